@@ -0,0 +1,3 @@
+#!/usr/bin/env python3
+
+"""Benchmarks, run them with 'python3 -m benchmarks.<name>'."""
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+""" Local HTTP server mimicking Google Translate TTS API, returning silent MP3 frames. """
+
+import argparse
+import http.server
+import random
+import threading
+import time
+import urllib.parse
+
+# MPEG 2 layer III, 32 kbps, 24 kHz, mono frame, with zeroed side information and main data, decoded as silence
+MP3_FRAME_HEADER = b"\xff\xf3\x44\xc4"
+MP3_FRAME = MP3_FRAME_HEADER + bytes(92)
+MP3_FRAME_DURATION = 576 / 24000
+SPEECH_DURATION_PER_CHAR = 0.06
+SILENCE_PADDING_DURATION = 0.2
+
+
+def buildMp3Data(text):
+    """Build silent MP3 data with a duration proportional to text length."""
+    duration = len(text) * SPEECH_DURATION_PER_CHAR + SILENCE_PADDING_DURATION
+    return MP3_FRAME * max(round(duration / MP3_FRAME_DURATION), 1)
+
+
+class FakeTtsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    """Request handler mimicking Google Translate TTS API."""
+
+    def do_GET(self):
+        """Handle GET request."""
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        with server.lock:
+            server.request_count += 1
+            delay = max(server.latency + server.rnd.uniform(-server.jitter, server.jitter), 0)
+            fail = server.rnd.random() < server.error_rate
+        time.sleep(delay)
+        if fail or ("q" not in params) or ("tl" not in params):
+            self.send_error(503 if fail else 400)
+            return
+        data = buildMp3Data(params["q"][0])
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """See http.server.BaseHTTPRequestHandler.log_message."""
+        pass
+
+
+class FakeTtsServer(http.server.ThreadingHTTPServer):
+
+    """
+    Local server mimicking Google Translate TTS API, running in a background thread.
+
+    Responses are delayed by latency seconds, plus or minus a random jitter, and a error_rate proportion of requests
+    fail with HTTP error 503.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0, seed=0, port=0):
+        super().__init__(("127.0.0.1", port), FakeTtsRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.thread = threading.Thread(target=self.serve_forever, name=__class__.__name__, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+    def getBaseUrl(self):
+        """Get URL to use as google_speech.SpeechSegment.BASE_URL."""
+        return "http://%s:%u/translate_tts" % self.server_address[:2]
+
+
+if __name__ == "__main__":
+    # parse args
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen to")
+    arg_parser.add_argument("-l", "--latency", type=float, default=0.05, help="Response latency in seconds")
+    arg_parser.add_argument("-j", "--jitter", type=float, default=0.02, help="Response latency jitter in seconds")
+    arg_parser.add_argument("-e", "--error-rate", type=float, default=0, help="Proportion of failed requests")
+    args = arg_parser.parse_args()
+
+    with FakeTtsServer(args.latency, args.jitter, args.error_rate, port=args.port) as server:
+        print("Listening on %s" % (server.getBaseUrl()))
+        server.thread.join()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+""" Benchmark peak memory usage when reading very large texts, from a string or from a file (Unix only). """
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import unittest.mock
+
+import google_speech
+from benchmarks.split_text import generateText
+
+MODES = ("string", "file")
+PIPELINES = ("split", "save")
+SILENT_MP3_FRAME = b"\xff\xf3\x44\xc4" + bytes(92)
+
+
+def getPeakRss():
+    """Get peak resident memory of the current process, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(text_filepath, mode, pipeline):
+    """Read a text file, and return a dictionary of measurements."""
+    baseline_rss = getPeakRss()
+    with open(text_filepath, "rt") as f:
+        speech = google_speech.Speech(f.read() if mode == "string" else f, "en")
+        if pipeline == "split":
+            segment_count = sum(1 for _ in speech)
+        else:
+            # no network, no cache growth: only measure the speech pipeline itself
+            # (replace methods with plain functions, mocks would record every call)
+            with unittest.mock.patch.object(
+                google_speech.SpeechSegment, "getCachedAudioData", new=lambda self: None
+            ), unittest.mock.patch.object(
+                google_speech.SpeechSegment, "storeAudioData", new=lambda self, audio_data: None
+            ), unittest.mock.patch.object(
+                google_speech.SpeechSegment, "download", new=lambda self, url: SILENT_MP3_FRAME
+            ), open(
+                os.devnull, "wb"
+            ) as output_file:
+                # count segments with the index callback, without keeping index entries
+                counter = itertools.count()
+                speech.savef(output_file, index=lambda segment: next(counter))
+            segment_count = next(counter)
+    return {
+        "mode": mode,
+        "pipeline": pipeline,
+        "size": os.path.getsize(text_filepath),
+        "segment_count": segment_count,
+        "peak_rss_increase": getPeakRss() - baseline_rss,
+    }
+
+
+if __name__ == "__main__":
+    # parse args
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("-s", "--size", type=int, default=100 * 1024 * 1024, help="Text size in characters")
+    arg_parser.add_argument("-m", "--modes", choices=MODES, nargs="+", default=MODES, help="Ways to read text")
+    arg_parser.add_argument(
+        "-p", "--pipelines", choices=PIPELINES, nargs="+", default=PIPELINES, help="What is done with segments"
+    )
+    arg_parser.add_argument("--run", nargs=3, metavar=("TEXT_FILE", "MODE", "PIPELINE"), help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run is not None:
+        # child process, so peak memory usage of each run is measured separately
+        print(json.dumps(run(*args.run)), flush=True)
+        sys.exit(0)
+
+    with tempfile.NamedTemporaryFile("wt", suffix=".txt") as text_file:
+        # generate text by blocks, to not need it all in memory here
+        block_size = 1024 * 1024
+        for i in range(0, args.size, block_size):
+            text_file.write(generateText("latin", min(block_size, args.size - i), seed=i))
+        text_file.flush()
+        for pipeline in args.pipelines:
+            for mode in args.modes:
+                subprocess.run(
+                    (sys.executable, "-m", "benchmarks.memory", "--run", text_file.name, mode, pipeline), check=True
+                )
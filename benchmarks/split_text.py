@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+""" Benchmark text splitting on large inputs in several scripts. """
+
+import argparse
+import json
+import random
+import string
+import timeit
+import unicodedata
+
+import google_speech
+
+SCRIPTS = {
+    # word characters, word separator, punctuation marks
+    "latin": (string.ascii_lowercase + "éèàç", " ", ".,;!?"),
+    "cjk": ("".join(chr(c) for c in range(0x4E00, 0x4E00 + 500)), "", "。，、！？"),
+    "devanagari": ("".join(chr(c) for c in range(0x0915, 0x0939)) + "ािीुूेैोौ", " ", "।,?"),
+}
+
+
+def generateText(script, size, seed=0):
+    """Generate pseudo random text of approximately size characters."""
+    letters, separator, punctuation = SCRIPTS[script]
+    rnd = random.Random(seed)
+    chunks = []
+    length = 0
+    while length < size:
+        word = "".join(rnd.choices(letters, k=rnd.randint(1, 12)))
+        if rnd.random() < 0.1:
+            word += rnd.choice(punctuation)
+        if rnd.random() < 0.01:
+            word += "\n"
+        chunks.append(word)
+        length += len(word) + len(separator)
+    return separator.join(chunks)
+
+
+def referenceSplitText(text):
+    """Split text with the original algorithm, slicing remaining text and scanning backwards up to 3 times."""
+    segments = []
+    remaining_text = google_speech.Speech.cleanSpaces(text)
+    max_size = google_speech.Speech.MAX_SEGMENT_SIZE
+    find = google_speech.Speech.findLastCharIndexMatching
+    while len(remaining_text) > max_size:
+        cur_text = remaining_text[:max_size]
+        split_idx = find(cur_text, lambda x: unicodedata.category(x) in ("Ps", "Pe", "Pi", "Pf", "Po"))
+        if split_idx is None:
+            split_idx = find(cur_text, lambda x: unicodedata.category(x).startswith("Z"))
+        if split_idx is None:
+            split_idx = find(cur_text, lambda x: not (unicodedata.category(x)[0] in ("L", "N")))
+        if split_idx is None:
+            split_idx = max_size - 1
+        segments.append(cur_text[: split_idx + 1].rstrip())
+        remaining_text = remaining_text[split_idx + 1 :].lstrip(string.whitespace + string.punctuation)
+    if remaining_text:
+        segments.append(remaining_text)
+    return segments
+
+
+if __name__ == "__main__":
+    # parse args
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        "-s", "--size", type=int, nargs="+", default=(1000000, 4000000), help="Text sizes in characters"
+    )
+    arg_parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of timing runs, best is kept")
+    arg_parser.add_argument("--no-reference", action="store_true", help="Do not time the original algorithm")
+    args = arg_parser.parse_args()
+
+    for script in SCRIPTS:
+        for size in args.size:
+            text = generateText(script, size)
+            segments = google_speech.Speech.splitText(text)
+            result = {"script": script, "size": len(text), "segment_count": len(segments)}
+            result["time"] = min(
+                timeit.repeat(lambda: google_speech.Speech.splitText(text), number=1, repeat=args.repeat)
+            )
+            if not args.no_reference:
+                assert referenceSplitText(text) == segments
+                result["reference_time"] = min(
+                    timeit.repeat(lambda: referenceSplitText(text), number=1, repeat=args.repeat)
+                )
+            print(json.dumps(result), flush=True)
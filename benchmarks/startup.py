@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+""" Benchmark command line startup: import time, and time to first audio byte with a warm cache (Linux only). """
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+WARM_TEXT = "Hello, this phrase is already in cache"
+
+
+def timeCommand(cmd, env, repeat, first_byte=False):
+    """Run a command several times, and return median time to exit, or to first byte on stdout if first_byte is True."""
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        p = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if first_byte:
+            assert p.stdout.read(1)
+            durations.append(time.perf_counter() - start_time)
+        p.communicate()
+        if not first_byte:
+            durations.append(time.perf_counter() - start_time)
+        assert p.returncode == 0
+    return statistics.median(durations)
+
+
+if __name__ == "__main__":
+    # parse args
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("-r", "--repeat", type=int, default=20, help="Number of runs, median is kept")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = os.environ.copy()
+        env["XDG_CACHE_HOME"] = cache_dir
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        # warm cache with fake audio data
+        subprocess.run(
+            (
+                sys.executable,
+                "-c",
+                "import google_speech; "
+                "google_speech.SpeechSegment(%r, 'en', 0, 1).storeAudioData(b'\\xff' * 4096)" % (WARM_TEXT),
+            ),
+            env=env,
+            check=True,
+        )
+
+        results = {
+            "interpreter": timeCommand((sys.executable, "-c", "pass"), env, args.repeat),
+            "import": timeCommand((sys.executable, "-c", "import google_speech"), env, args.repeat),
+            "help": timeCommand((sys.executable, "-m", "google_speech", "--help"), env, args.repeat),
+            "first_audio_byte_warm_cache": timeCommand(
+                (sys.executable, "-m", "google_speech", "-o", "-", WARM_TEXT), env, args.repeat, first_byte=True
+            ),
+        }
+    print(json.dumps(results))
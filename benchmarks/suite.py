@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+Offline end to end benchmark suite, using a local server mimicking Google Translate TTS API.
+
+Measure throughput and time to first audio for saving, playing (to the SoX null audio device), and reading from stdin,
+at several text sizes and concurrency levels, with cold and warm cache. Results are written as JSON lines.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import google_speech
+from benchmarks.fake_server import FakeTtsServer
+from benchmarks.split_text import generateText
+
+MODES = ("save", "play-segment", "play-stream", "stdin")
+RESULT_KEY_FIELDS = ("mode", "size", "jobs", "cache")
+MIN_REGRESSION_DURATION = 0.01
+
+
+class FirstAudioTimer:
+
+    """Instrumentation hook and file object recording the time audio output starts."""
+
+    def __init__(self):
+        self.first_audio_time = None
+        self.byte_count = 0
+
+    def __call__(self, event, data):
+        """See google_speech.instrumentation.addHook."""
+        if event == "play":
+            self.mark(time.perf_counter() - data["duration"])
+
+    def write(self, data):
+        """See io.RawIOBase.write."""
+        self.mark(time.perf_counter())
+        self.byte_count += len(data)
+        return len(data)
+
+    def flush(self):
+        """See io.RawIOBase.flush."""
+        pass
+
+    def mark(self, t):
+        """Record audio output time, if it is the first."""
+        if (self.first_audio_time is None) or (t < self.first_audio_time):
+            self.first_audio_time = t
+
+
+def useCacheDirectory(cache_dir):
+    """Make google_speech use a new cache in a directory."""
+    os.environ["XDG_CACHE_HOME"] = cache_dir
+    google_speech.SpeechSegment.setCache(None)
+
+
+def feedStdin(text, line_size=500):
+    """Replace stdin with a pipe, and write text to it, split into lines, from a background thread."""
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        with open(write_fd, "wt") as f:
+            for i in range(0, len(text), line_size):
+                f.write("%s\n" % (text[i : i + line_size]))
+
+    threading.Thread(target=write, daemon=True).start()
+    sys.stdin = open(read_fd, "rt")
+
+
+def runScenario(mode, text, jobs):
+    """Run a scenario, and return its measurements."""
+    timer = FirstAudioTimer()
+    google_speech.instrumentation.addHook(timer)
+    request_count = google_speech.SpeechSegment.getDownloadStats().get("requests", 0)
+    original_stdin = sys.stdin
+    start_time = time.perf_counter()
+    try:
+        if mode == "save":
+            google_speech.Speech(text, "en").savef(timer, jobs)
+        elif mode == "stdin":
+            feedStdin(text)
+            google_speech.Speech("-", "en").savef(timer, jobs)
+        else:
+            player = mode.split("-", 1)[1]
+            google_speech.Speech(text, "en").play(jobs=jobs, player=player)
+    finally:
+        duration = time.perf_counter() - start_time
+        google_speech.instrumentation.removeHook(timer)
+        if sys.stdin is not original_stdin:
+            sys.stdin.close()
+            sys.stdin = original_stdin
+    return {
+        "duration": duration,
+        "time_to_first_audio": (timer.first_audio_time - start_time) if timer.first_audio_time is not None else None,
+        "throughput": len(text) / duration,
+        "download_requests": google_speech.SpeechSegment.getDownloadStats().get("requests", 0) - request_count,
+    }
+
+
+def compareResults(results, baseline_filepath, tolerance):
+    """Compare results with a baseline result file, and return a list of regression descriptions."""
+    with open(baseline_filepath, "rt") as f:
+        baseline = {tuple(r[k] for k in RESULT_KEY_FIELDS): r for r in map(json.loads, f) if "duration" in r}
+    regressions = []
+    for result in results:
+        key = tuple(result[k] for k in RESULT_KEY_FIELDS)
+        if ("duration" not in result) or (key not in baseline):
+            continue
+        for metric in ("duration", "time_to_first_audio"):
+            value, ref_value = result[metric], baseline[key][metric]
+            if (
+                (value is not None)
+                and (ref_value is not None)
+                and (value > ref_value * (1 + tolerance))
+                # ignore noise on very short durations
+                and (value - ref_value > MIN_REGRESSION_DURATION)
+            ):
+                regressions.append(
+                    "%s %s: %.3fs -> %.3fs" % (dict(zip(RESULT_KEY_FIELDS, key)), metric, ref_value, value)
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    # parse args
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("-m", "--modes", choices=MODES, nargs="+", default=MODES, help="Modes to benchmark")
+    arg_parser.add_argument(
+        "-s", "--sizes", type=int, nargs="+", default=(1000, 10000, 50000), help="Text sizes in characters"
+    )
+    arg_parser.add_argument("-j", "--jobs", type=int, nargs="+", default=(1, 2, 8), help="Concurrency levels")
+    arg_parser.add_argument("-l", "--latency", type=float, default=0.05, help="Server response latency in seconds")
+    arg_parser.add_argument("--jitter", type=float, default=0.02, help="Server response latency jitter in seconds")
+    arg_parser.add_argument("-e", "--error-rate", type=float, default=0, help="Proportion of failed server responses")
+    arg_parser.add_argument("-o", "--output", default=None, help="Write results to this file instead of stdout")
+    arg_parser.add_argument("-c", "--compare", default=None, help="Baseline result file to detect regressions")
+    arg_parser.add_argument(
+        "-t", "--tolerance", type=float, default=0.2, help="Relative slowdown considered as a regression"
+    )
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL + 1)
+    os.environ["AUDIODEV"] = "null"
+    google_speech.SpeechSegment.DOWNLOAD_RETRY_BACKOFF = 0.05
+    has_sox = shutil.which("sox") is not None
+
+    results = []
+    output_file = open(args.output, "wt") if args.output is not None else sys.stdout
+    with FakeTtsServer(args.latency, args.jitter, args.error_rate) as server, output_file:
+        google_speech.SpeechSegment.BASE_URL = server.getBaseUrl()
+        for mode, size, jobs in itertools.product(args.modes, args.sizes, args.jobs):
+            text = generateText("latin", size, seed=size)
+            with tempfile.TemporaryDirectory() as cache_dir:
+                useCacheDirectory(cache_dir)
+                for cache in ("cold", "warm"):
+                    result = {"mode": mode, "size": size, "jobs": jobs, "cache": cache}
+                    if mode.startswith("play") and not has_sox:
+                        result["skipped"] = "SoX is not available"
+                    else:
+                        result.update(runScenario(mode, text, jobs))
+                    results.append(result)
+                    print(json.dumps(result), file=output_file, flush=True)
+
+    if args.compare is not None:
+        regressions = compareResults(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print("Regression: %s" % (regression), file=sys.stderr)
+        exit(int(bool(regressions)))
@@ -7,22 +7,31 @@ __author__ = "desbma"
 __license__ = "LGPLv2"
 
 import argparse
+import atexit
+import bisect
 import collections
+import concurrent.futures
+import contextlib
+import functools
+import importlib
+import itertools
+import json
 import logging
 import os
+import queue
+import random
 import re
+import sqlite3
 import string
 import subprocess
 import sys
 import threading
+import time
 import unicodedata
 import urllib.parse
+from typing import Counter, Dict
 
-import appdirs
-import requests
-import web_cache
-
-from google_speech import colored_logging
+from google_speech import colored_logging, instrumentation, mp3
 
 SUPPORTED_LANGUAGES = (
     "af",
@@ -102,26 +111,254 @@ SUPPORTED_LANGUAGES = (
     "zh-tw",
 )
 
-PRELOADER_THREAD_COUNT = 1
+PRELOADER_THREAD_COUNT = 2
+PRELOADER_WINDOW = 8
+DEFAULT_SERVER_ADDRESS = "127.0.0.1:8493"
 
 
 class PreloaderThread(threading.Thread):
 
-    """Thread to pre load (download and store in cache) audio data of a segment."""
+    """Thread to pre load (download and store in cache) audio data of segments taken from a scheduler queue."""
+
+    def __init__(self, scheduler, *args, **kwargs):
+        self.scheduler = scheduler
+        super().__init__(*args, **kwargs)
+
+    def run(self):
+        """See threading.Thread.run."""
+        while True:
+            segment = self.scheduler.getNextSegment()
+            error = None
+            try:
+                if segment is None:
+                    break
+                future = SpeechSegment.in_flight.get(segment.getCacheKey())
+                if future is not None:
+                    # being downloaded by another thread, don't wait for it, the segment is preloaded when it completes
+                    future.add_done_callback(functools.partial(__class__.onInFlightDone, segment))
+                    continue
+                if not segment.isInCache():
+                    segment.preLoad()
+                segment.preloaded_time = time.monotonic()
+            except Exception as e:
+                error = e
+                logging.getLogger().error("%s: %s" % (e.__class__.__qualname__, e))
+            finally:
+                if segment is not None:
+                    self.scheduler.onSegmentDone(segment, error)
+                self.scheduler.queue.task_done()
+
+    @staticmethod
+    def onInFlightDone(segment, future):
+        """Mark a segment as preloaded when the download of its audio data by another thread is complete."""
+        if future.exception() is None:
+            segment.preloaded_time = time.monotonic()
+
+
+class PreloadScheduler:
+
+    """
+    Pool of preloader threads, consuming segments from a priority queue.
+
+    Segments with the lowest priority value are preloaded first.
+    """
+
+    def __init__(self, thread_count=None):
+        if thread_count is None:
+            thread_count = PRELOADER_THREAD_COUNT
+        if thread_count < 1:
+            # join would wait forever for segments no thread consumes
+            raise ValueError("Invalid preloader thread count %d" % (thread_count))
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.threads = [PreloaderThread(self, name="PreloaderThread-%u" % (i)) for i in range(thread_count)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, segment, priority):
+        """Add a segment to preload."""
+        self.queue.put_nowait((priority, next(self.counter), segment))
+
+    def getNextSegment(self):
+        """Get next segment to preload, blocking until one is available, or None if the scheduler is stopping."""
+        return self.queue.get()[2]
+
+    def join(self):
+        """Wait for all submitted segments to be preloaded."""
+        self.queue.join()
+
+    def onSegmentDone(self, segment, error):
+        """Handle the end of a segment preload in a preloader thread, error being None if it succeeded."""
+        pass
+
+    def preloadAll(self, segments):
+        """
+        Preload segments, and wait for completion.
+
+        Identical segments are only submitted once. Return the number of unique segments.
+        """
+        cache_keys = set()
+        for segment in segments:
+            cache_key = segment.getCacheKey()
+            if cache_key in cache_keys:
+                continue
+            cache_keys.add(cache_key)
+            self.submit(segment, len(cache_keys))
+        self.join()
+        return len(cache_keys)
+
+    def stop(self):
+        """Drop pending segments, and wait for preloader threads to finish their current segment."""
+        try:
+            while True:
+                self.queue.get_nowait()
+                self.queue.task_done()
+        except queue.Empty:
+            pass
+        for _ in self.threads:
+            self.queue.put_nowait((-1, next(self.counter), None))
+        for thread in self.threads:
+            thread.join()
+
+
+class SegmentReaderThread(threading.Thread):
+
+    """
+    Thread producing speech segments, and scheduling them for preloading, ahead of their consumption.
+
+    Produced segments are stored in a bounded queue, so the thread blocks when it gets too far ahead.
+    """
+
+    def __init__(self, segments, scheduler, window, preload_first=True):
+        super().__init__(name=__class__.__name__, daemon=True)
+        self.segments = segments
+        self.scheduler = scheduler
+        self.preload_first = preload_first
+        self.segment_queue = queue.Queue(maxsize=max(window, 1))
+        self.stopped = threading.Event()
 
     def run(self):
         """See threading.Thread.run."""
         try:
-            for segment in self.segments:
-                acquired = segment.preload_mutex.acquire(blocking=False)
-                if acquired:
-                    try:
-                        if not segment.isInCache():
-                            segment.preLoad()
-                    finally:
-                        segment.preload_mutex.release()
+            for segment_idx, segment in enumerate(self.segments):
+                if self.stopped.is_set():
+                    return
+                if (segment_idx > 0) or self.preload_first:
+                    # priority is the segment position, so the next segment to be consumed is always preloaded first
+                    segment.preload_scheduled = True
+                    self.scheduler.submit(segment, segment_idx)
+                self.segment_queue.put(segment)
         except Exception as e:
-            logging.getLogger().error("%s: %s" % (e.__class__.__qualname__, e))
+            self.segment_queue.put(e)
+        else:
+            self.segment_queue.put(None)
+
+    def __iter__(self):
+        """Get produced segments, in order."""
+        while True:
+            item = self.segment_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def stop(self):
+        """Request thread stop, without waiting for it, because it may be blocked reading input."""
+        self.stopped.set()
+        try:
+            while True:
+                self.segment_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class StreamPlayer:
+
+    """
+    Player keeping a single SoX process open, and feeding it audio data of segments in order.
+
+    Segments are trimmed at MP3 frame boundaries, and sent as a single MP3 stream, without decoding them first.
+    """
+
+    def __init__(self, sox_effects=()):
+        cmd = ["sox", "-q", "-t", "mp3", "-"]
+        if sys.platform.startswith("win32"):
+            cmd.extend(("-t", "waveaudio"))
+        cmd.append("-d")
+        cmd.extend(sox_effects)
+        logging.getLogger().debug("Start player process")
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def play(self, segment):
+        """Queue a segment for playback."""
+        start_time = time.monotonic()
+        audio_data = segment.getTrimmedAudioData()
+        fetched_time = time.monotonic()
+        logging.getLogger().info("Playing speech segment (%s): '%s'" % (segment.lang, segment))
+        with instrumentation.timed("play", player="stream", bytes=len(audio_data)):
+            self.write(audio_data)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.getLogger().debug(
+                "Segment %u: fetched in %.3fs, %.2fs of audio queued in %.3fs"
+                % (
+                    segment.segment_num,
+                    fetched_time - start_time,
+                    mp3.getDuration(audio_data),
+                    time.monotonic() - fetched_time,
+                )
+            )
+
+    def write(self, audio_data):
+        """Queue MP3 data for playback."""
+        try:
+            self.process.stdin.write(audio_data)
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            raise RuntimeError("Player process exited unexpectedly")
+
+    def close(self):
+        """Wait for the end of playback."""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.process.wait() != 0:
+            raise RuntimeError()
+        logging.getLogger().debug("Done playing")
+
+
+class SourceOffsetMap:
+
+    """Map of offsets in a text with spaces cleaned (see Speech.cleanSpaces), to offsets in its source text."""
+
+    def __init__(self, source_offset=0):
+        # start offsets of clean text parts, and of their source, each part being contiguous in source text
+        self.offsets = [0]
+        self.source_offsets = [source_offset]
+
+    def add(self, offset, source_offset):
+        """Add a part of clean text starting at offset, from source text starting at source_offset."""
+        self.offsets.append(offset)
+        self.source_offsets.append(source_offset)
+
+    def getSourceOffset(self, offset):
+        """Get the offset in source text of a character of clean text."""
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        return self.source_offsets[i] + offset - self.offsets[i]
+
+    def getSourceSpan(self, start, end):
+        """Get (start, end) offsets in source text of clean text from start to end (not included)."""
+        source_start = self.getSourceOffset(start)
+        if end <= start:
+            return source_start, source_start
+        return source_start, self.getSourceOffset(end - 1) + 1
 
 
 class Speech:
@@ -130,10 +367,42 @@ class Speech:
 
     CLEAN_MULTIPLE_SPACES_REGEX = re.compile(r"\s{2,}")
     MAX_SEGMENT_SIZE = 200
+    SPLIT_STRIP_CHARS = frozenset(string.whitespace + string.punctuation)
+    SPLIT_CHAR_CLASS_PUNCTUATION, SPLIT_CHAR_CLASS_WHITESPACE, SPLIT_CHAR_CLASS_OTHER, SPLIT_CHAR_CLASS_ALNUM = range(4)
+    SPLIT_CHAR_CLASSES: Dict[str, int] = {}  # cache of getSplitCharClass results
+    # sentence terminals (Unicode Sentence_Terminal property) of common scripts
+    SENTENCE_END_CHARS = frozenset(
+        ".!?\u037e\u0589\u061f\u06d4\u0964\u0965\u104a\u104b\u1362\u1367\u1368\u2026\u3002\uff01\uff0e\uff1f"
+    )
+    # sentence terminals that may not be followed by a space, unlike '.' in numbers or abbreviations for example
+    SENTENCE_END_NO_SPACE_CHARS = "\u0964\u0965\u104a\u104b\u1362\u1367\u1368\u3002\uff01\uff0e\uff1f"
+    SENTENCE_TRAILING_CHARS = "\"'\u00bb\u201d\u2019)]\u300d\u300f\uff09"
+    # whitespace, or sentence terminals not followed by whitespace, with their trailing characters
+    CLAUSE_SPLIT_REGEX = re.compile(
+        r"\s+|[%s]+[%s]*(?=[^\s%s])"
+        % (SENTENCE_END_NO_SPACE_CHARS, re.escape(SENTENCE_TRAILING_CHARS), re.escape(SENTENCE_TRAILING_CHARS))
+    )
+    # cached segments spanning several windows are not reused
+    SENTENCE_WINDOW_SIZE = 5 * MAX_SEGMENT_SIZE
 
-    def __init__(self, text, lang):
-        self.text = self.cleanSpaces(text)
+    READ_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, text, lang, segmentation="greedy"):
+        """
+        Create speech for text.
+
+        text can be a string ('-' to read lines from stdin), or a text file object or iterator of text chunks, read
+        lazily, with a bounded memory usage.
+        """
+        if isinstance(text, str):
+            self.text, self.offset_map = self.cleanSpacesWithOffsets(text)
+            self.chunks = None
+        else:
+            self.text = None
+            self.offset_map = None
+            self.chunks = text
         self.lang = lang
+        self.segmentation = segmentation
 
     def __iter__(self):
         """Get an iterator over speech segments."""
@@ -145,18 +414,167 @@ class Speech:
             if sys.stdin.isatty():
                 logging.getLogger().error("Stdin is not a pipe")
                 return
+            # offset of line in clean text, lines being joined by a space, and in source text
+            line_offset = 0
+            line_source_offset = 0
             while True:
                 new_line = sys.stdin.readline()
                 if not new_line:
                     return
-                segments = __class__.splitText(new_line)
-                for segment_num, segment in enumerate(segments):
-                    yield SpeechSegment(segment, self.lang, segment_num, len(segments))
+                with instrumentation.timed("split", text_length=len(new_line)) as event_data:
+                    clean_line, offset_map = __class__.cleanSpacesWithOffsets(new_line, line_source_offset)
+                    offsets = list(self.iterSegmentOffsets(clean_line))
+                    event_data["segment_count"] = len(offsets)
+                for segment_num, (start, end) in enumerate(offsets):
+                    yield SpeechSegment(
+                        clean_line[start:end],
+                        self.lang,
+                        segment_num,
+                        len(offsets),
+                        text_offset=line_offset + start,
+                        source_span=offset_map.getSourceSpan(start, end),
+                    )
+                if clean_line:
+                    line_offset += len(clean_line) + 1
+                line_source_offset += len(new_line)
+
+        elif self.chunks is not None:
+            yield from self.iterChunkSegments()
+
+        elif self.segmentation == "sentence":
+            # splitting needs cache lookups, yield segments of each window of sentences as soon as it is split
+            segment_num = 0
+            for window in __class__.iterSentenceWindows(self.text):
+                with instrumentation.timed("split", text_length=window[-1][1] - window[0][0]) as event_data:
+                    offsets = __class__.splitSentenceWindow(self.text, window, self.lang)
+                    event_data["segment_count"] = len(offsets)
+                for start, end in offsets:
+                    yield SpeechSegment(
+                        self.text[start:end],
+                        self.lang,
+                        segment_num,
+                        text_offset=start,
+                        source_span=self.offset_map.getSourceSpan(start, end),
+                    )
+                    segment_num += 1
+
+        else:
+            # text is already clean
+            with instrumentation.timed("split", text_length=len(self.text)) as event_data:
+                offsets = list(self.iterSegmentOffsets(self.text))
+                event_data["segment_count"] = len(offsets)
+            for segment_num, (start, end) in enumerate(offsets):
+                yield SpeechSegment(
+                    self.text[start:end],
+                    self.lang,
+                    segment_num,
+                    len(offsets),
+                    text_offset=start,
+                    source_span=self.offset_map.getSourceSpan(start, end),
+                )
+
+    def iterChunkSegments(self):
+        """
+        Get speech segments of text read from chunks, cleaning and splitting text incrementally.
 
+        Segments ending in the last MAX_SEGMENT_SIZE characters read may change with the next chunk, so they are held
+        back until more text is read. With sentence segmentation, the last window of sentences read (see
+        iterSentenceWindows) is held back instead, and only the text read since the last window end was searched is
+        searched again. If no window end is found in twice SENTENCE_WINDOW_SIZE characters, leading text is split like
+        with greedy segmentation, to not wait for the end of the text. Total segment count is unknown.
+        """
+        read = getattr(self.chunks, "read", None)
+        if read is not None:
+            chunks = iter(functools.partial(read, __class__.READ_CHUNK_SIZE), "")
         else:
-            segments = __class__.splitText(self.text)
-            for segment_num, segment in enumerate(segments):
-                yield SpeechSegment(segment, self.lang, segment_num, len(segments))
+            chunks = iter(self.chunks)
+        max_size = __class__.MAX_SEGMENT_SIZE
+        # source text not split yet, and its offset in the whole source text
+        source_text = ""
+        source_offset = 0
+        # offset of text in the whole clean text
+        text_offset = 0
+        # offset in text from which to search for the next sentence window end
+        scan_start = 0
+        segment_num = 0
+        for chunk in chunks:
+            with instrumentation.timed("split", text_length=len(chunk)) as event_data:
+                source_text += chunk
+                # trailing spaces may be followed by text in next chunk
+                text, offset_map = __class__.cleanSpacesWithOffsets(source_text, source_offset, strip_end=False)
+                ready_offsets = []
+                # offset of the first segment held back
+                next_start = 0
+                if self.segmentation == "sentence":
+                    while True:
+                        window_end = __class__.findSentenceWindowEnd(text, next_start, scan_start)
+                        if window_end is None:
+                            break
+                        window = list(__class__.iterClauseOffsets(text, next_start, window_end))
+                        ready_offsets.extend(__class__.splitSentenceWindow(text, window, self.lang))
+                        next_start = scan_start = window_end
+                    # held back text is cleaned again, without leading spaces
+                    while (next_start < len(text)) and text[next_start].isspace():
+                        next_start += 1
+                    scan_start = len(text)
+                    if len(text) - next_start > 2 * __class__.SENTENCE_WINDOW_SIZE:
+                        # no sentence end in sight
+                        greedy_offsets, next_start = __class__.splitReadyText(
+                            text, next_start, __class__.SENTENCE_WINDOW_SIZE
+                        )
+                        ready_offsets.extend(greedy_offsets)
+                elif len(text) > 2 * max_size:
+                    ready_offsets, next_start = __class__.splitReadyText(text, 0, max_size)
+                event_data["segment_count"] = len(ready_offsets)
+            for start, end in ready_offsets:
+                yield SpeechSegment(
+                    text[start:end],
+                    self.lang,
+                    segment_num,
+                    text_offset=text_offset + start,
+                    source_span=offset_map.getSourceSpan(start, end),
+                )
+                segment_num += 1
+            text_offset += next_start
+            scan_start -= next_start
+            next_source_offset = offset_map.getSourceOffset(next_start)
+            source_text = source_text[next_source_offset - source_offset :]
+            source_offset = next_source_offset
+        text, offset_map = __class__.cleanSpacesWithOffsets(source_text, source_offset)
+        for start, end in self.iterSegmentOffsets(text):
+            yield SpeechSegment(
+                text[start:end],
+                self.lang,
+                segment_num,
+                text_offset=text_offset + start,
+                source_span=offset_map.getSourceSpan(start, end),
+            )
+            segment_num += 1
+
+    @staticmethod
+    def splitReadyText(text, start, held_size):
+        """
+        Split text[start:] (with spaces already cleaned) like iterSplitOffsets, except its last held_size characters.
+
+        Return the (start, end) offsets in text of the segments ending before the held back characters, and the start
+        offset of the next segment.
+        """
+        offsets = [
+            (start + segment_start, start + segment_end)
+            for segment_start, segment_end in __class__.iterSplitOffsets(text[start:])
+        ]
+        ready_count = 0
+        while (ready_count < len(offsets) - 1) and (offsets[ready_count][1] <= len(text) - held_size):
+            ready_count += 1
+        if ready_count == 0:
+            return [], start
+        return offsets[:ready_count], offsets[ready_count][0]
+
+    def iterSegmentOffsets(self, text):
+        """Split text (with spaces already cleaned) with the segmentation mode of the speech, and yield offsets."""
+        if self.segmentation == "sentence":
+            return __class__.iterSentenceSplitOffsets(text, self.lang)
+        return __class__.iterSplitOffsets(text)
 
     @staticmethod
     def findLastCharIndexMatching(text, func):
@@ -168,40 +586,215 @@ class Speech:
     @staticmethod
     def splitText(text):
         """Split text into sub segments of size not bigger than MAX_SEGMENT_SIZE."""
-        segments = []
-        remaining_text = __class__.cleanSpaces(text)
+        clean_text = __class__.cleanSpaces(text)
+        return [clean_text[start:end] for start, end in __class__.iterSplitOffsets(clean_text)]
 
-        while len(remaining_text) > __class__.MAX_SEGMENT_SIZE:
-            cur_text = remaining_text[: __class__.MAX_SEGMENT_SIZE]
+    @staticmethod
+    def iterSplitOffsets(text):
+        """
+        Split text (with spaces already cleaned) into sub segments of size not bigger than MAX_SEGMENT_SIZE.
 
-            # try to split at punctuation
-            split_idx = __class__.findLastCharIndexMatching(
-                cur_text,
-                # https://en.wikipedia.org/wiki/Unicode_character_property#General_Category
-                lambda x: unicodedata.category(x) in ("Ps", "Pe", "Pi", "Pf", "Po"),
-            )
-            if split_idx is None:
-                # try to split at whitespace
-                split_idx = __class__.findLastCharIndexMatching(
-                    cur_text, lambda x: unicodedata.category(x).startswith("Z")
-                )
-            if split_idx is None:
-                # try to split at anything not a letter or number
-                split_idx = __class__.findLastCharIndexMatching(
-                    cur_text, lambda x: not (unicodedata.category(x)[0] in ("L", "N"))
-                )
-            if split_idx is None:
-                # split at the last char
-                split_idx = __class__.MAX_SEGMENT_SIZE - 1
+        Yield (start, end) offsets of each segment in text.
+        """
+        max_size = __class__.MAX_SEGMENT_SIZE
+        text_len = len(text)
+        start = 0
+        while text_len - start > max_size:
+            split_idx = __class__.findSplitIndex(text, start, start + max_size)
+            end = split_idx + 1
+            yield start, start + len(text[start:end].rstrip())
+            start = end
+            while (start < text_len) and (text[start] in __class__.SPLIT_STRIP_CHARS):
+                start += 1
+        if start < text_len:
+            yield start, text_len
 
-            new_segment = cur_text[: split_idx + 1].rstrip()
-            segments.append(new_segment)
-            remaining_text = remaining_text[split_idx + 1 :].lstrip(string.whitespace + string.punctuation)
+    @staticmethod
+    def findSplitIndex(text, start, end):
+        """
+        Return index of the character where to split text[start:end].
 
-        if remaining_text:
-            segments.append(remaining_text)
+        Try to split at the last punctuation, then at the last whitespace, then at the last character that is not a
+        letter or number, and then at the last character.
+        """
+        char_classes = __class__.SPLIT_CHAR_CLASSES
+        whitespace_idx = other_idx = None
+        for i in range(end - 1, start - 1, -1):
+            c = text[i]
+            char_class = char_classes.get(c)
+            if char_class is None:
+                char_class = char_classes[c] = __class__.getSplitCharClass(c)
+            if char_class == __class__.SPLIT_CHAR_CLASS_PUNCTUATION:
+                return i
+            elif char_class == __class__.SPLIT_CHAR_CLASS_WHITESPACE:
+                if whitespace_idx is None:
+                    whitespace_idx = i
+            elif char_class == __class__.SPLIT_CHAR_CLASS_OTHER:
+                if other_idx is None:
+                    other_idx = i
+        if whitespace_idx is not None:
+            return whitespace_idx
+        if other_idx is not None:
+            return other_idx
+        return end - 1
 
-        return segments
+    @staticmethod
+    def iterClauseOffsets(text, start=0, end=None):
+        """
+        Split text[start:end] (with spaces already cleaned) after each punctuation followed by whitespace.
+
+        Text is also split after sentence terminals of SENTENCE_END_NO_SPACE_CHARS, even if no whitespace follows.
+        Yield (start, end, is_sentence_end) offsets in text for each clause, clauses longer than MAX_SEGMENT_SIZE being
+        split like iterSplitOffsets does.
+        """
+        if end is None:
+            end = len(text)
+        clause_ends = list(__class__.iterClauseEnds(text, start, end))
+        clause_ends.append(end)
+        for clause_end in clause_ends:
+            while (start < clause_end) and (text[start] in __class__.SPLIT_STRIP_CHARS):
+                start += 1
+            if start == clause_end:
+                continue
+            clause = text[start:clause_end]
+            stripped_clause = clause.rstrip(__class__.SENTENCE_TRAILING_CHARS)
+            is_sentence_end = (clause_end == end) or (stripped_clause[-1:] in __class__.SENTENCE_END_CHARS)
+            sub_offsets = list(__class__.iterSplitOffsets(clause))
+            for i, (sub_start, sub_end) in enumerate(sub_offsets):
+                yield start + sub_start, start + sub_end, is_sentence_end and (i == len(sub_offsets) - 1)
+            start = clause_end
+
+    @staticmethod
+    def iterClauseEnds(text, start, end):
+        """Yield end offsets of clauses of text[start:end] (see iterClauseOffsets), except the last one."""
+        for match in __class__.CLAUSE_SPLIT_REGEX.finditer(text, start, end):
+            if not text[match.start()].isspace():
+                yield match.end()
+            elif (match.start() > 0) and (
+                __class__.getSplitCharClass(text[match.start() - 1]) == __class__.SPLIT_CHAR_CLASS_PUNCTUATION
+            ):
+                yield match.start()
+
+    @staticmethod
+    def iterSentenceWindows(text):
+        """
+        Group clauses of text (with spaces already cleaned) into windows of whole sentences, to split them separately.
+
+        Each window, except the last one, ends at the first sentence end after SENTENCE_WINDOW_SIZE characters (see
+        findSentenceWindowEnd), so window boundaries only depend on the text before them. Yield lists of clauses, as
+        yielded by iterClauseOffsets.
+        """
+        start = 0
+        while start < len(text):
+            end = __class__.findSentenceWindowEnd(text, start)
+            if end is None:
+                end = len(text)
+            window = list(__class__.iterClauseOffsets(text, start, end))
+            if window:
+                yield window
+            start = end
+
+    @staticmethod
+    def findSentenceWindowEnd(text, start, scan_start=0):
+        """
+        Find the end of the window of sentences of text starting at offset start (see iterSentenceWindows).
+
+        Clause ends before scan_start are not looked at again, so that text read incrementally is only scanned once.
+        Return the end offset of the first sentence at least SENTENCE_WINDOW_SIZE characters after the first non space
+        character from start, or None if there is none.
+        """
+        while (start < len(text)) and text[start].isspace():
+            start += 1
+        min_end = max(start + __class__.SENTENCE_WINDOW_SIZE, scan_start)
+        if min_end >= len(text):
+            return None
+        # a clause split may begin before min_end
+        search_start = min_end
+        while (search_start > start) and (
+            (text[search_start - 1] in __class__.SENTENCE_END_NO_SPACE_CHARS)
+            or (text[search_start - 1] in __class__.SENTENCE_TRAILING_CHARS)
+        ):
+            search_start -= 1
+        for clause_end in __class__.iterClauseEnds(text, search_start, len(text)):
+            if clause_end < min_end:
+                continue
+            i = clause_end
+            while (i > start) and (text[i - 1] in __class__.SENTENCE_TRAILING_CHARS):
+                i -= 1
+            if (i > start) and (text[i - 1] in __class__.SENTENCE_END_CHARS):
+                return clause_end
+        return None
+
+    @staticmethod
+    def iterSentenceSplitOffsets(text, lang):
+        """
+        Split text (with spaces already cleaned) at sentence and clause boundaries, preferring already cached segments.
+
+        Unlike iterSplitOffsets, a sentence is not merged with its neighbours, unless the merged segment is already
+        cached, so the same sentence gives the same segment in different texts, and its audio data is reused. Long
+        sentences are split at clause boundaries. Windows of sentences (see iterSentenceWindows) are split one at a
+        time, so the first segments are available before the whole text is split.
+        Yield (start, end) offsets of each segment in text.
+        """
+        for window in __class__.iterSentenceWindows(text):
+            yield from __class__.splitSentenceWindow(text, window, lang)
+
+    @staticmethod
+    def splitSentenceWindow(text, clauses, lang):
+        """
+        Split a window of clauses of text, preferring already cached segments (see iterSentenceSplitOffsets).
+
+        Cache is looked up once for all candidate segments. Return a list of (start, end) offsets of each segment in
+        text.
+        """
+        max_size = __class__.MAX_SEGMENT_SIZE
+        # cache keys of candidate segments, made of clauses[i:j]
+        candidates = {}
+        for i in range(len(clauses)):
+            start = clauses[i][0]
+            for j in range(i + 1, len(clauses) + 1):
+                end = clauses[j - 1][1]
+                if (j > i + 1) and (end - start > max_size):
+                    break
+                candidates[i, j] = SpeechSegment.buildCacheKey(text[start:end], lang)
+        cached_keys = SpeechSegment.getCachedKeys(candidates.values())
+        # best[i] is (cost, segment end clause index) to read clauses[i:], cost being a tuple compared in order:
+        # uncached segments of several sentences, uncached segments, segments
+        best = [None] * len(clauses) + [((0, 0, 0), None)]
+        for i in range(len(clauses) - 1, -1, -1):
+            for j in range(i + 1, len(clauses) + 1):
+                cache_key = candidates.get((i, j))
+                if cache_key is None:
+                    break
+                if cache_key in cached_keys:
+                    cost = (0, 0, 1)
+                else:
+                    is_multi_sentence = any(clause[2] for clause in clauses[i : j - 1])
+                    cost = (int(is_multi_sentence), 1, 1)
+                next_cost = best[j][0]
+                cost = (cost[0] + next_cost[0], cost[1] + next_cost[1], cost[2] + next_cost[2])
+                if (best[i] is None) or (cost < best[i][0]):
+                    best[i] = (cost, j)
+        offsets = []
+        i = 0
+        while i < len(clauses):
+            j = best[i][1]
+            offsets.append((clauses[i][0], clauses[j - 1][1]))
+            i = j
+        return offsets
+
+    @staticmethod
+    def getSplitCharClass(c):
+        """Get the class of a character, to choose where to split text."""
+        # https://en.wikipedia.org/wiki/Unicode_character_property#General_Category
+        category = unicodedata.category(c)
+        if category in ("Ps", "Pe", "Pi", "Pf", "Po"):
+            return __class__.SPLIT_CHAR_CLASS_PUNCTUATION
+        if category[0] == "Z":
+            return __class__.SPLIT_CHAR_CLASS_WHITESPACE
+        if category[0] not in ("L", "N"):
+            return __class__.SPLIT_CHAR_CLASS_OTHER
+        return __class__.SPLIT_CHAR_CLASS_ALNUM
 
     @staticmethod
     def cleanSpaces(dirty_string):
@@ -210,41 +803,278 @@ class Speech:
             " ", dirty_string.replace("\n", " ").replace("\t", " ").strip()
         )
 
-    def play(self, sox_effects=()):
-        """Play a speech."""
-
-        # build the segments
-        preloader_threads = []
-        if self.text != "-":
-            segments = list(self)
-            # start preloader thread(s)
-            preloader_threads = [
-                PreloaderThread(name="PreloaderThread-%u" % (i)) for i in range(PRELOADER_THREAD_COUNT)
-            ]
-            for preloader_thread in preloader_threads:
-                preloader_thread.segments = segments
-                preloader_thread.start()
+    @staticmethod
+    def cleanSpacesWithOffsets(dirty_string, source_offset=0, strip_end=True):
+        """
+        Remove consecutive spaces from a string like cleanSpaces, and map offsets in the clean string to the source.
+
+        dirty_string starts at source_offset in the source text. If strip_end is False, trailing spaces are collapsed
+        but not removed. Return the clean string and its SourceOffsetMap.
+        """
+        text = dirty_string.replace("\n", " ").replace("\t", " ")
+        stripped_text = text.lstrip()
+        source_offset += len(text) - len(stripped_text)
+        if strip_end:
+            stripped_text = stripped_text.rstrip()
+        offset_map = SourceOffsetMap(source_offset)
+        removed_count = 0
+        for match in __class__.CLEAN_MULTIPLE_SPACES_REGEX.finditer(stripped_text):
+            removed_count += match.end() - match.start() - 1
+            offset_map.add(match.end() - removed_count, source_offset + match.end())
+        return __class__.CLEAN_MULTIPLE_SPACES_REGEX.sub(" ", stripped_text), offset_map
+
+    def iterPreloaded(self, jobs=None, window=None, preload_first=True, scheduler=None):
+        """
+        Get an iterator over speech segments, preloading the next ones in the background.
+
+        Segments are produced by a reader thread, so that reading from stdin does not delay playback, and at most
+        window segments ahead of the current one are scheduled for preloading, by a pool of jobs threads, or by a
+        shared scheduler if one is given. If preload_first is False, the first segment is left to the caller.
+        """
+        if window is None:
+            window = PRELOADER_WINDOW
+        own_scheduler = scheduler is None
+        if own_scheduler:
+            scheduler = PreloadScheduler(jobs)
+        reader_thread = SegmentReaderThread(iter(self), scheduler, window, preload_first)
+        reader_thread.start()
+        try:
+            yield from reader_thread
+        finally:
+            reader_thread.stop()
+            if own_scheduler:
+                scheduler.stop()
+
+    def play(self, sox_effects=(), jobs=None, player="segment", stream_download=False):
+        """
+        Play a speech.
+
+        With the 'segment' player, a SoX process is started for each segment, and effects are applied to each segment
+        separately. With the 'stream' player, segments are trimmed at MP3 frame level, and sent without decoding to a
+        single SoX process for gapless playback, and effects are applied to the whole speech.
+        If stream_download is True, with the 'segment' player, segments that are not cached or being preloaded are
+        played while they are downloaded. The first segment is then not preloaded, to start playing it as soon as
+        possible.
+        """
+        stream_download = stream_download and (player == "segment")
+        segments = self.iterPreloaded(jobs, preload_first=not stream_download)
+        if player == "stream":
+            with StreamPlayer(sox_effects) as stream_player:
+                for segment in segments:
+                    stream_player.play(segment)
         else:
-            segments = iter(self)
+            for segment in segments:
+                segment.play(sox_effects, stream_download)
 
-        # play segments
-        for segment in segments:
-            segment.play(sox_effects)
+    def save(self, path, jobs=None, index=False):
+        """
+        Save audio data to an MP3 file.
+
+        If index is True, the segment index is also written to a JSON file next to it (see segment_index).
+        """
+        with contextlib.ExitStack() as exit_stack:
+            f = exit_stack.enter_context(open(path, "wb"))
+            index_writer = None
+            if index:
+                from google_speech import segment_index
+
+                index_writer = exit_stack.enter_context(
+                    segment_index.IndexWriter(segment_index.getIndexPath(path), self.lang)
+                )
+            self.savef(f, jobs, index_writer)
+
+    def savef(self, file, jobs=None, index=None):
+        """
+        Write audio data into a file object.
+
+        Segments are downloaded concurrently by jobs threads, and written in order as soon as they are available.
+        They are trimmed and concatenated at MP3 frame level, with a Xing/Info header if the file is seekable.
+        If index is not None, it is called with the index entry of each segment, as soon as it is written: a dictionary
+        with its offsets in the source text (before spaces are cleaned), its byte offset and size in the MP3 stream,
+        its frame count, start time and duration in seconds.
+        """
+        start_time = 0
+        with mp3.Mp3Writer(file) as writer:
+            for segment in self.iterPreloaded(jobs):
+                audio_data = segment.getTrimmedAudioData()
+                frames = writer.write(audio_data)
+                file.flush()
+                if index is None:
+                    continue
+                duration = sum(frame.sample_count / frame.sample_rate for frame in frames)
+                index(
+                    {
+                        "text_start": segment.source_span[0],
+                        "text_end": segment.source_span[1],
+                        "offset": writer.byte_count - len(audio_data),
+                        "size": len(audio_data),
+                        "frame_count": len(frames),
+                        "start_time": start_time,
+                        "duration": duration,
+                    }
+                )
+                start_time += duration
 
-        if self.text != "-":
-            # destroy preloader threads
-            for preloader_thread in preloader_threads:
-                preloader_thread.join()
 
-    def save(self, path):
-        """Save audio data to an MP3 file."""
-        with open(path, "wb") as f:
-            self.savef(f)
+class SingleFlight:
 
-    def savef(self, file):
-        """Write audio data into a file object."""
-        for segment in self:
-            file.write(segment.getAudioData())
+    """
+    Registry of in flight calls, identified by a key.
+
+    Concurrent calls with the same key share a single execution, and all callers get its result or exception.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.futures
+
+    def get(self, key):
+        """Get the future of the in flight call for key, or None if there is none."""
+        with self.lock:
+            return self.futures.get(key)
+
+    def register(self, key):
+        """Get the future of the in flight call for key, and a boolean that is True if the caller must execute it."""
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                return future, False
+            future = self.futures[key] = concurrent.futures.Future()
+            return future, True
+
+    def complete(self, key, future, result=None, exception=None):
+        """Set result or exception of an in flight call, and remove it from the registry."""
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+        with self.lock:
+            del self.futures[key]
+
+    def call(self, key, func):
+        """Call func, or wait for the result of the in flight call with the same key."""
+        future, leader = self.register(key)
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            self.complete(key, future, exception=e)
+            raise
+        self.complete(key, future, result)
+        return result
+
+    async def callAsync(self, key, coroutine_func):
+        """Await coroutine_func(), or wait for the result of the in flight call with the same key."""
+        import asyncio
+
+        future, leader = self.register(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await coroutine_func()
+        except BaseException as e:
+            self.complete(key, future, exception=e)
+            raise
+        self.complete(key, future, result)
+        return result
+
+
+class RateLimiter:
+
+    """Token bucket rate limiter, shared by all threads."""
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("Invalid rate %s, must be positive" % (rate))
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting until it is available, and return the time waited in seconds."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def reserve(self):
+        """Take a token, and return the time to wait in seconds until it is available, without waiting."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            # tokens can go negative, each caller then waits for its own token to be available
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class MemoryCache:
+
+    """
+    In memory LRU cache of audio data, with a total size budget in bytes.
+
+    Used as a tier in front of the persistent cache, to serve frequently used data without database access.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hit_count = self.miss_count = self.eviction_count = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def get(self, key):
+        """Get data for key and mark it as recently used, or return None if it is not in cache."""
+        with self.lock:
+            try:
+                data = self.data[key]
+            except KeyError:
+                self.miss_count += 1
+                return None
+            self.data.move_to_end(key)
+            self.hit_count += 1
+            return data
+
+    def __setitem__(self, key, data):
+        if len(data) > self.max_size:
+            return
+        with self.lock:
+            previous_data = self.data.pop(key, None)
+            if previous_data is not None:
+                self.size -= len(previous_data)
+            self.data[key] = data
+            self.size += len(data)
+            # evict least recently used entries
+            while self.size > self.max_size:
+                evicted_data = self.data.popitem(last=False)[1]
+                self.size -= len(evicted_data)
+                self.eviction_count += 1
+
+    def __len__(self):
+        return len(self.data)
+
+    def getStats(self):
+        """Return a dictionary of cache counters."""
+        with self.lock:
+            return {
+                "entries": len(self.data),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hits": self.hit_count,
+                "misses": self.miss_count,
+                "evictions": self.eviction_count,
+            }
 
 
 class SpeechSegment:
@@ -252,90 +1082,506 @@ class SpeechSegment:
     """Text segment to be read."""
 
     BASE_URL = "https://translate.google.com/translate_tts"
+    HTTP_HEADERS = {"User-Agent": "Mozilla/5.0"}
+    HTTP_TIMEOUT = 3.1
+    CLEAN_SPACES_REGEX = re.compile(r"\s+")
+    # remove silence at the beginning and end of the audio returned by Google ("trim", "0.25", "-0.1")
+    TRIM_START_DURATION = 0.1
+    TRIM_END_DURATION = 0.07
+    TRIM_EFFECTS = ("trim", str(TRIM_START_DURATION), "reverse", "trim", str(TRIM_END_DURATION), "reverse")
+    PCM_SAMPLE_RATE = 24000
+    PCM_FORMAT = ("-t", "raw", "-e", "signed-integer", "-b", "16", "-r", str(PCM_SAMPLE_RATE), "-c", "1")
+
+    DOWNLOAD_RETRY_COUNT = 2
+    DOWNLOAD_RETRY_BACKOFF = 0.5
+    DOWNLOAD_HEDGE_DELAY = None
+    DOWNLOAD_CHUNK_SIZE = 4096
+    CACHE_BACKEND = "sqlite"
+    CACHE_MAX_SIZE = None
+    CACHE_MAX_ENTRIES = None
+    CACHE_MAINTENANCE_INTERVAL = 24 * 60 * 60
+    LEGACY_MIGRATION_METADATA_KEY = "legacy_keys_migrated"
 
-    session = requests.Session()
+    cache = None
+    cache_maintained = False
+    legacy_cache_migrated = None  # read from cache metadata on first cache miss
+    in_flight = SingleFlight()
+    memory_cache = None
+    processed_cache = None
+    processed_cache_enabled = False
+    processed_cache_maintained = False
+    rate_limiter = None
+    hedge_executor = None
+    download_counters: Counter[str] = collections.Counter()
+    download_counters_lock = threading.Lock()
+    session = None
+    init_lock = threading.Lock()
 
-    def __init__(self, text, lang, segment_num, segment_count=None):
+    def __init__(self, text, lang, segment_num, segment_count=None, text_offset=0, source_span=None):
         self.text = text
         self.lang = lang
         self.segment_num = segment_num
         self.segment_count = segment_count
-        self.preload_mutex = threading.Lock()
-        if not hasattr(__class__, "cache"):
-            db_filepath = os.path.join(
-                appdirs.user_cache_dir(appname="google_speech", appauthor=False), "google_speech-cache.sqlite"
-            )
-            os.makedirs(os.path.dirname(db_filepath), exist_ok=True)
-            cache_name = "sound_data"
-            __class__.cache = web_cache.ThreadedWebCache(
-                db_filepath,
-                cache_name,
-                expiration=60 * 60 * 24 * 365,  # 1 year
-                caching_strategy=web_cache.CachingStrategy.LRU,
-            )
-            logging.getLogger().debug(
-                "Total size of file '%s': %s" % (db_filepath, __class__.cache.getDatabaseFileSize())
-            )
-            purged_count = __class__.cache.purge()
-            logging.getLogger().debug(
-                "%u obsolete entries have been removed from cache '%s'" % (purged_count, cache_name)
+        self.text_offset = text_offset  # in clean speech text
+        # (start, end) offsets in source speech text, before spaces are cleaned
+        if source_span is None:
+            source_span = (text_offset, text_offset + len(text))
+        self.source_span = source_span
+        self.preload_scheduled = False
+        self.preloaded_time = None
+
+    @staticmethod
+    def getCache():
+        """Get the audio data cache, opening it on first call."""
+        if __class__.cache is None:
+            with __class__.init_lock:
+                if __class__.cache is None:
+                    __class__.cache = __class__.openCache()
+                    __class__.legacy_cache_migrated = None
+        return __class__.cache
+
+    @staticmethod
+    def openCache(name="google_speech-cache"):
+        """Open a cache with the backend selected by CACHE_BACKEND."""
+        import appdirs
+
+        from google_speech import cache_backends
+
+        cache_dirpath = appdirs.user_cache_dir(appname="google_speech", appauthor=False)
+        os.makedirs(cache_dirpath, exist_ok=True)
+        if __class__.CACHE_BACKEND == "pack":
+            return cache_backends.PackFileCacheBackend(os.path.join(cache_dirpath, "%s.pack" % (name)))
+        return cache_backends.WebCacheBackend(os.path.join(cache_dirpath, "%s.sqlite" % (name)))
+
+    @staticmethod
+    def getProcessedCache():
+        """Get the processed audio cache, opening it on first call."""
+        if __class__.processed_cache is None:
+            with __class__.init_lock:
+                if __class__.processed_cache is None:
+                    __class__.processed_cache = __class__.openCache("google_speech-processed-cache")
+        return __class__.processed_cache
+
+    @staticmethod
+    def enableProcessedCache(enabled=True):
+        """
+        Enable a cache tier of audio data decoded to PCM, trimmed and processed by effects, for the segment player.
+
+        Repeated plays of a segment with the same effects then skip decoding and effects processing.
+        """
+        __class__.processed_cache_enabled = enabled
+
+    @staticmethod
+    def setCache(cache):
+        """Use a cache backend instance instead of the default one."""
+        with __class__.init_lock:
+            __class__.cache = cache
+            __class__.cache_maintained = False
+            __class__.legacy_cache_migrated = None
+
+    @staticmethod
+    def maintainCache(processed=False):
+        """
+        Start maintenance of the cache (or processed cache) in a background thread, only once per process.
+
+        Called only when the cache is written to. See cache_tools.maintainCache, and the CACHE_MAX_SIZE,
+        CACHE_MAX_ENTRIES and CACHE_MAINTENANCE_INTERVAL settings. Storage space is not reclaimed, which would lock the
+        cache for a long time. The process does not wait for the thread at exit: interrupted maintenance is retried by
+        a later process, once its lease has expired. Return the thread, or None if maintenance was already started.
+        """
+        flag_name = "processed_cache_maintained" if processed else "cache_maintained"
+        with __class__.init_lock:
+            if getattr(__class__, flag_name):
+                return None
+            setattr(__class__, flag_name, True)
+        thread = threading.Thread(
+            target=__class__.runCacheMaintenance,
+            args=(__class__.getProcessedCache() if processed else __class__.getCache(), not processed),
+            name="CacheMaintenanceThread",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    @staticmethod
+    def runCacheMaintenance(cache, migrate_legacy_entries=False, interval=None, compact=False):
+        """
+        Maintain a cache with current settings, logging errors instead of raising them.
+
+        If migrate_legacy_entries is True, legacy entries are first migrated, if they were not already (see
+        migrateCacheOnce). interval defaults to CACHE_MAINTENANCE_INTERVAL. Return the number of removed entries, or
+        None if maintenance was skipped or failed.
+        """
+        from google_speech import cache_tools
+
+        try:
+            if migrate_legacy_entries:
+                __class__.migrateCacheOnce()
+            return cache_tools.maintainCache(
+                cache,
+                max_size=__class__.CACHE_MAX_SIZE,
+                max_count=__class__.CACHE_MAX_ENTRIES,
+                interval=__class__.CACHE_MAINTENANCE_INTERVAL if interval is None else interval,
+                compact=compact,
             )
-            row_count = len(__class__.cache)
-            logging.getLogger().debug("Cache '%s' contains %u entries" % (cache_name, row_count))
+        except Exception as e:
+            logging.getLogger().warning("Cache maintenance failed: %s: %s" % (e.__class__.__qualname__, e))
+        return None
+
+    @staticmethod
+    def enableMemoryCache(max_size):
+        """Enable an in memory cache of max_size bytes, in front of the persistent cache, or disable it if 0."""
+        __class__.memory_cache = MemoryCache(max_size) if max_size > 0 else None
+
+    @staticmethod
+    def getSession():
+        """Get the HTTP session, creating it on first call."""
+        if __class__.session is None:
+            with __class__.init_lock:
+                if __class__.session is None:
+                    import requests
+
+                    __class__.session = requests.Session()
+        return __class__.session
 
     def __str__(self):
         return self.text
 
     def isInCache(self):
         """Return True if audio data for this segment is present in cache, False otherwise."""
-        url = self.buildUrl(cache_friendly=True)
-        return url in __class__.cache
+        cache_key = self.getCacheKey()
+        memory_cache = __class__.memory_cache
+        if (memory_cache is not None) and (cache_key in memory_cache):
+            return True
+        return (cache_key in __class__.getCache()) or self.migrateLegacyCacheEntry()
 
     def preLoad(self):
         """Store audio data in cache for fast playback."""
         logging.getLogger().debug("Preloading segment '%s'" % (self))
-        real_url = self.buildUrl()
-        cache_url = self.buildUrl(cache_friendly=True)
-        audio_data = self.download(real_url)
-        assert audio_data
-        __class__.cache[cache_url] = audio_data
+        __class__.in_flight.call(self.getCacheKey(), self.loadAudioData)
 
     def getAudioData(self):
         """Fetch the audio data."""
-        with self.preload_mutex:
-            cache_url = self.buildUrl(cache_friendly=True)
-            if cache_url in __class__.cache:
-                logging.getLogger().debug("Got data for URL '%s' from cache" % (cache_url))
-                audio_data = __class__.cache[cache_url]
-                assert audio_data
+        start_time = time.monotonic()
+        audio_data = self.getCachedAudioData()
+        if audio_data is None:
+            # concurrent fetches of the same audio data share a single download
+            audio_data = __class__.in_flight.call(self.getCacheKey(), self.loadAudioData)
+        if self.preload_scheduled and instrumentation.hooks:
+            # positive if the preloader was ahead of consumption, negative if the consumer had to wait
+            if self.preloaded_time is not None:
+                lead = start_time - self.preloaded_time
             else:
-                real_url = self.buildUrl()
-                audio_data = self.download(real_url)
-                assert audio_data
-                __class__.cache[cache_url] = audio_data
+                lead = start_time - time.monotonic()
+            instrumentation.emit("preload_lead", lead=lead, stall=lead < 0)
         return audio_data
 
-    def play(self, sox_effects=()):
-        """Play the segment."""
-        audio_data = self.getAudioData()
+    def loadAudioData(self):
+        """Get audio data from cache, or download it and store it in cache."""
+        # check cache again, data may have been stored since the caller checked it
+        audio_data = self.getCachedAudioData()
+        if audio_data is None:
+            real_url = self.buildUrl()
+            audio_data = self.download(real_url)
+            assert audio_data
+            self.storeAudioData(audio_data)
+        return audio_data
+
+    def storeAudioData(self, audio_data):
+        """
+        Store audio data in cache.
+
+        If the cache database is locked for too long, for example by maintenance in another thread or process, audio
+        data is not stored in the persistent cache.
+        """
+        cache_key = self.getCacheKey()
+        memory_cache = __class__.memory_cache
+        if memory_cache is not None:
+            memory_cache[cache_key] = audio_data
+        __class__.maintainCache()
+        try:
+            __class__.getCache()[cache_key] = audio_data
+        except sqlite3.OperationalError as e:
+            logging.getLogger().warning("Failed to store audio data in cache: %s" % (e))
+
+    def getCachedAudioData(self):
+        """Get the audio data from cache, or None if it is not in cache."""
+        cache_key = self.getCacheKey()
+        memory_cache = __class__.memory_cache
+        if memory_cache is not None:
+            with instrumentation.timed("cache_lookup", tier="memory") as event_data:
+                audio_data = memory_cache.get(cache_key)
+                event_data["hit"] = audio_data is not None
+            if audio_data is not None:
+                return audio_data
+        cache = __class__.getCache()
+        with instrumentation.timed("cache_lookup", tier="persistent") as event_data:
+            try:
+                audio_data = cache[cache_key]
+            except KeyError:
+                audio_data = cache[cache_key] if self.migrateLegacyCacheEntry() else None
+            event_data["hit"] = audio_data is not None
+        if audio_data is None:
+            return None
+        logging.getLogger().debug("Got data for key '%s' from cache" % (cache_key))
+        assert audio_data
+        if memory_cache is not None:
+            memory_cache[cache_key] = audio_data
+        return audio_data
+
+    @staticmethod
+    def getCachedKeys(cache_keys):
+        """
+        Get the set of keys, among cache_keys, of audio data present in cache, with a single persistent cache lookup.
+
+        Unlike isInCache, legacy cache entries are not looked up.
+        """
+        cache_keys = set(cache_keys)
+        memory_cache = __class__.memory_cache
+        if memory_cache is not None:
+            cached_keys = set(filter(memory_cache.__contains__, cache_keys))
+        else:
+            cached_keys = set()
+        cached_keys.update(__class__.getCache().filterKeys(cache_keys - cached_keys))
+        return cached_keys
+
+    def getCacheKey(self):
+        """
+        Get the key used to store audio data for this segment in cache.
+
+        Unlike the URL, the key only depends on language and normalized text, so the same phrase is found in cache
+        whatever its position in the speech.
+        """
+        return __class__.buildCacheKey(self.text, self.lang)
+
+    @staticmethod
+    def buildCacheKey(text, lang):
+        """Build cache key for a text and language."""
+        params = collections.OrderedDict()
+        params["tl"] = lang.lower()
+        params["q"] = __class__.normalizeText(text)
+        return "%s?%s" % (__class__.BASE_URL, urllib.parse.urlencode(params))
+
+    @staticmethod
+    def normalizeText(text):
+        """Normalize text so that strings that read the same compare equal (NFC, spaces and case folded)."""
+        text = unicodedata.normalize("NFC", text)
+        text = __class__.CLEAN_SPACES_REGEX.sub(" ", text).strip()
+        return text.casefold()
+
+    def migrateLegacyCacheEntry(self):
+        """
+        Move audio data stored under the legacy URL cache key to the new cache key.
+
+        Legacy entries are only looked up if the whole cache was not migrated yet (see migrateCacheOnce), and if the
+        segment count is known, because it is part of legacy keys. Return True if an entry was migrated, False
+        otherwise.
+        """
+        if (self.segment_count is None) or __class__.isLegacyCacheMigrated():
+            return False
+        legacy_url = self.buildUrl(cache_friendly=True)
+        cache = __class__.getCache()
+        try:
+            audio_data = cache[legacy_url]
+        except KeyError:
+            return False
+        logging.getLogger().debug("Migrating cache entry for URL '%s'" % (legacy_url))
+        cache[self.getCacheKey()] = audio_data
+        del cache[legacy_url]
+        return True
+
+    @staticmethod
+    def migrateCache():
+        """
+        Move all cache entries stored with legacy URL keys to the new position independent keys.
+
+        Return the number of migrated entries, or None if cache keys can not be listed.
+        """
+        cache = __class__.getCache()
+        try:
+            cache_keys = cache.keys()
+        except RuntimeError:
+            # in memory cache
+            return None
+        migrated_count = 0
+        for legacy_url in filter(lambda key: "client=tw-ob" in key, cache_keys):
+            params = urllib.parse.parse_qs(urllib.parse.urlsplit(legacy_url).query)
+            try:
+                cache_key = __class__.buildCacheKey(params["q"][0], params["tl"][0])
+                audio_data = cache[legacy_url]
+            except (KeyError, IndexError):
+                continue
+            if cache_key not in cache:
+                cache[cache_key] = audio_data
+            try:
+                del cache[legacy_url]
+            except KeyError:
+                # migrated by another process meanwhile
+                continue
+            migrated_count += 1
+        logging.getLogger().debug("%u legacy entries have been migrated in cache" % (migrated_count))
+        return migrated_count
+
+    @staticmethod
+    def migrateCacheOnce():
+        """
+        Migrate all legacy cache entries (see migrateCache) if not already done, and record it in cache metadata.
+
+        Once it is recorded, cache misses don't look up legacy entries anymore. Return the number of migrated entries,
+        or None if nothing was done.
+        """
+        if __class__.isLegacyCacheMigrated():
+            return None
+        migrated_count = __class__.migrateCache()
+        if migrated_count is not None:
+            __class__.getCache().setMetadata(__class__.LEGACY_MIGRATION_METADATA_KEY, True)
+            __class__.legacy_cache_migrated = True
+        return migrated_count
+
+    @staticmethod
+    def isLegacyCacheMigrated():
+        """Return True if legacy cache entries were all migrated, False otherwise, reading cache metadata only once."""
+        if __class__.legacy_cache_migrated is None:
+            __class__.legacy_cache_migrated = __class__.getCache().getMetadata(
+                __class__.LEGACY_MIGRATION_METADATA_KEY, False
+            )
+        return __class__.legacy_cache_migrated
+
+    def play(self, sox_effects=(), stream_download=False):
+        """
+        Play the segment.
+
+        If stream_download is True, and audio data needs to be downloaded, the player is started before the download,
+        and fed with audio data as it is received. Audio data is then trimmed at MP3 frame level, instead of with SoX
+        effects, because SoX needs the whole audio data to trim its end. If the processed cache is enabled, processed
+        audio data is played from it instead, and stream_download is ignored.
+        """
+        if __class__.processed_cache_enabled:
+            stream_download = False
+            audio_chunks = iter((self.getProcessedPcmData(sox_effects),))
+            cmd = ["sox", "-q"]
+            cmd.extend(__class__.PCM_FORMAT)
+            cmd.append("-")
+            sox_effects = ()
+        else:
+            if stream_download:
+                audio_chunks = mp3.iterTrimmedChunks(
+                    self.iterAudioDataChunks(), __class__.TRIM_START_DURATION, __class__.TRIM_END_DURATION
+                )
+                sox_effects = tuple(sox_effects)
+            else:
+                audio_chunks = iter((self.getAudioData(),))
+                sox_effects = __class__.TRIM_EFFECTS + tuple(sox_effects)
+            cmd = ["sox", "-q", "-t", "mp3", "-"]
         logging.getLogger().info("Playing speech segment (%s): '%s'" % (self.lang, self))
-        cmd = ["sox", "-q", "-t", "mp3", "-"]
         if sys.platform.startswith("win32"):
             cmd.extend(("-t", "waveaudio"))
-        cmd.extend(("-d", "trim", "0.1", "reverse", "trim", "0.07", "reverse"))  # "trim", "0.25", "-0.1"
+        cmd.append("-d")
         cmd.extend(sox_effects)
         logging.getLogger().debug("Start player process")
-        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
-        p.communicate(input=audio_data)
+        with instrumentation.timed("play", player="segment", streamed=stream_download) as event_data:
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            byte_count = 0
+            try:
+                for audio_chunk in audio_chunks:
+                    p.stdin.write(audio_chunk)
+                    p.stdin.flush()
+                    byte_count += len(audio_chunk)
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+            except BaseException:
+                # download failed, don't play truncated audio data
+                p.kill()
+                p.wait()
+                raise
+            p.wait()
+            event_data["bytes"] = byte_count
         if p.returncode != 0:
             raise RuntimeError()
         logging.getLogger().debug("Done playing")
 
+    def getProcessedPcmData(self, sox_effects=()):
+        """
+        Get audio data trimmed, processed by sox_effects, and decoded to raw PCM (see PCM_FORMAT).
+
+        Processed data is taken from the processed cache, or stored in it, with a key made of the segment cache key
+        and the effects.
+        """
+        cache = __class__.getProcessedCache()
+        cache_key = json.dumps((self.getCacheKey(), tuple(sox_effects)))
+        with instrumentation.timed("cache_lookup", tier="processed") as event_data:
+            try:
+                pcm_data = cache[cache_key]
+            except KeyError:
+                pcm_data = None
+            event_data["hit"] = pcm_data is not None
+        if pcm_data is not None:
+            return pcm_data
+        audio_data = self.getAudioData()
+        cmd = ["sox", "-q", "-t", "mp3", "-"]
+        cmd.extend(__class__.PCM_FORMAT)
+        cmd.append("-")
+        cmd.extend(__class__.TRIM_EFFECTS)
+        cmd.extend(sox_effects)
+        with instrumentation.timed("decode", bytes=len(audio_data)):
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            pcm_data = p.communicate(input=audio_data)[0]
+        if p.returncode != 0:
+            raise RuntimeError()
+        __class__.maintainCache(processed=True)
+        cache[cache_key] = pcm_data
+        return pcm_data
+
+    def iterAudioDataChunks(self):
+        """
+        Get audio data as an iterator of chunks, streaming the download if audio data is not cached.
+
+        Audio data is stored in cache only when the download completes successfully. Concurrent fetches of the same
+        audio data wait for the streamed download to complete.
+        """
+        audio_data = self.getCachedAudioData()
+        if audio_data is not None:
+            yield audio_data
+            return
+        cache_key = self.getCacheKey()
+        future, leader = __class__.in_flight.register(cache_key)
+        if not leader:
+            yield future.result()
+            return
+        try:
+            # check cache again, data may have been stored since we checked it
+            audio_data = self.getCachedAudioData()
+            if audio_data is None:
+                audio_chunks = []
+                for audio_chunk in self.downloadStreamed(self.buildUrl()):
+                    audio_chunks.append(audio_chunk)
+                    yield audio_chunk
+                audio_data = b"".join(audio_chunks)
+                assert audio_data
+                self.storeAudioData(audio_data)
+            else:
+                yield audio_data
+        except GeneratorExit:
+            # consumer stopped iterating, audio data is incomplete
+            __class__.in_flight.complete(
+                cache_key, future, exception=RuntimeError("Streamed download of '%s' was interrupted" % (self))
+            )
+            raise
+        except BaseException as e:
+            __class__.in_flight.complete(cache_key, future, exception=e)
+            raise
+        __class__.in_flight.complete(cache_key, future, audio_data)
+
+    def getTrimmedAudioData(self):
+        """Get audio data, without the leading and trailing silence frames (see mp3.trim)."""
+        return mp3.trim(self.getAudioData(), __class__.TRIM_START_DURATION, __class__.TRIM_END_DURATION)
+
     def buildUrl(self, cache_friendly=False):
         """
         Construct the URL to get the sound from Goggle API.
 
-        If cache_friendly is True, remove token from URL to use as a cache key.
+        If cache_friendly is True, remove token from URL to use as a legacy cache key (see getCacheKey).
         """
         params = collections.OrderedDict()
         params["client"] = "tw-ob"
@@ -350,12 +1596,252 @@ class SpeechSegment:
         return "%s?%s" % (__class__.BASE_URL, urllib.parse.urlencode(params))
 
     def download(self, url):
-        """Download a sound file."""
+        """Download a sound file, retrying with jittered exponential backoff on transient errors."""
+        import requests
+
+        for attempt in itertools.count():
+            try:
+                return self.downloadHedged(url)
+            except requests.RequestException as e:
+                if not __class__.waitBeforeRetry(url, attempt, e):
+                    raise
+
+    def downloadStreamed(self, url):
+        """
+        Download a sound file, and yield chunks of data as they are received.
+
+        Like download, retry on transient errors, but only if no data was yielded yet. Requests are not hedged.
+        """
+        import requests
+
+        for attempt in itertools.count():
+            received = False
+            try:
+                for chunk in self.downloadStreamedOnce(url):
+                    received = True
+                    yield chunk
+                return
+            except requests.RequestException as e:
+                if received or (not __class__.waitBeforeRetry(url, attempt, e)):
+                    raise
+
+    @staticmethod
+    def waitBeforeRetry(url, attempt, error):
+        """
+        Sleep with jittered exponential backoff before retrying a failed download.
+
+        Return False without sleeping if the download must not be retried.
+        """
+        delay = __class__.getRetryDelay(url, attempt, error, __class__.isRetryableError(error))
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
+
+    @staticmethod
+    def getRetryDelay(url, attempt, error, retryable):
+        """Get the jittered exponential backoff delay before retrying a failed download, or None to not retry it."""
+        if (attempt >= __class__.DOWNLOAD_RETRY_COUNT) or (not retryable):
+            return None
+        delay = random.uniform(0, __class__.DOWNLOAD_RETRY_BACKOFF * 2**attempt)
+        logging.getLogger().debug(
+            "Download of '%s' failed (%s: %s), retrying in %.2fs" % (url, error.__class__.__qualname__, error, delay)
+        )
+        __class__.incrementDownloadCounter("retries")
+        return delay
+
+    def downloadHedged(self, url):
+        """
+        Download a sound file.
+
+        If a response is not received after DOWNLOAD_HEDGE_DELAY seconds, send a duplicate request, and use whichever
+        response arrives first.
+        """
+        import requests
+
+        if __class__.DOWNLOAD_HEDGE_DELAY is None:
+            return self.downloadOnce(url)
+        executor = __class__.getHedgeExecutor()
+        futures = [executor.submit(self.downloadOnce, url)]
+        done, _ = concurrent.futures.wait(futures, timeout=__class__.DOWNLOAD_HEDGE_DELAY)
+        if not done:
+            logging.getLogger().debug(
+                "No response for '%s' after %.2fs, sending hedged request" % (url, __class__.DOWNLOAD_HEDGE_DELAY)
+            )
+            __class__.incrementDownloadCounter("hedges")
+            futures.append(executor.submit(self.downloadOnce, url))
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                audio_data = future.result()
+            except requests.RequestException as e:
+                error = e
+            else:
+                if future is not futures[0]:
+                    __class__.incrementDownloadCounter("hedge_wins")
+                return audio_data
+        assert error is not None
+        raise error
+
+    def downloadOnce(self, url):
+        """Download a sound file with a single request."""
+        __class__.throttleDownload()
         logging.getLogger().debug("Downloading '%s'..." % (url))
-        response = __class__.session.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=3.1)
-        response.raise_for_status()
+        __class__.incrementDownloadCounter("requests")
+        with instrumentation.timed("download", error=True) as event_data:
+            response = __class__.getSession().get(url, headers=__class__.HTTP_HEADERS, timeout=__class__.HTTP_TIMEOUT)
+            response.raise_for_status()
+            event_data.update(error=False, bytes=len(response.content))
         return response.content
 
+    def downloadStreamedOnce(self, url):
+        """Download a sound file with a single request, and yield chunks of data as they are received."""
+        __class__.throttleDownload()
+        logging.getLogger().debug("Downloading '%s' (streamed)..." % (url))
+        __class__.incrementDownloadCounter("requests")
+        with instrumentation.timed("download", error=True, streamed=True) as event_data:
+            with __class__.getSession().get(
+                url, headers=__class__.HTTP_HEADERS, timeout=__class__.HTTP_TIMEOUT, stream=True
+            ) as response:
+                response.raise_for_status()
+                byte_count = 0
+                for chunk in response.iter_content(__class__.DOWNLOAD_CHUNK_SIZE):
+                    byte_count += len(chunk)
+                    yield chunk
+            event_data.update(error=False, bytes=byte_count)
+
+    @staticmethod
+    def throttleDownload():
+        """Wait until the rate limit allows a download request."""
+        throttle_delay = __class__.reserveDownload()
+        if throttle_delay > 0:
+            time.sleep(throttle_delay)
+
+    @staticmethod
+    def reserveDownload():
+        """Reserve a download request in the rate limit, and return the time to wait before sending it in seconds."""
+        rate_limiter = __class__.rate_limiter
+        if rate_limiter is None:
+            return 0
+        throttle_delay = rate_limiter.reserve()
+        if throttle_delay > 0:
+            __class__.incrementDownloadCounter("throttled")
+            __class__.incrementDownloadCounter("throttle_delay", throttle_delay)
+        return throttle_delay
+
+    @staticmethod
+    def isRetryableError(error):
+        """Return True if a failed download can be retried, False otherwise."""
+        import requests
+
+        if isinstance(error, requests.HTTPError):
+            return (error.response is not None) and (
+                (error.response.status_code == 429) or (error.response.status_code >= 500)
+            )
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    @staticmethod
+    def getHedgeExecutor():
+        """Get the thread pool used to send hedged requests, creating it on first call."""
+        if __class__.hedge_executor is None:
+            with __class__.init_lock:
+                if __class__.hedge_executor is None:
+                    __class__.hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                        thread_name_prefix="HedgedDownloadThread"
+                    )
+        return __class__.hedge_executor
+
+    @staticmethod
+    def setRateLimit(rate, burst=1):
+        """Limit downloads to rate requests per second, for all threads, or remove limit if rate is None."""
+        __class__.rate_limiter = RateLimiter(rate, burst) if rate is not None else None
+
+    @staticmethod
+    def incrementDownloadCounter(name, value=1):
+        """Increment a download counter."""
+        with __class__.download_counters_lock:
+            __class__.download_counters[name] += value
+
+    @staticmethod
+    def getDownloadStats():
+        """Return a dictionary of download counters (requests, retries, hedges, throttling delay...)."""
+        with __class__.download_counters_lock:
+            return dict(__class__.download_counters)
+
+
+def __getattr__(name):
+    """Import heavy dependencies on first access only, to speed up startup (see PEP 562)."""
+    if name in ("appdirs", "requests", "web_cache"):
+        return importlib.import_module(name)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+
+def printStats(stats_collector):
+    """Write performance measurements summary to stderr."""
+    summary = stats_collector.getSummary()
+    summary["download_counters"] = SpeechSegment.getDownloadStats()
+    if SpeechSegment.memory_cache is not None:
+        summary["memory_cache"] = SpeechSegment.memory_cache.getStats()
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+
+
+def positiveFloat(s):
+    """Parse a command line number argument that must be strictly positive."""
+    value = float(s)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("invalid value %s, must be positive" % (value))
+    return value
+
+
+def positiveInt(s):
+    """Parse a command line integer argument that must be at least 1."""
+    value = int(s)
+    if value < 1:
+        raise argparse.ArgumentTypeError("invalid value %d, must be at least 1" % (value))
+    return value
+
+
+def nonNegativeInt(s):
+    """Parse a command line integer argument that must not be negative."""
+    value = int(s)
+    if value < 0:
+        raise argparse.ArgumentTypeError("invalid value %d, must not be negative" % (value))
+    return value
+
+
+@contextlib.contextmanager
+def openTextInput(path):
+    """Open a text file for reading, or use stdin if path is '-'."""
+    if path == "-":
+        yield sys.stdin
+    else:
+        with open(path, "rt") as f:
+            yield f
+
+
+def runCacheCommand(args):
+    """Run a cache command of the command line (--warm, --prefetch, etc.), and return the exit code."""
+    from google_speech import cache_tools
+
+    if args.warm is not None:
+        with openTextInput(args.warm) as f:
+            cache_tools.warmCache(f, args.lang, args.jobs, args.segmentation)
+    elif args.prefetch is not None:
+        with openTextInput(args.prefetch) as f:
+            plan = cache_tools.planPrefetch(cache_tools.readPrefetchItems(f, args.lang), args.segmentation)
+        progress = cache_tools.runPrefetch(plan, args.jobs)
+        return int(any(lang_progress["failed"] for lang_progress in progress.values()))
+    elif args.export_cache is not None:
+        cache_tools.exportCache(args.export_cache)
+    elif args.import_cache is not None:
+        cache_tools.importCache(args.import_cache)
+    elif args.maintain_cache is not None:
+        removed_count = SpeechSegment.runCacheMaintenance(
+            SpeechSegment.getCache(), migrate_legacy_entries=True, interval=0, compact=True
+        )
+        return int(removed_count is None)
+    return 0
+
 
 def cl_main():
     """Command line entry point for google_speech."""
@@ -364,7 +1850,10 @@ def cl_main():
         description="Google Speech v%s.%s" % (__version__, __doc__),
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    arg_parser.add_argument("speech", help="Text to play")
+    arg_parser.add_argument("speech", nargs="?", help="Text to play")
+    arg_parser.add_argument(
+        "-f", "--file", default=None, dest="file", help="Read text to play from this file, incrementally"
+    )
     arg_parser.add_argument("-l", "--lang", choices=SUPPORTED_LANGUAGES, default="en", dest="lang", help="Language")
     arg_parser.add_argument(
         "-e",
@@ -383,9 +1872,215 @@ def cl_main():
         help="Level of logging output",
     )
     arg_parser.add_argument(
-        "-o", "--output", default=None, dest="output", help="Outputs audio data to this file instead of playing it"
+        "-o",
+        "--output",
+        default=None,
+        dest="output",
+        help="Outputs audio data to this file instead of playing it, '-' for stdout",
+    )
+    arg_parser.add_argument(
+        "--index",
+        action="store_true",
+        default=False,
+        dest="index",
+        help="With -o, also write a JSON index of segment text, byte and time positions next to the output file",
+    )
+    arg_parser.add_argument(
+        "-p",
+        "--player",
+        choices=("segment", "stream"),
+        default="segment",
+        dest="player",
+        help="Playback mode: one SoX process per segment, or a single SoX process for gapless playback of the whole "
+        "speech (effects then apply to the whole speech)",
+    )
+    arg_parser.add_argument(
+        "--stream-download",
+        action="store_true",
+        default=False,
+        dest="stream_download",
+        help="With the segment player, start playing segments while they are downloaded, to reduce latency",
+    )
+    arg_parser.add_argument(
+        "--processed-cache",
+        action="store_true",
+        default=False,
+        dest="processed_cache",
+        help="With the segment player, cache decoded audio data with effects applied, to replay it without "
+        "processing (uses more disk space)",
+    )
+    arg_parser.add_argument(
+        "--segmentation",
+        choices=("greedy", "sentence"),
+        default="greedy",
+        dest="segmentation",
+        help="Text splitting: pack as much text as possible in each segment, or split at sentence boundaries and "
+        "prefer already cached segments, to reuse audio data of phrases common to several texts",
+    )
+    arg_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positiveInt,
+        default=PRELOADER_THREAD_COUNT,
+        dest="jobs",
+        help="Number of threads downloading segments ahead of playback",
+    )
+    arg_parser.add_argument(
+        "-b",
+        "--batch",
+        default=None,
+        dest="batch",
+        help="Render many speeches to MP3 files, reading jobs from this JSON lines file ('-' for stdin), each line "
+        "being an object with 'text', 'lang' (optional) and 'output' keys. Report for each job is written to stdout",
+    )
+    arg_parser.add_argument(
+        "--batch-workers",
+        type=positiveInt,
+        default=os.cpu_count(),
+        dest="batch_workers",
+        help="Number of workers rendering batch jobs",
+    )
+    arg_parser.add_argument(
+        "--batch-processes",
+        action="store_true",
+        default=False,
+        dest="batch_processes",
+        help="Render batch jobs in worker processes instead of threads",
+    )
+    arg_parser.add_argument(
+        "--retries",
+        type=nonNegativeInt,
+        default=SpeechSegment.DOWNLOAD_RETRY_COUNT,
+        dest="retries",
+        help="Number of retries of a failed download",
+    )
+    arg_parser.add_argument(
+        "--hedge-delay",
+        type=positiveFloat,
+        default=None,
+        dest="hedge_delay",
+        help="Send a duplicate request if a download did not complete after this delay in seconds",
+    )
+    arg_parser.add_argument(
+        "--rate-limit",
+        type=positiveFloat,
+        default=None,
+        dest="rate_limit",
+        help="Maximum number of download requests per second",
+    )
+    arg_parser.add_argument(
+        "--memory-cache",
+        type=int,
+        default=None,
+        dest="memory_cache",
+        help="Size in MB of an in memory cache of audio data, in front of the persistent cache (mostly useful with "
+        "--serve)",
+    )
+    arg_parser.add_argument(
+        "--cache-backend",
+        choices=("sqlite", "pack"),
+        default=SpeechSegment.CACHE_BACKEND,
+        dest="cache_backend",
+        help="Cache storage: SQLite database, or memory mapped append only pack file (faster reads, no expiration)",
+    )
+    arg_parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=None,
+        dest="cache_max_size",
+        help="Maximum cache size in MB, least recently used entries beyond are removed during cache maintenance",
+    )
+    arg_parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=None,
+        dest="cache_max_entries",
+        help="Maximum number of cache entries, least recently used entries beyond are removed during cache maintenance",
+    )
+    arg_parser.add_argument(
+        "--cache-maintenance-interval",
+        type=float,
+        default=SpeechSegment.CACHE_MAINTENANCE_INTERVAL / 3600,
+        dest="cache_maintenance_interval",
+        help="Minimum delay in hours between cache maintenances (removal of obsolete and excess entries)",
+    )
+    arg_parser.add_argument(
+        "--maintain-cache",
+        action="store_const",
+        const=True,
+        default=None,
+        dest="maintain_cache",
+        help="Maintain the cache now (removal of obsolete and excess entries), and reclaim unused storage space of the "
+        "cache files",
+    )
+    arg_parser.add_argument(
+        "--stats",
+        action="store_true",
+        default=False,
+        dest="stats",
+        help="Write a JSON summary of performance measurements to stderr when done",
+    )
+    arg_parser.add_argument(
+        "--warm",
+        default=None,
+        dest="warm",
+        help="Download and store in cache audio data for each line of this text file ('-' for stdin)",
+    )
+    arg_parser.add_argument(
+        "--prefetch",
+        default=None,
+        dest="prefetch",
+        help="Download and store in cache audio data for texts in several languages, from a JSON lines file ('-' for "
+        'stdin) with one {"text": "...", "lang": "en"} object per line, with progress for each language',
+    )
+    arg_parser.add_argument(
+        "--export-cache",
+        default=None,
+        dest="export_cache",
+        help="Export cache contents to this bundle file",
+    )
+    arg_parser.add_argument(
+        "--import-cache",
+        default=None,
+        dest="import_cache",
+        help="Import cache contents from a bundle file created with --export-cache",
+    )
+    arg_parser.add_argument(
+        "--serve",
+        nargs="?",
+        const=DEFAULT_SERVER_ADDRESS,
+        default=None,
+        dest="serve",
+        help="Run a daemon serving speech requests on this 'host:port' address or Unix socket path, sharing cache, "
+        "connections, and preloader threads between clients",
+    )
+    arg_parser.add_argument(
+        "--server",
+        nargs="?",
+        const=DEFAULT_SERVER_ADDRESS,
+        default=None,
+        dest="server",
+        help="Get speech audio data from a daemon started with --serve, listening on this address",
     )
     args = arg_parser.parse_args()
+    commands = (
+        args.speech,
+        args.file,
+        args.batch,
+        args.warm,
+        args.prefetch,
+        args.export_cache,
+        args.import_cache,
+        args.maintain_cache,
+        args.serve,
+    )
+    if sum(command is not None for command in commands) != 1:
+        arg_parser.error(
+            "Exactly one of a speech, --file, --batch, --warm, --prefetch, --export-cache, --import-cache, "
+            "--maintain-cache or --serve is required"
+        )
+    if (args.server is not None) and (args.speech is None) and (args.file is None):
+        arg_parser.error("--server requires a speech")
 
     # setup logger
     logging_level = {"warning": logging.WARNING, "normal": logging.INFO, "debug": logging.DEBUG}
@@ -405,12 +2100,65 @@ def cl_main():
         logging.getLogger().debug("Effects are not supported when saving to a file")
         exit(1)
 
+    SpeechSegment.CACHE_BACKEND = args.cache_backend
+    SpeechSegment.CACHE_MAX_SIZE = args.cache_max_size * 1024 * 1024 if args.cache_max_size is not None else None
+    SpeechSegment.CACHE_MAX_ENTRIES = args.cache_max_entries
+    SpeechSegment.CACHE_MAINTENANCE_INTERVAL = args.cache_maintenance_interval * 3600
+    if args.memory_cache is not None:
+        SpeechSegment.enableMemoryCache(args.memory_cache * 1024 * 1024)
+    SpeechSegment.enableProcessedCache(args.processed_cache)
+    SpeechSegment.DOWNLOAD_RETRY_COUNT = args.retries
+    SpeechSegment.DOWNLOAD_HEDGE_DELAY = args.hedge_delay
+    SpeechSegment.setRateLimit(args.rate_limit)
+    if args.stats:
+        stats_collector = instrumentation.StatsCollector()
+        instrumentation.addHook(stats_collector)
+        atexit.register(printStats, stats_collector)
+
     # do the job
-    speech = Speech(args.speech, args.lang)
-    if args.output:
-        speech.save(args.output)
-    else:
-        speech.play(args.sox_effects)
+    if args.server is not None:
+        # thin client, don't touch cache or network
+        from google_speech import server
+
+        if args.file is not None:
+            with open(args.file, "rt") as f:
+                text = f.read()
+        elif args.speech == "-":
+            text = sys.stdin.read()
+        else:
+            text = args.speech
+        server.runClient(args.server, text, args.lang, args.output, args.sox_effects, args.segmentation)
+        return
+    if args.serve is not None:
+        from google_speech import server
+
+        # memory cache tier is already enabled
+        server.serve(args.serve, args.jobs)
+        return
+    cache_commands = (args.warm, args.prefetch, args.export_cache, args.import_cache, args.maintain_cache)
+    if any(command is not None for command in cache_commands):
+        exit(runCacheCommand(args))
+    if args.batch is not None:
+        from google_speech import batch
+
+        with openTextInput(args.batch) as f:
+            jobs = list(batch.readJobs(f, args.lang))
+        results = batch.render(jobs, args.batch_workers, args.batch_processes, args.jobs)
+        for result in results:
+            print(json.dumps(result.asDict()))
+        exit(int(any(result.error is not None for result in results)))
+
+    with contextlib.ExitStack() as exit_stack:
+        if args.file is not None:
+            speech = Speech(exit_stack.enter_context(open(args.file, "rt")), args.lang, args.segmentation)
+        else:
+            speech = Speech(args.speech, args.lang, args.segmentation)
+        if args.output == "-":
+            speech.savef(sys.stdout.buffer, args.jobs)
+        elif args.output:
+            speech.save(args.output, args.jobs, args.index)
+        else:
+            speech.play(args.sox_effects, args.jobs, args.player, args.stream_download)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+""" Asyncio interface to read a text using Google Translate TTS API. """
+
+import asyncio
+import collections
+import contextlib
+import functools
+import itertools
+import logging
+
+try:
+    import aiohttp
+except ImportError:
+    # blocking downloads will be run in the default executor
+    aiohttp = None  # type: ignore
+
+from google_speech import Speech, SpeechSegment, instrumentation, mp3
+
+ASYNC_CONCURRENCY = 8
+
+
+class AsyncSpeechSegment(SpeechSegment):
+
+    """Text segment to be read, with audio data fetching that does not block the event loop."""
+
+    async def fetchAudioData(self, session=None):
+        """
+        Fetch the audio data.
+
+        If session is an aiohttp.ClientSession, it is used to download the data, otherwise the blocking download runs
+        in the default executor.
+        """
+        loop = asyncio.get_running_loop()
+        audio_data = await loop.run_in_executor(None, self.getCachedAudioData)
+        if audio_data is None:
+            # concurrent fetches of the same audio data, from coroutines or threads, share a single download
+            audio_data = await SpeechSegment.in_flight.callAsync(
+                self.getCacheKey(), functools.partial(self.loadAudioDataAsync, session)
+            )
+        return audio_data
+
+    async def loadAudioDataAsync(self, session):
+        """Get audio data from cache, or download it and store it in cache."""
+        loop = asyncio.get_running_loop()
+        audio_data = await loop.run_in_executor(None, self.getCachedAudioData)
+        if audio_data is None:
+            real_url = self.buildUrl()
+            if session is not None:
+                audio_data = await self.downloadAsync(real_url, session)
+            else:
+                audio_data = await loop.run_in_executor(None, self.download, real_url)
+            assert audio_data
+            await loop.run_in_executor(None, self.storeAudioData, audio_data)
+        return audio_data
+
+    async def downloadAsync(self, url, session):
+        """
+        Download a sound file with an aiohttp session, retrying with jittered exponential backoff on transient errors.
+
+        Like SpeechSegment.download, requests are rate limited by the shared rate limiter, but without blocking the
+        event loop.
+        """
+        for attempt in itertools.count():
+            try:
+                return await self.downloadOnceAsync(url, session)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = SpeechSegment.getRetryDelay(url, attempt, e, isRetryableError(e))
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def downloadOnceAsync(self, url, session):
+        """Download a sound file with a single request of an aiohttp session."""
+        throttle_delay = SpeechSegment.reserveDownload()
+        if throttle_delay > 0:
+            await asyncio.sleep(throttle_delay)
+        logging.getLogger().debug("Downloading '%s'..." % (url))
+        SpeechSegment.incrementDownloadCounter("requests")
+        with instrumentation.timed("download", error=True) as event_data:
+            async with session.get(
+                url,
+                headers=SpeechSegment.HTTP_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=SpeechSegment.HTTP_TIMEOUT),
+            ) as response:
+                response.raise_for_status()
+                audio_data = await response.read()
+            event_data.update(error=False, bytes=len(audio_data))
+        return audio_data
+
+
+def isRetryableError(error):
+    """Return True if a failed aiohttp download can be retried, False otherwise (see SpeechSegment.isRetryableError)."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return (error.status == 429) or (error.status >= 500)
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+class AsyncSpeech:
+
+    """
+    Text to be read, with an asyncio interface.
+
+    Iterating with 'async for' yields audio data of each segment in order, while up to concurrency segments are
+    fetched concurrently.
+    """
+
+    def __init__(self, text, lang, concurrency=ASYNC_CONCURRENCY, session=None):
+        self.speech = Speech(text, lang)
+        self.concurrency = concurrency
+        self.session = session
+
+    def __aiter__(self):
+        """Get an asynchronous iterator over segment audio data."""
+        return self.iterAudioData()
+
+    async def iterSegments(self):
+        """Get an asynchronous iterator over speech segments."""
+        loop = asyncio.get_running_loop()
+        segments = iter(self.speech)
+        while True:
+            if self.speech.text in ("-", None):
+                # reading stdin or a file blocks
+                segment = await loop.run_in_executor(None, next, segments, None)
+            else:
+                segment = next(segments, None)
+            if segment is None:
+                break
+            yield AsyncSpeechSegment(
+                segment.text,
+                segment.lang,
+                segment.segment_num,
+                segment.segment_count,
+                segment.text_offset,
+                segment.source_span,
+            )
+
+    async def iterAudioData(self):
+        """Get an asynchronous iterator over segment audio data, in order."""
+        async with contextlib.AsyncExitStack() as exit_stack:
+            session = self.session
+            if (session is None) and (aiohttp is not None):
+                session = await exit_stack.enter_async_context(aiohttp.ClientSession())
+            pending = collections.deque()
+            try:
+                async for segment in self.iterSegments():
+                    pending.append(asyncio.ensure_future(segment.fetchAudioData(session)))
+                    if len(pending) >= self.concurrency:
+                        yield await pending.popleft()
+                while pending:
+                    yield await pending.popleft()
+            finally:
+                for task in pending:
+                    task.cancel()
+
+    async def save(self, path):
+        """Save audio data to an MP3 file."""
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, open, path, "wb")
+        try:
+            await self.savef(f)
+        finally:
+            await loop.run_in_executor(None, f.close)
+
+    async def savef(self, file):
+        """Write audio data into a file object (see Speech.savef)."""
+        loop = asyncio.get_running_loop()
+        writer = mp3.Mp3Writer(file)
+        async for audio_data in self:
+            audio_data = mp3.trim(audio_data, SpeechSegment.TRIM_START_DURATION, SpeechSegment.TRIM_END_DURATION)
+            await loop.run_in_executor(None, writer.write, audio_data)
+        await loop.run_in_executor(None, writer.close)
@@ -0,0 +1,94 @@
+""" Render many speeches to MP3 files. """
+
+import collections
+import concurrent.futures
+import itertools
+import json
+import logging
+import multiprocessing
+
+from google_speech import PreloadScheduler, Speech, SpeechSegment
+
+BatchJob = collections.namedtuple("BatchJob", ("text", "lang", "output"))
+
+
+class BatchResult(collections.namedtuple("BatchResult", ("job", "error"))):
+
+    """Result of a batch job, error being None if it succeeded."""
+
+    def asDict(self):
+        """Get result as a dictionary suitable for JSON serialization."""
+        d = self.job._asdict()
+        del d["text"]
+        d["ok"] = self.error is None
+        if self.error is not None:
+            d["error"] = "%s: %s" % (self.error.__class__.__qualname__, self.error)
+        return d
+
+
+def readJobs(file, default_lang="en"):
+    """Parse jobs from a JSON lines file object."""
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        d = json.loads(line)
+        yield BatchJob(d["text"], d.get("lang", default_lang), d["output"])
+
+
+def preload(jobs, thread_count=None):
+    """
+    Download and store in cache audio data of all jobs segments.
+
+    Identical segments are downloaded only once, even if they are part of different jobs.
+    """
+    scheduler = PreloadScheduler(thread_count)
+    try:
+        segments = itertools.chain.from_iterable(Speech(job.text, job.lang) for job in jobs)
+        segment_count = scheduler.preloadAll(segments)
+        logging.getLogger().debug("%u unique segments in %u jobs" % (segment_count, len(jobs)))
+    finally:
+        scheduler.stop()
+
+
+def initWorkerProcess(cache_backend):
+    """Apply settings of the parent process in a worker process."""
+    SpeechSegment.CACHE_BACKEND = cache_backend
+
+
+def renderJob(job):
+    """Render a single job."""
+    Speech(job.text, job.lang).save(job.output, 1)
+
+
+def render(jobs, worker_count=None, use_processes=False, preload_thread_count=None):
+    """
+    Render jobs, and return a BatchResult for each, in order.
+
+    Segments are first downloaded to the shared cache, then jobs are rendered by a pool of worker_count threads, or
+    processes if use_processes is True.
+    """
+    jobs = list(jobs)
+    preload(jobs, preload_thread_count)
+    if use_processes:
+        # don't fork, child processes would inherit the cache helper thread state
+        executor = concurrent.futures.ProcessPoolExecutor(
+            worker_count,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initWorkerProcess,
+            initargs=(SpeechSegment.CACHE_BACKEND,),
+        )
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(worker_count)
+    results = []
+    with executor:
+        futures = [executor.submit(renderJob, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.getLogger().error("Job for '%s' failed: %s: %s" % (job.output, e.__class__.__qualname__, e))
+                results.append(BatchResult(job, e))
+            else:
+                results.append(BatchResult(job, None))
+    return results
@@ -0,0 +1,573 @@
+""" Persistent storage backends for the audio data cache. """
+
+import contextlib
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # no cross process locking (Windows), only a single process must write to a pack file cache
+    fcntl = None  # type: ignore
+
+
+class CacheBackend:
+
+    """
+    Interface of audio data cache backends.
+
+    A backend is a mapping of string cache keys to MP3 data (any bytes-like object), with a few maintenance methods.
+    """
+
+    def __contains__(self, key):
+        raise NotImplementedError()
+
+    def __getitem__(self, key):
+        """Get data for key, or raise KeyError if it is not in cache."""
+        raise NotImplementedError()
+
+    def __setitem__(self, key, data):
+        raise NotImplementedError()
+
+    def __delitem__(self, key):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def keys(self):
+        """Get list of all keys in cache."""
+        raise NotImplementedError()
+
+    def filterKeys(self, keys):
+        """Get the set of keys present in cache, among keys."""
+        return set(filter(self.__contains__, keys))
+
+    def purge(self):
+        """Remove obsolete entries, and return their count."""
+        return 0
+
+    def getUsage(self):
+        """Get (entry count, total data size in bytes) of cache."""
+        raise NotImplementedError()
+
+    def evict(self, max_size=None, max_count=None):
+        """Remove least recently used entries until cache fits in max_size bytes and max_count entries, return count."""
+        return 0
+
+    def compact(self):
+        """Reclaim storage space of removed entries, and return the number of bytes saved."""
+        return 0
+
+    def getMetadata(self, name, default=None):
+        """Get a metadata value (any JSON serializable value) stored with the cache."""
+        raise NotImplementedError()
+
+    def setMetadata(self, name, value):
+        """Store a metadata value with the cache."""
+        raise NotImplementedError()
+
+    def replaceMetadata(self, name, old_value, new_value):
+        """
+        Store a metadata value only if its current value is old_value (None if it is not set), atomically.
+
+        Return True if the value was stored, False otherwise.
+        """
+        raise NotImplementedError()
+
+
+class WebCacheBackend(CacheBackend):
+
+    """Cache backend storing data in a SQLite database, using web_cache."""
+
+    TABLE_NAME = "sound_data"
+    METADATA_TABLE_NAME = "google_speech_metadata"
+    EXPIRATION = 60 * 60 * 24 * 365  # 1 year
+    DB_TIMEOUT = 30
+    FILTER_KEYS_BATCH_SIZE = 500  # below the SQLite limit of query parameters
+
+    def __init__(self, db_filepath):
+        import web_cache
+
+        self.db_filepath = db_filepath
+        self.metadata = {}  # only used for in memory caches
+        self.metadata_lock = threading.Lock()
+        self.cache = web_cache.ThreadedWebCache(
+            db_filepath,
+            __class__.TABLE_NAME,
+            expiration=__class__.EXPIRATION,
+            caching_strategy=web_cache.CachingStrategy.LRU,
+        )
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            # these can be slow on large caches
+            logging.getLogger().debug("Total size of file '%s': %s" % (db_filepath, self.cache.getDatabaseFileSize()))
+            logging.getLogger().debug("Cache '%s' contains %u entries" % (__class__.TABLE_NAME, len(self.cache)))
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __getitem__(self, key):
+        """See CacheBackend.__getitem__."""
+        return self.cache[key]
+
+    def __setitem__(self, key, data):
+        self.cache[key] = data
+
+    def __delitem__(self, key):
+        del self.cache[key]
+
+    def __len__(self):
+        return len(self.cache)
+
+    def keys(self):
+        """See CacheBackend.keys."""
+        if __class__.isInMemory():
+            raise RuntimeError("Can not list keys of an in memory cache")
+        with self.connect() as connection:
+            return [row[0] for row in connection.execute("SELECT url FROM %s;" % (self.cache.getDbTableName()))]
+
+    def filterKeys(self, keys):
+        """See CacheBackend.filterKeys."""
+        if __class__.isInMemory():
+            return super().filterKeys(keys)
+        keys = list(keys)
+        found_keys = set()
+        if not keys:
+            return found_keys
+        batch_size = __class__.FILTER_KEYS_BATCH_SIZE
+        with self.connect() as connection:
+            for i in range(0, len(keys), batch_size):
+                batch_keys = keys[i : i + batch_size]
+                found_keys.update(
+                    row[0]
+                    for row in connection.execute(
+                        "SELECT url FROM %s WHERE url IN (%s);"
+                        % (self.cache.getDbTableName(), ", ".join("?" * len(batch_keys))),
+                        batch_keys,
+                    )
+                )
+        return found_keys
+
+    def purge(self):
+        """See CacheBackend.purge."""
+        return self.cache.purge()
+
+    def getUsage(self):
+        """See CacheBackend.getUsage."""
+        if __class__.isInMemory():
+            return len(self.cache), 0
+        with self.connect() as connection:
+            return tuple(
+                connection.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM %s;" % (self.cache.getDbTableName())
+                ).fetchone()
+            )
+
+    def evict(self, max_size=None, max_count=None):
+        """See CacheBackend.evict."""
+        if __class__.isInMemory() or ((max_size is None) and (max_count is None)):
+            return 0
+        conditions = []
+        params = []
+        if max_size is not None:
+            conditions.append("cumulative_size > ?")
+            params.append(max_size)
+        if max_count is not None:
+            conditions.append("rank > ?")
+            params.append(max_count)
+        table_name = self.cache.getDbTableName()
+        with self.connect() as connection, connection:
+            return connection.execute(
+                """DELETE FROM %s WHERE url IN (
+                     SELECT url FROM (
+                       SELECT url, SUM(LENGTH(data)) OVER w AS cumulative_size, ROW_NUMBER() OVER w AS rank FROM %s
+                       WINDOW w AS (ORDER BY last_accessed_timestamp DESC, added_timestamp DESC
+                                    ROWS UNBOUNDED PRECEDING)
+                     ) WHERE %s
+                   );"""
+                % (table_name, table_name, " OR ".join(conditions)),
+                params,
+            ).rowcount
+
+    def compact(self):
+        """See CacheBackend.compact."""
+        if __class__.isInMemory():
+            return 0
+        previous_size = os.path.getsize(self.db_filepath)
+        with self.connect() as connection:
+            connection.execute("VACUUM;")
+        return previous_size - os.path.getsize(self.db_filepath)
+
+    def getMetadata(self, name, default=None):
+        """See CacheBackend.getMetadata."""
+        if __class__.isInMemory():
+            return self.metadata.get(name, default)
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT value FROM %s WHERE name = ?;" % (__class__.METADATA_TABLE_NAME), (name,)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def setMetadata(self, name, value):
+        """See CacheBackend.setMetadata."""
+        if __class__.isInMemory():
+            self.metadata[name] = value
+            return
+        with self.connect() as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO %s (name, value) VALUES (?, ?);" % (__class__.METADATA_TABLE_NAME),
+                (name, json.dumps(value)),
+            )
+
+    def replaceMetadata(self, name, old_value, new_value):
+        """See CacheBackend.replaceMetadata."""
+        if __class__.isInMemory():
+            with self.metadata_lock:
+                if self.metadata.get(name) != old_value:
+                    return False
+                self.metadata[name] = new_value
+                return True
+        with self.connect() as connection:
+            # lock database for writing before reading, so no other process can change the value meanwhile
+            connection.execute("BEGIN IMMEDIATE;")
+            try:
+                row = connection.execute(
+                    "SELECT value FROM %s WHERE name = ?;" % (__class__.METADATA_TABLE_NAME), (name,)
+                ).fetchone()
+                if (json.loads(row[0]) if row is not None else None) != old_value:
+                    return False
+                connection.execute(
+                    "INSERT OR REPLACE INTO %s (name, value) VALUES (?, ?);" % (__class__.METADATA_TABLE_NAME),
+                    (name, json.dumps(new_value)),
+                )
+                connection.commit()
+                return True
+            finally:
+                if connection.in_transaction:
+                    connection.rollback()
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Open a direct connection to the database, for operations web_cache does not support."""
+        import sqlite3
+
+        connection = sqlite3.connect(self.db_filepath, timeout=__class__.DB_TIMEOUT)
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY KEY, value TEXT NOT NULL);"
+                % (__class__.METADATA_TABLE_NAME)
+            )
+            yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def isInMemory():
+        """Return True if web_cache stores data in memory instead of the database file, False otherwise."""
+        import web_cache
+
+        return web_cache.DISABLE_PERSISTENT_CACHING
+
+
+class PackFileCacheBackend(CacheBackend):
+
+    """
+    Cache backend storing data in an append only pack file, with a compact hash index file.
+
+    The pack file is memory mapped, and data is returned as memoryview slices of it, without copy. Several processes
+    can read the cache while another writes to it: readers load new index entries before each lookup. Deleting an
+    entry appends a tombstone record, and compact() rewrites the files without dead records. Pack and index files are
+    opened together under the file lock, and the pack file is mapped from the open file, so that offsets of the index
+    always refer to the pack file they were written for.
+
+    Pack file: header, then records of (key length, data length, key, data).
+    Index file: header, then entries of (64-bit key hash, record offset in pack file).
+    """
+
+    PACK_MAGIC = b"GSPACK01"
+    INDEX_MAGIC = b"GSINDX01"
+    RECORD_HEADER = struct.Struct("<II")
+    INDEX_ENTRY = struct.Struct("<QQ")
+    TOMBSTONE = 0xFFFFFFFF
+
+    def __init__(self, pack_filepath):
+        self.pack_filepath = pack_filepath
+        self.index_filepath = "%s.idx" % (pack_filepath)
+        self.lock_filepath = "%s.lock" % (pack_filepath)
+        self.metadata_filepath = "%s.meta" % (pack_filepath)
+        self.lock = threading.RLock()
+        self.lock_depth = 0
+        self.lock_file = open(self.lock_filepath, "ab")
+        with self.fileLock():
+            for filepath, magic in (
+                (self.pack_filepath, __class__.PACK_MAGIC),
+                (self.index_filepath, __class__.INDEX_MAGIC),
+            ):
+                if (not os.path.exists(filepath)) or (os.path.getsize(filepath) == 0):
+                    with open(filepath, "wb") as f:
+                        f.write(magic)
+            self.open()
+
+    def open(self):
+        """Open pack and index files, and load index."""
+        # files are replaced together by compaction, under the file lock
+        with self.fileLock():
+            self.pack_file = open(self.pack_filepath, "ab")
+            self.pack_read_file = open(self.pack_filepath, "rb")
+            self.index_file = open(self.index_filepath, "rb")
+        self.index_inode = os.fstat(self.index_file.fileno()).st_ino
+        if self.index_file.read(len(__class__.INDEX_MAGIC)) != __class__.INDEX_MAGIC:
+            raise ValueError("Invalid cache index file '%s'" % (self.index_filepath))
+        self.index = {}
+        self.mmap = None
+        self.mapReadOnly()
+        if self.mmap[: len(__class__.PACK_MAGIC)] != __class__.PACK_MAGIC:
+            raise ValueError("Invalid cache pack file '%s'" % (self.pack_filepath))
+        self.loadIndex()
+
+    def close(self):
+        """Close files."""
+        with self.lock:
+            self.closeFiles()
+            self.lock_file.close()
+
+    def closeFiles(self):
+        """Close pack and index files."""
+        self.pack_file.close()
+        self.pack_read_file.close()
+        self.index_file.close()
+        # can not close mmap while memoryviews of it exist, it is released with the last one
+        self.mmap = None
+
+    def mapReadOnly(self):
+        """Memory map the pack file, or map it again if it has grown."""
+        # not by path, the file may have been replaced since the index was opened
+        # previous mmap is released with the last memoryview of it
+        self.mmap = mmap.mmap(self.pack_read_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def loadIndex(self):
+        """Load index entries appended since last call."""
+        entry_size = __class__.INDEX_ENTRY.size
+        data = self.index_file.read()
+        # a writer may be appending an entry
+        incomplete_size = len(data) % entry_size
+        if incomplete_size:
+            self.index_file.seek(-incomplete_size, os.SEEK_CUR)
+            data = data[:-incomplete_size]
+        self.index.update(__class__.INDEX_ENTRY.iter_unpack(data))
+
+    def refresh(self):
+        """Load changes made by other processes."""
+        if os.stat(self.index_filepath).st_ino != self.index_inode:
+            # files were replaced by compaction
+            self.closeFiles()
+            self.open()
+        else:
+            self.loadIndex()
+
+    @contextlib.contextmanager
+    def fileLock(self):
+        """Context manager to get exclusive write access to files, across threads and processes."""
+        with self.lock:
+            # reentrant, the file lock is only released by the outermost call
+            if (self.lock_depth == 0) and (fcntl is not None):
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if (self.lock_depth == 0) and (fcntl is not None):
+                    fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def hashKey(key_bytes):
+        """Get 64-bit hash of a key."""
+        return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "little")
+
+    def readRecord(self, offset):
+        """Read record at offset in pack file, and return (key bytes, data memoryview or None if deleted)."""
+        header_end = offset + __class__.RECORD_HEADER.size
+        if header_end > len(self.mmap):
+            self.mapReadOnly()
+        key_len, data_len = __class__.RECORD_HEADER.unpack_from(self.mmap, offset)
+        key_end = header_end + key_len
+        if data_len == __class__.TOMBSTONE:
+            return self.mmap[header_end:key_end], None
+        data_end = key_end + data_len
+        if data_end > len(self.mmap):
+            self.mapReadOnly()
+        return self.mmap[header_end:key_end], memoryview(self.mmap)[key_end:data_end]
+
+    def lookup(self, key_bytes):
+        """Get data memoryview for key, or None if it is not in the loaded index."""
+        offset = self.index.get(__class__.hashKey(key_bytes))
+        if offset is None:
+            return None
+        record_key, data = self.readRecord(offset)
+        if record_key != key_bytes:
+            # hash collision
+            return None
+        return data
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        """See CacheBackend.__getitem__."""
+        key_bytes = key.encode()
+        with self.lock:
+            # cheap if nothing changed: a stat and an empty read
+            self.refresh()
+            data = self.lookup(key_bytes)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def append(self, key, data):
+        """Append a record to the pack file, data being None for a tombstone."""
+        key_bytes = key.encode()
+        with self.fileLock():
+            self.refresh()
+            offset = self.pack_file.seek(0, os.SEEK_END)
+            data_len = __class__.TOMBSTONE if data is None else len(data)
+            self.pack_file.write(__class__.RECORD_HEADER.pack(len(key_bytes), data_len))
+            self.pack_file.write(key_bytes)
+            if data is not None:
+                self.pack_file.write(data)
+            # data must be written before it is referenced by the index
+            self.pack_file.flush()
+            key_hash = __class__.hashKey(key_bytes)
+            with open(self.index_filepath, "ab") as index_file:
+                index_file.write(__class__.INDEX_ENTRY.pack(key_hash, offset))
+            self.index[key_hash] = offset
+
+    def __setitem__(self, key, data):
+        self.append(key, data)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.append(key, None)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iterLiveRecords(self):
+        """Yield (offset, key bytes, data memoryview) of entries, in pack file order."""
+        with self.lock:
+            self.refresh()
+            for offset in sorted(self.index.values()):
+                key_bytes, data = self.readRecord(offset)
+                if data is not None:
+                    yield offset, key_bytes, data
+
+    def keys(self):
+        """See CacheBackend.keys."""
+        return [key_bytes.decode() for _, key_bytes, _ in self.iterLiveRecords()]
+
+    def getUsage(self):
+        """See CacheBackend.getUsage."""
+        entry_count = data_size = 0
+        for _, _, data in self.iterLiveRecords():
+            entry_count += 1
+            data_size += len(data)
+        return entry_count, data_size
+
+    def evict(self, max_size=None, max_count=None):
+        """
+        See CacheBackend.evict.
+
+        Reads are not tracked, so the least recently written entries are removed, and the pack file is compacted.
+        """
+        if (max_size is None) and (max_count is None):
+            return 0
+        with self.fileLock():
+            records = list(self.iterLiveRecords())
+            kept_count = kept_size = 0
+            evicted_count = 0
+            for _, key_bytes, data in reversed(records):
+                kept_count += 1
+                kept_size += len(data)
+                if (
+                    (evicted_count > 0)
+                    or ((max_count is not None) and (kept_count > max_count))
+                    or ((max_size is not None) and (kept_size > max_size))
+                ):
+                    self.append(key_bytes.decode(), None)
+                    evicted_count += 1
+            if evicted_count > 0:
+                self.compact()
+        return evicted_count
+
+    def getMetadata(self, name, default=None):
+        """See CacheBackend.getMetadata."""
+        try:
+            with open(self.metadata_filepath, "rt") as f:
+                return json.load(f).get(name, default)
+        except FileNotFoundError:
+            return default
+
+    def setMetadata(self, name, value):
+        """See CacheBackend.setMetadata."""
+        with self.fileLock():
+            try:
+                with open(self.metadata_filepath, "rt") as f:
+                    metadata = json.load(f)
+            except FileNotFoundError:
+                metadata = {}
+            metadata[name] = value
+            tmp_filepath = "%s.tmp" % (self.metadata_filepath)
+            with open(tmp_filepath, "wt") as f:
+                json.dump(metadata, f)
+            os.replace(tmp_filepath, self.metadata_filepath)
+
+    def replaceMetadata(self, name, old_value, new_value):
+        """See CacheBackend.replaceMetadata."""
+        with self.fileLock():
+            if self.getMetadata(name) != old_value:
+                return False
+            self.setMetadata(name, new_value)
+            return True
+
+    def compact(self):
+        """
+        Rewrite pack and index files, without deleted or overwritten records.
+
+        Other processes can keep reading the cache, but must not write to it meanwhile. Return the number of bytes
+        saved.
+        """
+        with self.fileLock():
+            self.refresh()
+            previous_size = len(self.mmap)
+            tmp_pack_filepath = "%s.tmp" % (self.pack_filepath)
+            tmp_index_filepath = "%s.tmp" % (self.index_filepath)
+            with open(tmp_pack_filepath, "wb") as pack_file, open(tmp_index_filepath, "wb") as index_file:
+                pack_file.write(__class__.PACK_MAGIC)
+                index_file.write(__class__.INDEX_MAGIC)
+                # keep pack file order, which is the write order used by evict
+                for key_hash, offset in sorted(self.index.items(), key=lambda item: item[1]):
+                    key_bytes, data = self.readRecord(offset)
+                    if data is None:
+                        continue
+                    index_file.write(__class__.INDEX_ENTRY.pack(key_hash, pack_file.tell()))
+                    pack_file.write(__class__.RECORD_HEADER.pack(len(key_bytes), len(data)))
+                    pack_file.write(key_bytes)
+                    pack_file.write(data)
+                new_size = pack_file.tell()
+            # replace pack first, readers reload both files when they see the index was replaced
+            os.replace(tmp_pack_filepath, self.pack_filepath)
+            os.replace(tmp_index_filepath, self.index_filepath)
+            self.closeFiles()
+            self.open()
+        logging.getLogger().debug("Cache pack file compacted from %u to %u bytes" % (previous_size, new_size))
+        return previous_size - new_size
@@ -0,0 +1,262 @@
+""" Cache warm up and multi language prefetch, cache maintenance, and export/import of cache contents. """
+
+import collections
+import itertools
+import json
+import logging
+import threading
+import time
+import zipfile
+
+from google_speech import PreloadScheduler, Speech, SpeechSegment
+
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_MANIFEST_NAME = "manifest.json"
+MAINTENANCE_TIMESTAMP_KEY = "last_maintenance_timestamp"
+MAINTENANCE_LEASE_KEY = "maintenance_lease_timestamp"
+MAINTENANCE_LEASE_DURATION = 60 * 60  # after which a process is considered to have died during maintenance
+PREFETCH_PROGRESS_INTERVAL = 5
+
+
+def warmCache(texts, lang, thread_count=None, segmentation="greedy"):
+    """
+    Download and store in cache audio data of all segments of texts, if they are not already cached.
+
+    Return the number of unique segments.
+    """
+    scheduler = PreloadScheduler(thread_count)
+    try:
+        segments = itertools.chain.from_iterable(Speech(text, lang, segmentation) for text in texts)
+        segment_count = scheduler.preloadAll(segments)
+    finally:
+        scheduler.stop()
+    logging.getLogger().info("Cache warmed up with %u unique segments" % (segment_count))
+    return segment_count
+
+
+class PrefetchPlan:
+
+    """Unique segments to download, not already in cache, for texts in several languages."""
+
+    def __init__(self):
+        self.segments = collections.OrderedDict()  # lang -> segments to download
+        self.cached_counts = collections.Counter()  # lang -> count of unique segments already cached
+        self.duplicate_count = 0
+
+    def __len__(self):
+        return sum(map(len, self.segments.values()))
+
+    def iterScheduled(self):
+        """Get segments to download, alternating between languages, so they progress together."""
+        for segments in itertools.zip_longest(*self.segments.values()):
+            yield from filter(None, segments)
+
+
+def planPrefetch(items, segmentation="greedy"):
+    """
+    Split texts of (text, lang) pairs, and get a PrefetchPlan of their unique segments not already in cache.
+
+    Segments shared by several texts of the same language are only planned once.
+    """
+    plan = PrefetchPlan()
+    cache_keys = set()
+    for text, lang in items:
+        for segment in Speech(text, lang, segmentation):
+            cache_key = segment.getCacheKey()
+            if cache_key in cache_keys:
+                plan.duplicate_count += 1
+                continue
+            cache_keys.add(cache_key)
+            if segment.isInCache():
+                plan.cached_counts[lang] += 1
+            else:
+                plan.segments.setdefault(lang, []).append(segment)
+    logging.getLogger().info(
+        "Prefetch plan: %u segments to download, %u already cached, %u duplicates"
+        % (len(plan), sum(plan.cached_counts.values()), plan.duplicate_count)
+    )
+    return plan
+
+
+class PrefetchScheduler(PreloadScheduler):
+
+    """Preload scheduler tracking progress of a PrefetchPlan, for each language."""
+
+    def __init__(self, plan, thread_count=None, progress_callback=None):
+        self.lock = threading.Lock()
+        self.progress = collections.OrderedDict(
+            (lang, {"total": len(segments), "done": 0, "failed": 0, "eta": None})
+            for lang, segments in plan.segments.items()
+        )
+        self.progress_callback = progress_callback if progress_callback is not None else logPrefetchProgress
+        self.start_time = time.monotonic()
+        self.last_report_time = self.start_time
+        super().__init__(thread_count)
+
+    def onSegmentDone(self, segment, error):
+        """See PreloadScheduler.onSegmentDone."""
+        with self.lock:
+            lang_progress = self.progress[segment.lang]
+            lang_progress["done"] += 1
+            if error is not None:
+                lang_progress["failed"] += 1
+            now = time.monotonic()
+            # assume the language keeps its current rate
+            rate = lang_progress["done"] / max(now - self.start_time, 1e-6)
+            lang_progress["eta"] = (lang_progress["total"] - lang_progress["done"]) / rate
+            if now - self.last_report_time < PREFETCH_PROGRESS_INTERVAL:
+                return
+            self.last_report_time = now
+            progress = self.getProgress()
+        self.progress_callback(progress)
+
+    def getProgress(self):
+        """Get a copy of progress: a dictionary of total, done and failed segment counts, and ETA, for each language."""
+        return collections.OrderedDict((lang, dict(lang_progress)) for lang, lang_progress in self.progress.items())
+
+
+def logPrefetchProgress(progress):
+    """Log prefetch progress, as returned by PrefetchScheduler.getProgress."""
+    for lang, lang_progress in progress.items():
+        logging.getLogger().info(
+            "%s: %u/%u segments downloaded, %u failed%s"
+            % (
+                lang,
+                lang_progress["done"] - lang_progress["failed"],
+                lang_progress["total"],
+                lang_progress["failed"],
+                ", ETA %.0fs" % (lang_progress["eta"]) if lang_progress["eta"] else "",
+            )
+        )
+
+
+def runPrefetch(plan, thread_count=None, progress_callback=None):
+    """
+    Download segments of a PrefetchPlan with a shared pool of thread_count preloader threads, and wait for completion.
+
+    progress_callback is called periodically with the progress of each language, and once when done. Return the final
+    progress.
+    """
+    scheduler = PrefetchScheduler(plan, thread_count, progress_callback)
+    try:
+        for priority, segment in enumerate(plan.iterScheduled()):
+            scheduler.submit(segment, priority)
+        scheduler.join()
+    finally:
+        scheduler.stop()
+    progress = scheduler.getProgress()
+    scheduler.progress_callback(progress)
+    return progress
+
+
+def readPrefetchItems(file, default_lang="en"):
+    """Parse (text, lang) pairs from a JSON lines file object, with a {"text": ..., "lang": ...} object per line."""
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        d = json.loads(line)
+        yield d["text"], d.get("lang", default_lang)
+
+
+def exportCache(path):
+    """
+    Export all cache entries to a bundle file.
+
+    The bundle is a ZIP archive with a JSON manifest mapping cache keys to MP3 files. Return the number of exported
+    entries.
+    """
+    cache = SpeechSegment.getCache()
+    manifest = {"version": BUNDLE_FORMAT_VERSION, "entries": {}}
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as bundle:
+        for i, cache_key in enumerate(cache.keys()):
+            try:
+                audio_data = cache[cache_key]
+            except KeyError:
+                # removed since listed
+                continue
+            entry_name = "%08u.mp3" % (i)
+            bundle.writestr(entry_name, bytes(audio_data))
+            manifest["entries"][cache_key] = entry_name
+        bundle.writestr(BUNDLE_MANIFEST_NAME, json.dumps(manifest))
+    entry_count = len(manifest["entries"])
+    logging.getLogger().info("%u cache entries exported to '%s'" % (entry_count, path))
+    return entry_count
+
+
+def importCache(path, overwrite=False):
+    """
+    Import cache entries from a bundle file created by exportCache.
+
+    Existing entries are kept, unless overwrite is True. Return the number of imported entries.
+    """
+    cache = SpeechSegment.getCache()
+    SpeechSegment.maintainCache()
+    imported_count = 0
+    with zipfile.ZipFile(path, "r") as bundle:
+        manifest = json.loads(bundle.read(BUNDLE_MANIFEST_NAME))
+        if manifest["version"] != BUNDLE_FORMAT_VERSION:
+            raise ValueError("Unsupported cache bundle version %u" % (manifest["version"]))
+        for cache_key, entry_name in manifest["entries"].items():
+            if (not overwrite) and (cache_key in cache):
+                continue
+            cache[cache_key] = bundle.read(entry_name)
+            imported_count += 1
+    logging.getLogger().info("%u cache entries imported from '%s'" % (imported_count, path))
+    return imported_count
+
+
+def maintainCache(cache, max_size=None, max_count=None, interval=0, compact=False):
+    """
+    Purge obsolete entries, evict least recently used entries, and optionally compact a cache.
+
+    Entries are evicted until the cache fits in max_size bytes and max_count entries. Nothing is done if the cache was
+    already maintained less than interval seconds ago, or is being maintained, by any process. The maintenance
+    timestamp is only recorded when maintenance completes. Return the number of removed entries, or None if maintenance
+    was skipped.
+    """
+    now = time.time()
+    if isRecentlyMaintained(cache, now, interval):
+        return None
+    # take a lease, so concurrent processes don't maintain the cache too
+    lease_timestamp = cache.getMetadata(MAINTENANCE_LEASE_KEY)
+    if (lease_timestamp is not None) and (now - lease_timestamp < MAINTENANCE_LEASE_DURATION):
+        logging.getLogger().debug("Cache is being maintained by another process, skipping maintenance")
+        return None
+    if not cache.replaceMetadata(MAINTENANCE_LEASE_KEY, lease_timestamp, now):
+        logging.getLogger().debug("Cache maintenance was started by another process, skipping maintenance")
+        return None
+    try:
+        # another process may have completed maintenance since we checked
+        if isRecentlyMaintained(cache, now, interval):
+            return None
+        removed_count = runMaintenance(cache, max_size, max_count, compact)
+        cache.setMetadata(MAINTENANCE_TIMESTAMP_KEY, time.time())
+    finally:
+        cache.replaceMetadata(MAINTENANCE_LEASE_KEY, now, None)
+    return removed_count
+
+
+def isRecentlyMaintained(cache, now, interval):
+    """Return True if the cache was maintained less than interval seconds before now, False otherwise."""
+    last_maintenance_timestamp = cache.getMetadata(MAINTENANCE_TIMESTAMP_KEY, 0)
+    if now - last_maintenance_timestamp < interval:
+        logging.getLogger().debug(
+            "Cache was maintained %.0fs ago, skipping maintenance" % (now - last_maintenance_timestamp)
+        )
+        return True
+    return False
+
+
+def runMaintenance(cache, max_size, max_count, compact):
+    """Purge, evict and compact a cache (see maintainCache), and return the number of removed entries."""
+    removed_count = cache.purge()
+    logging.getLogger().debug("%u obsolete entries have been removed from cache" % (removed_count))
+    if (max_size is not None) or (max_count is not None):
+        evicted_count = cache.evict(max_size=max_size, max_count=max_count)
+        logging.getLogger().debug("%u least recently used entries have been evicted from cache" % (evicted_count))
+        removed_count += evicted_count
+    if compact:
+        saved_size = cache.compact()
+        logging.getLogger().debug("Cache compacted, %u bytes saved" % (saved_size))
+    return removed_count
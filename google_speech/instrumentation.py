@@ -0,0 +1,137 @@
+""" Performance instrumentation: hooks called with timing and size measurements of each processing stage. """
+
+import collections
+import contextlib
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+# callables called with (event, data dict) for each event
+hooks: List[Callable[[str, Dict[str, Any]], None]] = []
+
+
+def addHook(hook):
+    """Register a callable to be called with (event, data) for each instrumentation event."""
+    hooks.append(hook)
+
+
+def removeHook(hook):
+    """Unregister a callable previously registered with addHook."""
+    hooks.remove(hook)
+
+
+def emit(event, **data):
+    """Send an event to all hooks."""
+    for hook in hooks:
+        hook(event, data)
+
+
+@contextlib.contextmanager
+def timed(event, **data):
+    """
+    Context manager measuring the duration of its block, and emitting it in an event.
+
+    The yielded dictionary can be updated in the block to add data to the event. The event is also emitted if the block
+    raises an exception.
+    """
+    if not hooks:
+        yield data
+        return
+    start_time = time.perf_counter()
+    try:
+        yield data
+    finally:
+        emit(event, duration=time.perf_counter() - start_time, **data)
+
+
+class ValueStats:
+
+    """
+    Running aggregates of the values of an event field, with a fixed size random sample of them for percentiles.
+
+    Memory usage does not depend on the number of values. Percentiles are exact until there are more values than the
+    sample size, and estimated from the sample after that.
+    """
+
+    def __init__(self, sample_size, rng):
+        self.count = 0
+        self.true_count = 0
+        self.all_bool = True
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.sample = []
+        self.sample_size = sample_size
+        self.rng = rng
+
+    def add(self, value):
+        """Add a value."""
+        self.count += 1
+        if isinstance(value, bool):
+            self.true_count += value
+        else:
+            self.all_bool = False
+        self.total += value
+        if (self.min is None) or (value < self.min):
+            self.min = value
+        if (self.max is None) or (value > self.max):
+            self.max = value
+        # reservoir sampling: each value has the same probability to be in the sample
+        if len(self.sample) < self.sample_size:
+            self.sample.append(value)
+        else:
+            i = self.rng.randrange(self.count)
+            if i < self.sample_size:
+                self.sample[i] = value
+
+    def getSummary(self, percentiles):
+        """Get summary of values, with the given percentiles."""
+        if self.all_bool:
+            return {"true": self.true_count, "false": self.count - self.true_count}
+        summary = {"total": self.total, "min": self.min, "max": self.max, "mean": self.total / self.count}
+        sample = sorted(self.sample)
+        for percentile in percentiles:
+            # nearest rank method
+            rank = max(-(-percentile * len(sample) // 100), 1)
+            summary["p%u" % (percentile)] = sample[rank - 1]
+        return summary
+
+
+class StatsCollector:
+
+    """Hook aggregating events into counts, totals and percentiles of their numeric values, in bounded memory."""
+
+    PERCENTILES = (50, 90, 99)
+    SAMPLE_SIZE = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rng = random.Random()
+        self.events = collections.defaultdict(
+            lambda: collections.defaultdict(lambda: ValueStats(__class__.SAMPLE_SIZE, self.rng))
+        )
+        self.counts = collections.Counter()
+
+    def __call__(self, event, data):
+        """Record an event."""
+        with self.lock:
+            self.counts[event] += 1
+            values = self.events[event]
+            for name, value in data.items():
+                if isinstance(value, (bool, int, float)):
+                    values[name].add(value)
+
+    def getSummary(self):
+        """Get a dictionary summarizing all events, suitable for JSON serialization."""
+        with self.lock:
+            return {
+                event: dict(
+                    count=self.counts[event],
+                    **{
+                        name: value_stats.getSummary(__class__.PERCENTILES)
+                        for name, value_stats in self.events[event].items()
+                    },
+                )
+                for event in sorted(self.events)
+            }
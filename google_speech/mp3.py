@@ -0,0 +1,418 @@
+""" MPEG audio layer III frame parsing, trimming and concatenation, without decoding. """
+
+import collections
+import logging
+import struct
+
+HEADER = struct.Struct(">I")
+SYNC_MASK = 0xFFE00000
+LAYER_III = 0b01
+VERSION_1, VERSION_2, VERSION_2_5 = 0b11, 0b10, 0b00
+BITRATES = {
+    VERSION_1: (None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, None),
+    VERSION_2: (None, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, None),
+}
+BITRATES[VERSION_2_5] = BITRATES[VERSION_2]
+SAMPLE_RATES = {
+    VERSION_1: (44100, 48000, 32000, None),
+    VERSION_2: (22050, 24000, 16000, None),
+    VERSION_2_5: (11025, 12000, 8000, None),
+}
+CHANNEL_MODE_MONO = 0b11
+TAG_IDS = (b"Xing", b"Info")
+VBRI_TAG_ID = b"VBRI"
+VBRI_TAG_OFFSET = 36
+TAG_TOC_SIZE = 100
+TAG_FLAGS = 0x1 | 0x2 | 0x4  # frame count, byte count, TOC
+TAG_SIZE = 4 + 4 + 4 + 4 + TAG_TOC_SIZE
+
+Frame = collections.namedtuple(
+    "Frame", ("offset", "size", "header", "version", "bitrate", "sample_rate", "channel_count", "sample_count")
+)
+Frame.__doc__ = "MPEG audio layer III frame, offset and size being in bytes."
+
+
+def parseFrameHeader(data, offset):
+    """Parse the frame header at offset in data, and return a Frame, or None if there is no valid header."""
+    if offset + HEADER.size > len(data):
+        return None
+    header = HEADER.unpack_from(data, offset)[0]
+    if (header & SYNC_MASK) != SYNC_MASK:
+        return None
+    version = (header >> 19) & 0b11
+    layer = (header >> 17) & 0b11
+    if (version not in BITRATES) or (layer != LAYER_III):
+        return None
+    bitrate = BITRATES[version][(header >> 12) & 0b1111]
+    sample_rate = SAMPLE_RATES[version][(header >> 10) & 0b11]
+    if (bitrate is None) or (sample_rate is None):
+        return None
+    padding = (header >> 9) & 0b1
+    channel_count = 1 if ((header >> 6) & 0b11) == CHANNEL_MODE_MONO else 2
+    sample_count = 1152 if version == VERSION_1 else 576
+    size = sample_count // 8 * bitrate * 1000 // sample_rate + padding
+    return Frame(offset, size, header, version, bitrate, sample_rate, channel_count, sample_count)
+
+
+def getSideInfoOffset(frame):
+    """Get offset of side information in a frame, relative to frame start."""
+    has_crc = not ((frame.header >> 16) & 0b1)
+    return HEADER.size + (2 if has_crc else 0)
+
+
+def getSideInfoSize(frame):
+    """Get size of side information in a frame."""
+    if frame.version == VERSION_1:
+        return 17 if frame.channel_count == 1 else 32
+    return 9 if frame.channel_count == 1 else 17
+
+
+def getMainDataSize(frame):
+    """Get size of the main data (bit reservoir) area of a frame."""
+    return frame.size - getSideInfoOffset(frame) - getSideInfoSize(frame)
+
+
+def getMainDataBegin(data, frame):
+    """Get the number of bytes of main data of a frame stored in previous frames (bit reservoir)."""
+    side_info_offset = frame.offset + getSideInfoOffset(frame)
+    if frame.version == VERSION_1:
+        return ((data[side_info_offset] << 8) | data[side_info_offset + 1]) >> 7
+    return data[side_info_offset]
+
+
+def isTagFrame(data, frame):
+    """Return True if a frame contains a Xing, Info or VBRI tag instead of audio, False otherwise."""
+    tag_offset = frame.offset + getSideInfoOffset(frame) + getSideInfoSize(frame)
+    if bytes(data[tag_offset : tag_offset + 4]) in TAG_IDS:
+        return True
+    tag_offset = frame.offset + VBRI_TAG_OFFSET
+    return bytes(data[tag_offset : tag_offset + 4]) == VBRI_TAG_ID
+
+
+def getId3v2Size(data):
+    """Get size of an ID3v2 tag at the start of data, or 0 if there is none."""
+    if bytes(data[:3]) != b"ID3" or len(data) < 10:
+        return 0
+    # size is stored as a 28-bit "syncsafe" integer
+    size = 10 + ((data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F))
+    if data[5] & 0x10:
+        # footer
+        size += 10
+    return size
+
+
+def iterFrames(data):
+    """
+    Parse audio frames of MP3 data (any bytes-like object).
+
+    ID3v2 tags, Xing/Info/VBRI tag frames, and garbage between frames are skipped. Yield a Frame for each complete
+    audio frame.
+    """
+    data = memoryview(data)
+    offset = getId3v2Size(data)
+    data_len = len(data)
+    while offset < data_len:
+        frame = parseFrameHeader(data, offset)
+        if (frame is None) or (offset + frame.size > data_len):
+            # resync
+            offset += 1
+            continue
+        if not isTagFrame(data, frame):
+            yield frame
+        offset += frame.size
+
+
+def trim(data, start_duration, end_duration):
+    """
+    Remove whole frames at the start and end of MP3 data, within start_duration and end_duration seconds.
+
+    Frames holding bit reservoir data of the first kept frame are kept too. Return a memoryview of data, without copy,
+    or of the whole data if it does not contain MP3 frames.
+    """
+    data = memoryview(data)
+    frames = list(iterFrames(data))
+    if not frames:
+        return data
+    first = 0
+    duration = 0
+    while first < len(frames):
+        duration += frames[first].sample_count / frames[first].sample_rate
+        if duration > start_duration:
+            break
+        first += 1
+    end = len(frames)
+    duration = 0
+    while end > first:
+        duration += frames[end - 1].sample_count / frames[end - 1].sample_rate
+        if duration > end_duration:
+            break
+        end -= 1
+    if first >= end:
+        # too short, keep everything
+        first, end = 0, len(frames)
+    # the first kept frame may reference main data stored in previous frames
+    reservoir_size = getMainDataBegin(data, frames[first])
+    while (reservoir_size > 0) and (first > 0):
+        first -= 1
+        reservoir_size -= getMainDataSize(frames[first])
+    return data[frames[first].offset : frames[end - 1].offset + frames[end - 1].size]
+
+
+class StreamTrimmer:
+
+    """
+    Remove whole frames at the start and end of MP3 data received in chunks, like trim does for whole data.
+
+    Frames are output as soon as they can not be part of the frames removed at the end, so data is not delayed by more
+    than end_duration seconds of audio.
+    """
+
+    def __init__(self, start_duration, end_duration):
+        self.start_duration = start_duration
+        self.end_duration = end_duration
+        self.data = bytearray()  # received data not parsed yet
+        self.id3_skipped = False
+        self.received_data = bytearray()  # all received data until a frame is found, output as is if there is none
+        self.started = False  # True once the first kept frame is received
+        self.head_frames = []  # (Frame, data) of frames removed at start, output anyway if the whole data is too short
+        self.head_duration = 0
+        # data of frames not output yet, that may be removed at the end, as (duration, data, is bit reservoir) tuples
+        self.held_frames = collections.deque()
+        self.held_duration = 0  # of held frames, except bit reservoir frames
+        self.released = False
+
+    def feed(self, data):
+        """Add received MP3 data, and return trimmed data that can be output."""
+        self.data.extend(data)
+        if self.received_data is not None:
+            self.received_data.extend(data)
+        for frame, frame_data in self.parseFrames(final=False):
+            self.addFrame(frame, frame_data)
+        return self.release()
+
+    def flush(self):
+        """Return remaining trimmed data, at the end of MP3 data."""
+        for frame, frame_data in self.parseFrames(final=True):
+            self.addFrame(frame, frame_data)
+        if self.received_data is not None:
+            # not MP3 data
+            return bytes(self.received_data)
+        output = bytearray(self.release())
+        held_frames = list(self.held_frames)
+        end = len(held_frames)
+        duration = 0
+        while (end > 0) and (not held_frames[end - 1][2]):
+            duration += held_frames[end - 1][0]
+            if duration > self.end_duration:
+                break
+            end -= 1
+        if (not self.released) and all(is_reservoir for _, _, is_reservoir in held_frames[:end]):
+            # too short, keep everything
+            for _, frame_data in self.head_frames:
+                output.extend(frame_data)
+            end = len(held_frames)
+        for _, frame_data, _ in held_frames[:end]:
+            output.extend(frame_data)
+        return bytes(output)
+
+    def parseFrames(self, final):
+        """
+        Parse complete audio frames of received data, and remove their data (see iterFrames).
+
+        Yield (Frame, frame data) tuples, frame offset being 0. If final is False, incomplete data at the end is kept
+        for the next call.
+        """
+        data = self.data
+        offset = 0
+        if not self.id3_skipped:
+            if (len(data) < 10) and (not final):
+                return
+            offset = getId3v2Size(data)
+            if (offset > len(data)) and (not final):
+                return
+            self.id3_skipped = True
+        while offset < len(data):
+            frame = parseFrameHeader(data, offset)
+            if (frame is not None) and (offset + frame.size > len(data)) and (not final):
+                # wait for the rest of the frame
+                break
+            if (frame is None) or (offset + frame.size > len(data)):
+                if (offset + HEADER.size > len(data)) and (not final):
+                    break
+                # resync
+                offset += 1
+                continue
+            frame_data = bytes(data[offset : offset + frame.size])
+            offset += frame.size
+            frame = frame._replace(offset=0)
+            if not isTagFrame(frame_data, frame):
+                self.received_data = None
+                yield frame, frame_data
+        del data[:offset]
+
+    def addFrame(self, frame, frame_data):
+        """Remove a frame at the start, or hold it until it can be output."""
+        duration = frame.sample_count / frame.sample_rate
+        if not self.started:
+            self.head_duration += duration
+            if self.head_duration <= self.start_duration:
+                self.head_frames.append((frame, frame_data))
+                return
+            self.started = True
+            # the first kept frame may reference main data stored in previous frames
+            reservoir_frame_count = 0
+            reservoir_size = getMainDataBegin(frame_data, frame)
+            while (reservoir_size > 0) and (reservoir_frame_count < len(self.head_frames)):
+                reservoir_frame_count += 1
+                reservoir_size -= getMainDataSize(self.head_frames[-reservoir_frame_count][0])
+            if reservoir_frame_count > 0:
+                for _, reservoir_frame_data in self.head_frames[-reservoir_frame_count:]:
+                    self.held_frames.append((0, reservoir_frame_data, True))
+                del self.head_frames[-reservoir_frame_count:]
+        self.held_frames.append((duration, frame_data, False))
+        self.held_duration += duration
+
+    def release(self):
+        """Remove and return data of held frames that can not be part of the frames removed at the end."""
+        output = []
+        while self.held_frames:
+            duration, frame_data, _ = self.held_frames[0]
+            if self.held_duration - duration <= self.end_duration:
+                break
+            self.held_frames.popleft()
+            self.held_duration -= duration
+            output.append(frame_data)
+        if output:
+            self.released = True
+            self.head_frames = []
+        return b"".join(output)
+
+
+def iterTrimmedChunks(chunks, start_duration, end_duration):
+    """Remove whole frames at the start and end of MP3 data received as an iterable of chunks (see StreamTrimmer)."""
+    trimmer = StreamTrimmer(start_duration, end_duration)
+    for chunk in chunks:
+        trimmed_data = trimmer.feed(chunk)
+        if trimmed_data:
+            yield trimmed_data
+    trimmed_data = trimmer.flush()
+    if trimmed_data:
+        yield trimmed_data
+
+
+def getDuration(data):
+    """Get duration of MP3 data in seconds."""
+    return sum(frame.sample_count / frame.sample_rate for frame in iterFrames(data))
+
+
+def buildTagFrame(first_frame, frame_count, byte_count, frame_offsets, is_cbr):
+    """
+    Build a frame containing a Xing tag (or Info tag, for constant bitrate) for MP3 data.
+
+    frame_offsets are offsets of audio frames from the start of the tag frame, and byte_count includes the tag frame.
+    """
+    # find the lowest bitrate giving a frame big enough for the tag, without CRC and padding
+    header = (first_frame.header | (1 << 16)) & ~(0b1 << 9) & ~(0b1111 << 12)
+    for bitrate_idx in range(1, 15):
+        frame = parseFrameHeader(HEADER.pack(header | (bitrate_idx << 12)), 0)
+        assert frame is not None
+        tag_offset = getSideInfoOffset(frame) + getSideInfoSize(frame)
+        if frame.size >= tag_offset + TAG_SIZE:
+            break
+    # table of contents: position in file for each percent of duration, scaled to 256
+    toc = bytes(
+        min(255, frame_offsets[i * frame_count // TAG_TOC_SIZE] * 256 // byte_count) if frame_count else 0
+        for i in range(TAG_TOC_SIZE)
+    )
+    data = bytearray(frame.size)
+    HEADER.pack_into(data, 0, frame.header)
+    struct.pack_into(
+        ">4sIII%us" % (TAG_TOC_SIZE),
+        data,
+        tag_offset,
+        TAG_IDS[1] if is_cbr else TAG_IDS[0],
+        TAG_FLAGS,
+        frame_count,
+        byte_count,
+        toc,
+    )
+    return bytes(data)
+
+
+class Mp3Writer:
+
+    """
+    Write MP3 data of several segments to a file, as a single stream.
+
+    If the file is seekable, a Xing/Info tag frame with total frame count, size, and seek table is written at the start
+    of the stream, so players know the duration and can seek.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.tag_position = None
+        self.tag_size = 0
+        self.first_frame = None
+        self.frame_offsets = []
+        self.byte_count = 0
+        self.bitrates = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        """Write MP3 data, and return its audio frames."""
+        frames = list(iterFrames(data))
+        if not frames:
+            logging.getLogger().debug("No MP3 frame found in %u bytes of data, writing data as is" % (len(data)))
+            self.writeData(data)
+            return frames
+        if self.first_frame is None:
+            self.first_frame = frames[0]
+            if self.isSeekable():
+                # write a placeholder tag frame, updated on close
+                self.tag_position = self.file.tell()
+                tag_frame = buildTagFrame(self.first_frame, 0, 1, [0], True)
+                self.tag_size = len(tag_frame)
+                # count bytes from the start of the tag frame
+                self.byte_count = 0
+                self.writeData(tag_frame)
+        for frame in frames:
+            if (frame.sample_rate, frame.channel_count) != (
+                self.first_frame.sample_rate,
+                self.first_frame.channel_count,
+            ):
+                raise ValueError("Can not concatenate MP3 data with different sample rates or channel counts")
+            self.frame_offsets.append(self.byte_count + frame.offset)
+            self.bitrates.add(frame.bitrate)
+        self.writeData(data)
+        return frames
+
+    def writeData(self, data):
+        """Write data to file."""
+        self.file.write(data)
+        self.byte_count += len(data)
+
+    def isSeekable(self):
+        """Return True if the file supports seeking, False otherwise."""
+        try:
+            return self.file.seekable()
+        except AttributeError:
+            return False
+
+    def close(self):
+        """Update the tag frame, without closing the file."""
+        if self.tag_position is None:
+            return
+        tag_frame = buildTagFrame(
+            self.first_frame, len(self.frame_offsets), self.byte_count, self.frame_offsets, len(self.bitrates) == 1
+        )
+        assert len(tag_frame) == self.tag_size
+        end_position = self.file.tell()
+        self.file.seek(self.tag_position)
+        self.file.write(tag_frame)
+        self.file.seek(end_position)
+        self.tag_position = None
@@ -0,0 +1,118 @@
+""" Index of segment positions in saved speech MP3 files, for random access to segments without decoding. """
+
+import bisect
+import json
+import os
+
+from google_speech import Speech, SpeechSegment, mp3
+
+INDEX_FORMAT_VERSION = 1
+INDEX_SUFFIX = ".index.json"
+
+
+def getIndexPath(mp3_path):
+    """Get path of the index file of an MP3 file."""
+    return mp3_path + INDEX_SUFFIX
+
+
+class IndexWriter:
+
+    """
+    Writer of a segment index to a JSON file, one segment at a time, to not keep the whole index in memory.
+
+    Instances are callable with the index entry of a segment, and can be passed as the index of Speech.savef. The file
+    is only replaced when the writer is closed without error.
+    """
+
+    def __init__(self, path, lang):
+        self.path = path
+        self.tmp_path = "%s.tmp" % (path)
+        self.file = open(self.tmp_path, "wt")
+        self.file.write('{"version": %u, "lang": %s, "segments": [' % (INDEX_FORMAT_VERSION, json.dumps(lang)))
+        self.segment_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+    def __call__(self, segment):
+        """Write the index entry of the next segment."""
+        if self.segment_count > 0:
+            self.file.write(", ")
+        json.dump(segment, self.file)
+        self.segment_count += 1
+
+    def close(self):
+        """Finish writing the index file."""
+        self.file.write("]}")
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def writeIndex(path, lang, segments):
+    """Write a segment index, as produced by Speech.savef, to a JSON file."""
+    with IndexWriter(path, lang) as index_writer:
+        for segment in segments:
+            index_writer(segment)
+
+
+def readIndex(path):
+    """Read a segment index file, and return a dictionary with 'lang' and 'segments' keys."""
+    with open(path, "rt") as f:
+        index = json.load(f)
+    if index["version"] != INDEX_FORMAT_VERSION:
+        raise ValueError("Unsupported segment index version %u" % (index["version"]))
+    return index
+
+
+def findSegment(segments, position):
+    """Get the number of the segment being played at position in seconds."""
+    return max(0, bisect.bisect_right([segment["start_time"] for segment in segments], position) - 1)
+
+
+def extractSegments(mp3_path, file, first, last=None, index=None):
+    """
+    Write MP3 data of segments first to last (included, defaults to first) of a saved speech into a file object.
+
+    Only data of these segments is read, using the index (read from the index file of mp3_path if None). Return the
+    extracted segments of the index.
+    """
+    if index is None:
+        index = readIndex(getIndexPath(mp3_path))
+    segments = index["segments"][first : (first if last is None else last) + 1]
+    if not segments:
+        raise IndexError("Invalid segment range")
+    with open(mp3_path, "rb") as mp3_file, mp3.Mp3Writer(file) as writer:
+        for segment in segments:
+            mp3_file.seek(segment["offset"])
+            writer.write(mp3_file.read(segment["size"]))
+    return segments
+
+
+def renderSegments(index, text, file, first, last=None):
+    """
+    Render again segments first to last (included, defaults to first) of an index, and write MP3 data to a file object.
+
+    Segment text is taken from the source text of the speech at the indexed offsets, and is not split again. Audio data
+    is taken from cache if available.
+    """
+    segments = index["segments"][first : (first if last is None else last) + 1]
+    if not segments:
+        raise IndexError("Invalid segment range")
+    with mp3.Mp3Writer(file) as writer:
+        for segment_num, segment in enumerate(segments):
+            speech_segment = SpeechSegment(
+                Speech.cleanSpaces(text[segment["text_start"] : segment["text_end"]]),
+                index["lang"],
+                segment_num,
+                len(segments),
+                source_span=(segment["text_start"], segment["text_end"]),
+            )
+            writer.write(speech_segment.getTrimmedAudioData())
+    return segments
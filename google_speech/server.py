@@ -0,0 +1,240 @@
+""" Local daemon serving speech audio data over HTTP, on a TCP or Unix socket, and its client. """
+
+import http.client
+import http.server
+import logging
+import os
+import re
+import socket
+import socketserver
+import sys
+import urllib.parse
+
+from google_speech import SUPPORTED_LANGUAGES, PreloadScheduler, Speech, SpeechSegment, StreamPlayer, __version__
+
+SPEECH_PATH = "/speech"
+SEGMENTATIONS = ("greedy", "sentence")
+CLIENT_TIMEOUT = 60
+CLIENT_CHUNK_SIZE = 16 * 1024
+# other addresses are Unix socket paths
+TCP_ADDRESS_REGEX = re.compile(r"^(\[[0-9A-Fa-f:.]+\]|[^\s/:\[\]]+):([0-9]+)$")
+
+
+class SpeechRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    """
+    Handler of speech requests.
+
+    Text, lang and segmentation parameters are read from the URL query string (GET), or from a form encoded body
+    (POST). Trimmed MP3 data of segments is sent with chunked transfer encoding, as soon as each segment is available.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "google_speech/%s" % (__version__)
+
+    def do_GET(self):
+        """Handle a GET request."""
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != SPEECH_PATH:
+            self.send_error(http.HTTPStatus.NOT_FOUND)
+            return
+        self.handleSpeech(urllib.parse.parse_qs(url.query))
+
+    def do_POST(self):
+        """Handle a POST request."""
+        if urllib.parse.urlsplit(self.path).path != SPEECH_PATH:
+            self.send_error(http.HTTPStatus.NOT_FOUND)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.handleSpeech(urllib.parse.parse_qs(body.decode()))
+
+    def handleSpeech(self, params):
+        """Send audio data of a speech."""
+        text = params.get("text", ("",))[0]
+        lang = params.get("lang", ("en",))[0]
+        segmentation = params.get("segmentation", ("greedy",))[0]
+        if (not text.strip()) or (text == "-") or (lang not in SUPPORTED_LANGUAGES):
+            self.send_error(http.HTTPStatus.BAD_REQUEST, "Invalid text or language")
+            return
+        if segmentation not in SEGMENTATIONS:
+            self.send_error(http.HTTPStatus.BAD_REQUEST, "Invalid segmentation")
+            return
+        segments = Speech(text, lang, segmentation).iterPreloaded(scheduler=self.server.scheduler)
+        try:
+            try:
+                # fetch first segment before sending headers, so errors can still be reported with a status code
+                audio_data = next(segments).getTrimmedAudioData()
+            except Exception as e:
+                logging.getLogger().error("%s: %s" % (e.__class__.__qualname__, e))
+                self.send_error(http.HTTPStatus.BAD_GATEWAY, "%s: %s" % (e.__class__.__qualname__, e))
+                return
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                self.writeChunk(audio_data)
+                for segment in segments:
+                    self.writeChunk(segment.getTrimmedAudioData())
+                self.writeChunk(b"")
+            except Exception as e:
+                # the client sees the response is truncated
+                logging.getLogger().error("%s: %s" % (e.__class__.__qualname__, e))
+                self.close_connection = True
+        finally:
+            segments.close()
+
+    def writeChunk(self, data):
+        """Write data as a HTTP chunk, an empty chunk ending the response."""
+        self.wfile.write(b"%X\r\n" % (len(data)))
+        self.wfile.write(data)
+        self.wfile.write(b"\r\n")
+        self.wfile.flush()
+
+    def address_string(self):
+        """See http.server.BaseHTTPRequestHandler.address_string."""
+        # client address is not a tuple for Unix sockets
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        """See http.server.BaseHTTPRequestHandler.log_message."""
+        logging.getLogger().debug("%s %s" % (self.address_string(), format % args))
+
+
+class TcpSpeechServer(http.server.ThreadingHTTPServer):
+
+    """Speech server on a TCP socket."""
+
+    daemon_threads = True
+
+
+class UnixSpeechServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """Speech server on a Unix socket."""
+
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    """HTTP connection over a Unix socket."""
+
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        """See http.client.HTTPConnection.connect."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def isUnixSocketAddress(address):
+    """Return True if address is a Unix socket path, False if it is a 'host:port' TCP address."""
+    return TCP_ADDRESS_REGEX.match(address) is None
+
+
+def parseTcpAddress(address):
+    """Parse a 'host:port' address, the host being an IPv6 address between brackets or not, and return (host, port)."""
+    match = TCP_ADDRESS_REGEX.match(address)
+    if match is None:
+        raise ValueError("Invalid TCP address '%s'" % (address))
+    return match.group(1).strip("[]"), int(match.group(2))
+
+
+def createServer(address, scheduler):
+    """Create a speech server listening on address, using a shared preload scheduler."""
+    if isUnixSocketAddress(address):
+        if os.path.exists(address):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect(address)
+                except OSError:
+                    # stale socket file from a server that did not exit cleanly
+                    os.remove(address)
+                else:
+                    raise RuntimeError("A server is already listening on '%s'" % (address))
+        server = UnixSpeechServer(address, SpeechRequestHandler)
+    else:
+        server = TcpSpeechServer(parseTcpAddress(address), SpeechRequestHandler)
+    server.scheduler = scheduler
+    return server
+
+
+def serve(address, thread_count=None, memory_cache_size=None):
+    """
+    Serve speech requests on address, until interrupted.
+
+    All clients share the HTTP connection pool, the cache, and the preloader threads. If memory_cache_size is not None,
+    an in memory cache tier of this size in bytes is also shared, so frequently requested segments are served without
+    database access.
+    """
+    if memory_cache_size is not None:
+        SpeechSegment.enableMemoryCache(memory_cache_size)
+    scheduler = PreloadScheduler(thread_count)
+    server = createServer(address, scheduler)
+    # open cache and HTTP session now, rather than on first request
+    SpeechSegment.getCache()
+    SpeechSegment.getSession()
+    logging.getLogger().info("Listening on %s" % (address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.stop()
+        if isUnixSocketAddress(address):
+            os.remove(address)
+
+
+def iterSpeechData(address, text, lang, segmentation="greedy"):
+    """Request a speech from the server at address, and yield chunks of MP3 data as they are received."""
+    if isUnixSocketAddress(address):
+        connection = UnixHTTPConnection(address, CLIENT_TIMEOUT)
+    else:
+        host, port = parseTcpAddress(address)
+        connection = http.client.HTTPConnection(host, port, timeout=CLIENT_TIMEOUT)
+    try:
+        body = urllib.parse.urlencode({"text": text, "lang": lang, "segmentation": segmentation})
+        connection.request(
+            "POST", SPEECH_PATH, body=body, headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        response = connection.getresponse()
+        if response.status != http.HTTPStatus.OK:
+            raise RuntimeError("Server error %u: %s" % (response.status, response.reason))
+        while True:
+            chunk = response.read1(CLIENT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        connection.close()
+
+
+def saveSpeech(address, text, lang, file, segmentation="greedy"):
+    """Request a speech from the server at address, and write MP3 data into a file object."""
+    for chunk in iterSpeechData(address, text, lang, segmentation):
+        file.write(chunk)
+        file.flush()
+
+
+def playSpeech(address, text, lang, sox_effects=(), segmentation="greedy"):
+    """Request a speech from the server at address, and play it while it is received."""
+    with StreamPlayer(sox_effects) as player:
+        for chunk in iterSpeechData(address, text, lang, segmentation):
+            player.write(chunk)
+
+
+def runClient(address, text, lang, output=None, sox_effects=(), segmentation="greedy"):
+    """Request a speech from the server at address, and play it, or save it to output path ('-' for stdout)."""
+    if output == "-":
+        saveSpeech(address, text, lang, sys.stdout.buffer, segmentation)
+    elif output:
+        with open(output, "wb") as f:
+            saveSpeech(address, text, lang, f, segmentation)
+    else:
+        playSpeech(address, text, lang, sox_effects, segmentation)
@@ -27,7 +27,7 @@ setup(
     name="google_speech",
     version=version,
     author="desbma",
-    packages=find_packages(exclude=("tests",)),
+    packages=find_packages(exclude=("tests", "benchmarks")),
     entry_points={"console_scripts": ["google_speech = google_speech:cl_main"]},
     test_suite="tests",
     install_requires=requirements,
@@ -2,15 +2,29 @@
 
 """Unit tests."""
 
+import asyncio
+import concurrent.futures
+import io
 import itertools
 import logging
 import os
 import socket
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
 import google_speech
+import google_speech.async_speech
+import google_speech.batch
+import google_speech.cache_backends
+import google_speech.cache_tools
+import google_speech.mp3
+import google_speech.segment_index
+import google_speech.server
 
 google_speech.web_cache.DISABLE_PERSISTENT_CACHING = True
 
@@ -57,8 +71,8 @@ class TestGoogleSpeech(unittest.TestCase):
             "texte.",
         )
         for lang, speech in zip(("en", "fr"), speeches):
-            for effect in ((), ("speed", "10")):
-                google_speech.Speech(speech, lang).play(effect)
+            for effect, player in itertools.product(((), ("speed", "10")), ("segment", "stream")):
+                google_speech.Speech(speech, lang).play(effect, player=player)
 
     def test_splitTest(self):
         """Split input text."""
@@ -108,6 +122,890 @@ class TestGoogleSpeech(unittest.TestCase):
             self.assertEqual(i, len(split_text * 3))
             sys.stdin = original_stdin
 
+    def test_splitChunks(self):
+        """Split text read from a file object or chunk iterator, like the whole text."""
+        text = " ".join("Chunked  sentence\tnumber %u,\nwith some more words" % (i) for i in range(300))
+        ref_split_text = google_speech.Speech.splitText(text)
+        for chunk_size in (1, 7, 1000):
+            chunks = (text[i : i + chunk_size] for i in range(0, len(text), chunk_size))
+            speech = google_speech.Speech(chunks, "en")
+            self.assertEqual([segment.text for segment in speech], ref_split_text)
+        speech = google_speech.Speech(io.StringIO(" \n%s\n " % (text)), "en")
+        segments = list(speech)
+        self.assertEqual([segment.text for segment in segments], ref_split_text)
+        self.assertEqual([segment.segment_num for segment in segments], list(range(len(ref_split_text))))
+
+        # sentence segmentation, segments being yielded before all chunks are read
+        text = " ".join(
+            "Chunked sentence number %u, with %swords%s" % (i, "more " * (i % 7), ".!?,"[i % 4]) for i in range(300)
+        )
+        segment_texts = [text[start:end] for start, end in google_speech.Speech.iterSentenceSplitOffsets(text, "en")]
+        for i in range(0, len(segment_texts) - 1, 3):
+            # cached segments spanning several sentences
+            google_speech.SpeechSegment(" ".join(segment_texts[i : i + 2]), "en", 0).storeAudioData(b"\x00")
+        ref_offsets = list(google_speech.Speech.iterSentenceSplitOffsets(text, "en"))
+        self.assertLess(len(ref_offsets), len(segment_texts))
+        for chunk_size in (7, 50, 1000):
+            read_sizes = []
+
+            def iter_chunks():
+                for i in range(0, len(text), chunk_size):
+                    read_sizes.append(i)
+                    yield text[i : i + chunk_size]
+
+            segments = iter(google_speech.Speech(iter_chunks(), "en", "sentence"))
+            first_segment = next(segments)
+            self.assertLess(read_sizes[-1], len(text) // 2)
+            segments = [first_segment] + list(segments)
+            self.assertEqual(
+                [(segment.text_offset, segment.text_offset + len(segment.text)) for segment in segments], ref_offsets
+            )
+
+        # without any sentence end, leading text is split like with greedy segmentation
+        text = ", ".join("clause number %u without any sentence end" % (i) for i in range(2000))
+        read_sizes = []
+
+        def iter_chunks():
+            for i in range(0, len(text), 1000):
+                read_sizes.append(i)
+                yield text[i : i + 1000]
+
+        segments = iter(google_speech.Speech(iter_chunks(), "en", "sentence"))
+        first_segment = next(segments)
+        self.assertLess(read_sizes[-1], len(text) // 2)
+        segments = [first_segment] + list(segments)
+        for segment in segments:
+            self.assertLessEqual(len(segment.text), google_speech.Speech.MAX_SEGMENT_SIZE)
+            self.assertEqual(text[segment.text_offset : segment.text_offset + len(segment.text)], segment.text)
+        self.assertEqual(segments[-1].text_offset + len(segments[-1].text), len(text))
+
+    def test_sentenceSegmentation(self):
+        """Split input text at sentence boundaries, preferring cached segments."""
+        text = "Hello John. Your order has shipped! It will arrive on %s, at the usual address." % ("d" * 180)
+        speech = google_speech.Speech(text, "en", "sentence")
+        self.assertEqual(
+            [segment.text for segment in speech],
+            ["Hello John.", "Your order has shipped!", "It will arrive on %s," % ("d" * 180), "at the usual address."],
+        )
+
+        # same sentence, different neighbours
+        speech = google_speech.Speech("Hello Jane. Your order has shipped! Thanks.", "en", "sentence")
+        self.assertEqual([segment.text for segment in speech], ["Hello Jane.", "Your order has shipped!", "Thanks."])
+
+        # cached segments spanning several sentences are reused
+        google_speech.SpeechSegment("Hello Jane. Your order has shipped!", "en", 0).storeAudioData(b"\x00")
+        speech = google_speech.Speech("Hello Jane. Your order has shipped! Thanks.", "en", "sentence")
+        self.assertEqual([segment.text for segment in speech], ["Hello Jane. Your order has shipped!", "Thanks."])
+
+        # sentence terminals of scripts not followed by spaces
+        speech = google_speech.Speech("你好。我很好。谢谢！「再见。」", "zh", "sentence")
+        self.assertEqual([segment.text for segment in speech], ["你好。", "我很好。", "谢谢！", "「再见。」"])
+        speech = google_speech.Speech("नमस्ते।आप कैसे हैं। ठीक हूँ॥", "hi", "sentence")
+        self.assertEqual([segment.text for segment in speech], ["नमस्ते।", "आप कैसे हैं।", "ठीक हूँ॥"])
+        # but not ASCII ones
+        speech = google_speech.Speech("It costs 3.14 dollars.It is cheap.", "en", "sentence")
+        self.assertEqual([segment.text for segment in speech], ["It costs 3.14 dollars.It is cheap."])
+
+        # long text is split by windows of sentences, with a single cache lookup for each
+        text = " ".join("Windowed sentence number %u, with a clause." % (i) for i in range(200))
+        window_count = len(list(google_speech.Speech.iterSentenceWindows(text)))
+        self.assertGreater(window_count, 1)
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "getCachedKeys", wraps=google_speech.SpeechSegment.getCachedKeys
+        ) as get_cached_keys_mock, unittest.mock.patch.object(
+            google_speech.SpeechSegment, "isInCache", side_effect=AssertionError()
+        ):
+            segments = iter(google_speech.Speech(text, "en", "sentence"))
+            self.assertEqual(next(segments).text, "Windowed sentence number 0, with a clause.")
+            self.assertEqual(get_cached_keys_mock.call_count, 1)
+            self.assertEqual(len(list(segments)), 199)
+            self.assertEqual(get_cached_keys_mock.call_count, window_count)
+
+    def test_cacheKey(self):
+        """Build position independent cache keys."""
+        segment = google_speech.SpeechSegment("Hello  World", "en", 0, 3)
+        self.assertEqual(segment.getCacheKey(), google_speech.SpeechSegment("hello world", "en", 2, 4).getCacheKey())
+        self.assertEqual(
+            google_speech.SpeechSegment("Cafe\u0301", "fr", 0).getCacheKey(),
+            google_speech.SpeechSegment("caf\u00e9", "fr", 1).getCacheKey(),
+        )
+        self.assertNotEqual(segment.getCacheKey(), google_speech.SpeechSegment("Hello World", "fr", 0).getCacheKey())
+
+        # legacy entries are migrated on access
+        legacy_segment = google_speech.SpeechSegment("Legacy entry", "en", 1, 2)
+        legacy_url = legacy_segment.buildUrl(cache_friendly=True)
+        google_speech.SpeechSegment.getCache()[legacy_url] = b"\x00"
+        self.assertFalse(google_speech.SpeechSegment("legacy  ENTRY", "en", 0, 1).isInCache())
+        self.assertTrue(legacy_segment.isInCache())
+        self.assertNotIn(legacy_url, google_speech.SpeechSegment.getCache())
+        self.assertEqual(google_speech.SpeechSegment("legacy  ENTRY", "en", 0, 1).getAudioData(), b"\x00")
+
+        # legacy entries are migrated once during maintenance, then not looked up anymore
+        with tempfile.TemporaryDirectory() as tmp_dir, unittest.mock.patch.dict(
+            os.environ, {"XDG_CACHE_HOME": tmp_dir}
+        ), unittest.mock.patch.object(
+            google_speech.web_cache, "DISABLE_PERSISTENT_CACHING", False
+        ), unittest.mock.patch.object(
+            google_speech.SpeechSegment, "cache", None
+        ), unittest.mock.patch.object(
+            google_speech.SpeechSegment, "legacy_cache_migrated", None
+        ):
+            cache = google_speech.SpeechSegment.getCache()
+            cache[legacy_url] = b"\x01"
+            google_speech.SpeechSegment.runCacheMaintenance(cache, migrate_legacy_entries=True)
+            self.assertNotIn(legacy_url, cache)
+            self.assertEqual(legacy_segment.getAudioData(), b"\x01")
+            self.assertTrue(cache.getMetadata(google_speech.SpeechSegment.LEGACY_MIGRATION_METADATA_KEY))
+            self.assertIsNone(google_speech.SpeechSegment.migrateCacheOnce())
+            other_legacy_segment = google_speech.SpeechSegment("Other legacy entry", "en", 1, 2)
+            other_legacy_url = other_legacy_segment.buildUrl(cache_friendly=True)
+            cache[other_legacy_url] = b"\x02"
+            contains = type(cache).__contains__
+            with unittest.mock.patch.object(
+                type(cache), "__contains__", autospec=True, side_effect=contains
+            ) as contains_mock:
+                self.assertFalse(other_legacy_segment.isInCache())
+                self.assertEqual(contains_mock.call_count, 1)
+            self.assertIn(other_legacy_url, cache)
+
+    def test_iterPreloaded(self):
+        """Preload segments ahead of consumption, in order."""
+        text = " ".join("Sentence number %u." % (i) for i in range(100))
+        speech = google_speech.Speech(text, "en")
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "download", side_effect=lambda url: url.encode()
+        ) as download_mock:
+            speech_segments = list(speech.iterPreloaded(jobs=4, window=3))
+            self.assertEqual([str(s) for s in speech_segments], [str(s) for s in speech])
+            for segment in speech_segments:
+                self.assertEqual(segment.getAudioData(), segment.buildUrl().encode())
+            self.assertEqual(download_mock.call_count, len(speech_segments))
+
+            # input is stdin
+            with tempfile.SpooledTemporaryFile(mode="w+t") as text_file:
+                for i in range(50):
+                    text_file.write("Line %u\n" % (i))
+                text_file.seek(0)
+                original_stdin, sys.stdin = sys.stdin, text_file
+                try:
+                    segments = []
+                    for segment in google_speech.Speech("-", "en").iterPreloaded(jobs=2, window=4):
+                        segment.getAudioData()
+                        segments.append(segment)
+                finally:
+                    sys.stdin = original_stdin
+            self.assertEqual([str(s) for s in segments], ["Line %u" % (i) for i in range(50)])
+            self.assertEqual(download_mock.call_count, len(speech_segments) + 50)
+
+        # no thread to preload segments
+        with self.assertRaises(ValueError):
+            google_speech.PreloadScheduler(0)
+
+    def test_save(self):
+        """Save segments concurrently, in order."""
+        text = " ".join("Saved sentence number %u." % (i) for i in range(100))
+        speech = google_speech.Speech(text, "en")
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "download", side_effect=lambda url: url.encode()
+        ) as download_mock:
+            output = io.BytesIO()
+            speech.savef(output, jobs=4)
+            self.assertEqual(output.getvalue(), b"".join(segment.buildUrl().encode() for segment in speech))
+            self.assertEqual(download_mock.call_count, len(list(speech)))
+
+    def test_asyncSpeech(self):
+        """Fetch audio data with the asyncio interface."""
+        text = " ".join("Async sentence number %u." % (i) for i in range(100))
+        speech = google_speech.Speech(text, "en")
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "download", side_effect=lambda url: url.encode()
+        ) as download_mock, unittest.mock.patch.object(google_speech.async_speech, "aiohttp", None):
+            output = io.BytesIO()
+            asyncio.run(google_speech.async_speech.AsyncSpeech(text, "en", concurrency=4).savef(output))
+            self.assertEqual(output.getvalue(), b"".join(segment.buildUrl().encode() for segment in speech))
+            self.assertEqual(download_mock.call_count, len(list(speech)))
+
+    @unittest.skipIf(google_speech.async_speech.aiohttp is None, "Need aiohttp")
+    def test_asyncDownload(self):
+        """Retry and rate limit downloads with aiohttp."""
+        aiohttp = google_speech.async_speech.aiohttp
+        segment = google_speech.async_speech.AsyncSpeechSegment("Async download", "en", 0)
+        url = segment.buildUrl()
+        response = unittest.mock.MagicMock()
+        response.__aenter__.return_value = response
+        response.read = unittest.mock.AsyncMock(return_value=b"\x08")
+        error_response = unittest.mock.MagicMock()
+        error_response.__aenter__.return_value = error_response
+        error_response.raise_for_status.side_effect = aiohttp.ClientResponseError(None, (), status=404)
+        request_count = google_speech.SpeechSegment.getDownloadStats().get("requests", 0)
+        with unittest.mock.patch.object(google_speech.SpeechSegment, "DOWNLOAD_RETRY_BACKOFF", 0):
+            # retry transient errors
+            session = unittest.mock.Mock()
+            session.get.side_effect = (aiohttp.ClientConnectionError(), response)
+            self.assertEqual(asyncio.run(segment.downloadAsync(url, session)), b"\x08")
+            self.assertEqual(session.get.call_count, 2)
+
+            # don't retry client errors
+            session = unittest.mock.Mock()
+            session.get.return_value = error_response
+            with self.assertRaises(aiohttp.ClientResponseError):
+                asyncio.run(segment.downloadAsync(url, session))
+            self.assertEqual(session.get.call_count, 1)
+        self.assertEqual(google_speech.SpeechSegment.getDownloadStats()["requests"], request_count + 3)
+
+        # rate limit, without blocking the event loop
+        session = unittest.mock.Mock()
+        session.get.return_value = response
+        google_speech.SpeechSegment.setRateLimit(50)
+        try:
+
+            async def download():
+                with unittest.mock.patch.object(google_speech.time, "sleep", side_effect=AssertionError()):
+                    await asyncio.gather(*(segment.downloadAsync(url, session) for _ in range(6)))
+
+            start_time = time.monotonic()
+            asyncio.run(download())
+            self.assertGreaterEqual(time.monotonic() - start_time, 0.09)
+        finally:
+            google_speech.SpeechSegment.setRateLimit(None)
+        with self.assertRaises(ValueError):
+            google_speech.SpeechSegment.setRateLimit(0)
+
+    def test_batch(self):
+        """Render many speeches, downloading identical segments once."""
+        texts = ("Batch sentence one.", "Batch sentence two.", "Batch sentence one.")
+        with tempfile.TemporaryDirectory() as tmp_dir, unittest.mock.patch.object(
+            google_speech.SpeechSegment, "download", side_effect=lambda url: url.encode()
+        ) as download_mock:
+            jobs = [
+                google_speech.batch.BatchJob(text, "en", os.path.join(tmp_dir, "%u.mp3" % (i)))
+                for i, text in enumerate(texts)
+            ]
+            jobs.append(google_speech.batch.BatchJob(texts[0], "en", os.path.join(tmp_dir, "missing", "0.mp3")))
+            results = google_speech.batch.render(jobs, worker_count=2)
+            self.assertEqual(download_mock.call_count, 2)
+            self.assertEqual([result.job for result in results], jobs)
+            self.assertEqual([result.error is None for result in results], [True, True, True, False])
+            for job in jobs[:-1]:
+                with open(job.output, "rb") as f:
+                    self.assertEqual(f.read(), google_speech.SpeechSegment(job.text, "en", 0, 1).buildUrl().encode())
+
+    def test_memoryCache(self):
+        """Serve audio data from the in memory cache tier."""
+        memory_cache = google_speech.MemoryCache(10)
+        memory_cache["a"] = b"aaaa"
+        memory_cache["b"] = b"bbbb"
+        self.assertEqual(memory_cache.get("a"), b"aaaa")
+        memory_cache["c"] = b"cccc"
+        self.assertIsNone(memory_cache.get("b"))
+        self.assertEqual(memory_cache.get("a"), b"aaaa")
+        memory_cache["d"] = b"d" * 11
+        self.assertNotIn("d", memory_cache)
+        self.assertEqual(
+            memory_cache.getStats(),
+            {"entries": 2, "size": 8, "max_size": 10, "hits": 2, "misses": 1, "evictions": 1},
+        )
+
+        google_speech.SpeechSegment.enableMemoryCache(1024)
+        try:
+            segment = google_speech.SpeechSegment("Memory cached", "en", 0)
+            segment.storeAudioData(b"\x01")
+            with unittest.mock.patch.object(google_speech.SpeechSegment, "getCache") as cache_mock:
+                self.assertTrue(segment.isInCache())
+                self.assertEqual(segment.getAudioData(), b"\x01")
+                cache_mock.assert_not_called()
+
+            # enabled by the server
+            with unittest.mock.patch.object(google_speech.server, "createServer") as create_server_mock:
+                create_server_mock.return_value.serve_forever.side_effect = KeyboardInterrupt
+                google_speech.server.serve("127.0.0.1:0", 1, 2048)
+            self.assertEqual(google_speech.SpeechSegment.memory_cache.max_size, 2048)
+        finally:
+            google_speech.SpeechSegment.enableMemoryCache(0)
+
+    def test_download(self):
+        """Retry, hedge and rate limit downloads."""
+        segment = google_speech.SpeechSegment("Download", "en", 0)
+        url = segment.buildUrl()
+        response = unittest.mock.Mock(content=b"\x02")
+        with unittest.mock.patch.object(google_speech.SpeechSegment, "DOWNLOAD_RETRY_BACKOFF", 0):
+            # retry transient errors
+            session = unittest.mock.Mock()
+            session.get.side_effect = (google_speech.requests.ConnectionError(), response)
+            with unittest.mock.patch.object(google_speech.SpeechSegment, "getSession", return_value=session):
+                self.assertEqual(segment.download(url), b"\x02")
+            self.assertEqual(session.get.call_count, 2)
+
+            # don't retry client errors
+            session = unittest.mock.Mock()
+            error_response = unittest.mock.Mock(status_code=404)
+            error_response.raise_for_status.side_effect = google_speech.requests.HTTPError(response=error_response)
+            session.get.return_value = error_response
+            with unittest.mock.patch.object(google_speech.SpeechSegment, "getSession", return_value=session):
+                with self.assertRaises(google_speech.requests.HTTPError):
+                    segment.download(url)
+            self.assertEqual(session.get.call_count, 1)
+
+        # hedge slow requests
+        responses = [(1, b"\x03"), (0, b"\x04")]
+
+        def slow_get(*args, **kwargs):
+            delay, content = responses.pop(0)
+            time.sleep(delay)
+            return unittest.mock.Mock(content=content)
+
+        session = unittest.mock.Mock()
+        session.get.side_effect = slow_get
+        hedge_count = google_speech.SpeechSegment.getDownloadStats().get("hedges", 0)
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "getSession", return_value=session
+        ), unittest.mock.patch.object(google_speech.SpeechSegment, "DOWNLOAD_HEDGE_DELAY", 0.1):
+            self.assertEqual(segment.download(url), b"\x04")
+        self.assertEqual(google_speech.SpeechSegment.getDownloadStats()["hedges"], hedge_count + 1)
+
+        # rate limit
+        rate_limiter = google_speech.RateLimiter(50)
+        start_time = time.monotonic()
+        for _ in range(6):
+            rate_limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.09)
+
+    def test_streamedDownload(self):
+        """Stream audio data while it is downloaded, and store it in cache when complete."""
+        response = unittest.mock.MagicMock()
+        response.__enter__.return_value = response
+        response.iter_content.return_value = (b"\x01", b"\x02")
+        session = unittest.mock.Mock()
+        session.get.side_effect = (google_speech.requests.ConnectionError(), response, response)
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "getSession", return_value=session
+        ), unittest.mock.patch.object(google_speech.SpeechSegment, "DOWNLOAD_RETRY_BACKOFF", 0):
+            segment = google_speech.SpeechSegment("Streamed download", "en", 0)
+            self.assertEqual(list(segment.iterAudioDataChunks()), [b"\x01", b"\x02"])
+            self.assertEqual(session.get.call_count, 2)
+            self.assertEqual(list(segment.iterAudioDataChunks()), [b"\x01\x02"])
+            self.assertEqual(session.get.call_count, 2)
+
+            # streamed audio data is trimmed before playback, not by SoX, that would wait for the end of data
+            process = unittest.mock.Mock(returncode=0)
+            audio_data = (b"\xff\xf3\x44\xc4" + bytes(92)) * 20
+            audio_chunks = iter((audio_data[:500], audio_data[500:]))
+            with unittest.mock.patch.object(
+                google_speech.SpeechSegment, "iterAudioDataChunks", return_value=audio_chunks
+            ), unittest.mock.patch.object(google_speech.subprocess, "Popen", return_value=process) as popen_mock:
+                google_speech.SpeechSegment("Streamed playback", "en", 0).play(("speed", "1.1"), stream_download=True)
+            self.assertNotIn("reverse", popen_mock.call_args[0][0])
+            self.assertEqual(popen_mock.call_args[0][0][-2:], ["speed", "1.1"])
+            self.assertEqual(
+                b"".join(call[0][0] for call in process.stdin.write.call_args_list),
+                bytes(google_speech.mp3.trim(audio_data, 0.1, 0.07)),
+            )
+
+            # incomplete download is not cached
+            segment = google_speech.SpeechSegment("Interrupted streamed download", "en", 0)
+            audio_chunks = segment.iterAudioDataChunks()
+            self.assertEqual(next(audio_chunks), b"\x01")
+            audio_chunks.close()
+            self.assertFalse(segment.isInCache())
+            self.assertNotIn(segment.getCacheKey(), google_speech.SpeechSegment.in_flight)
+
+    def test_processedCache(self):
+        """Decode and process audio data once for each effect chain."""
+        segment = google_speech.SpeechSegment("Processed segment", "en", 0)
+        process = unittest.mock.Mock(returncode=0)
+        process.communicate.return_value = (b"\x00\x01", b"")
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "download", side_effect=lambda url: url.encode()
+        ) as download_mock, unittest.mock.patch.object(
+            google_speech.subprocess, "Popen", return_value=process
+        ) as popen_mock:
+            for _ in range(2):
+                self.assertEqual(segment.getProcessedPcmData(("speed", "1.1")), b"\x00\x01")
+            self.assertEqual(popen_mock.call_count, 1)
+            self.assertEqual(popen_mock.call_args[0][0][-2:], ["speed", "1.1"])
+            process.communicate.assert_called_once_with(input=segment.buildUrl().encode())
+            self.assertEqual(segment.getProcessedPcmData(), b"\x00\x01")
+            self.assertEqual(popen_mock.call_count, 2)
+            self.assertEqual(download_mock.call_count, 1)
+
+    def test_singleFlight(self):
+        """Share a single download between concurrent fetches of the same audio data."""
+
+        def slow_download(url):
+            time.sleep(0.2)
+            return b"\x05"
+
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "download", side_effect=slow_download
+        ) as download_mock, concurrent.futures.ThreadPoolExecutor(8) as executor:
+            segments = [google_speech.SpeechSegment("Single  flight", "en", i) for i in range(8)]
+            results = list(executor.map(google_speech.SpeechSegment.getAudioData, segments))
+            self.assertEqual(results, [b"\x05"] * 8)
+            self.assertEqual(download_mock.call_count, 1)
+
+        # a segment being downloaded by another thread is preloaded when its download completes
+        segment = google_speech.SpeechSegment("In flight", "en", 0)
+        future, leader = google_speech.SpeechSegment.in_flight.register(segment.getCacheKey())
+        self.assertTrue(leader)
+        scheduler = google_speech.PreloadScheduler(1)
+        try:
+            scheduler.preloadAll((segment,))
+        finally:
+            scheduler.stop()
+        self.assertIsNone(segment.preloaded_time)
+        segment.storeAudioData(b"\x05")
+        google_speech.SpeechSegment.in_flight.complete(segment.getCacheKey(), future, b"\x05")
+        self.assertIsNotNone(segment.preloaded_time)
+
+        # errors are propagated to all callers
+        single_flight = google_speech.SingleFlight()
+        barrier = threading.Barrier(4)
+
+        def failing_call():
+            time.sleep(0.2)
+            raise ValueError()
+
+        def call():
+            barrier.wait()
+            return single_flight.call("key", failing_call)
+
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(call) for _ in range(4)]
+            for future in futures:
+                self.assertIsInstance(future.exception(), ValueError)
+        self.assertNotIn("key", single_flight)
+
+    def test_instrumentation(self):
+        """Collect performance measurements."""
+        stats_collector = google_speech.instrumentation.StatsCollector()
+        google_speech.instrumentation.addHook(stats_collector)
+        try:
+            text = " ".join("Instrumented sentence number %u." % (i) for i in range(20))
+            with unittest.mock.patch.object(
+                google_speech.SpeechSegment, "getSession", return_value=unittest.mock.Mock()
+            ) as session_mock:
+                session_mock.return_value.get.return_value = unittest.mock.Mock(content=b"\x06" * 10)
+                google_speech.Speech(text, "en").savef(io.BytesIO())
+        finally:
+            google_speech.instrumentation.removeHook(stats_collector)
+        summary = stats_collector.getSummary()
+        segment_count = len(list(google_speech.Speech(text, "en")))
+        self.assertEqual(summary["split"]["count"], 1)
+        self.assertEqual(summary["split"]["segment_count"]["total"], segment_count)
+        self.assertEqual(summary["download"]["count"], segment_count)
+        self.assertEqual(summary["download"]["bytes"]["total"], 10 * segment_count)
+        self.assertEqual(summary["download"]["error"], {"true": 0, "false": segment_count})
+        self.assertEqual(summary["preload_lead"]["count"], segment_count)
+        self.assertIn("p99", summary["cache_lookup"]["duration"])
+
+        # memory usage is bounded
+        stats_collector = google_speech.instrumentation.StatsCollector()
+        value_count = 10 * stats_collector.SAMPLE_SIZE
+        for i in range(value_count):
+            stats_collector("event", {"value": i, "hit": i % 4 == 0, "name": "ignored"})
+        self.assertEqual(len(stats_collector.events["event"]["value"].sample), stats_collector.SAMPLE_SIZE)
+        summary = stats_collector.getSummary()["event"]
+        self.assertEqual(summary["count"], value_count)
+        self.assertEqual(summary["hit"], {"true": value_count // 4, "false": value_count - value_count // 4})
+        self.assertNotIn("name", summary)
+        self.assertEqual(summary["value"]["total"], value_count * (value_count - 1) // 2)
+        self.assertEqual((summary["value"]["min"], summary["value"]["max"]), (0, value_count - 1))
+        self.assertAlmostEqual(summary["value"]["p50"], value_count / 2, delta=value_count / 10)
+
+    def test_cacheTools(self):
+        """Warm up, export and import cache."""
+        texts = ("Warm phrase one.", "Warm phrase two.", "Warm phrase one.")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with unittest.mock.patch.dict(
+                os.environ, {"XDG_CACHE_HOME": os.path.join(tmp_dir, "cache1")}
+            ), unittest.mock.patch.object(
+                google_speech.web_cache, "DISABLE_PERSISTENT_CACHING", False
+            ), unittest.mock.patch.object(
+                google_speech.SpeechSegment, "cache", None
+            ), unittest.mock.patch.object(
+                google_speech.SpeechSegment, "download", side_effect=lambda url: url.encode()
+            ) as download_mock:
+                self.assertEqual(google_speech.cache_tools.warmCache(texts, "en", 2), 2)
+                self.assertEqual(download_mock.call_count, 2)
+                bundle_filepath = os.path.join(tmp_dir, "bundle.zip")
+                self.assertEqual(google_speech.cache_tools.exportCache(bundle_filepath), 2)
+
+            with unittest.mock.patch.dict(
+                os.environ, {"XDG_CACHE_HOME": os.path.join(tmp_dir, "cache2")}
+            ), unittest.mock.patch.object(
+                google_speech.web_cache, "DISABLE_PERSISTENT_CACHING", False
+            ), unittest.mock.patch.object(
+                google_speech.SpeechSegment, "cache", None
+            ), unittest.mock.patch.object(
+                google_speech.SpeechSegment, "download"
+            ) as download_mock:
+                self.assertEqual(google_speech.cache_tools.importCache(bundle_filepath), 2)
+                self.assertEqual(google_speech.cache_tools.importCache(bundle_filepath), 0)
+                for text in texts:
+                    segment = google_speech.SpeechSegment(text, "en", 0, 1)
+                    self.assertEqual(segment.getAudioData(), segment.buildUrl().encode())
+                download_mock.assert_not_called()
+
+    def test_mp3(self):
+        """Parse, trim and concatenate MP3 frames."""
+        # MPEG 2 layer III, 32 kbps, 24 kHz, mono: 96 bytes and 24 ms per frame, 83 bytes of main data
+        frame_header = b"\xff\xf3\x44\xc4"
+        frame_count = 50
+        audio_data = bytearray(b"ID3\x04\x00\x00\x00\x00\x00\x02\x00\x00")
+        for i in range(frame_count):
+            # main data begin, in side information
+            main_data_begin = 100 if i == 4 else 0
+            audio_data.extend(frame_header + bytes((main_data_begin,)) + bytes(91))
+        audio_data = bytes(audio_data)
+        frames = list(google_speech.mp3.iterFrames(audio_data))
+        self.assertEqual(len(frames), frame_count)
+        self.assertEqual(frames[0].offset, 12)
+        self.assertEqual(frames[0].size, 96)
+        self.assertAlmostEqual(google_speech.mp3.getDuration(audio_data), frame_count * 0.024)
+
+        # 4 frames removed at start, 2 at end, and 2 kept for the bit reservoir of the first kept frame (4 * 24 < 100)
+        trimmed_data = google_speech.mp3.trim(audio_data, 0.1, 0.07)
+        self.assertIsInstance(trimmed_data, memoryview)
+        trimmed_frames = list(google_speech.mp3.iterFrames(trimmed_data))
+        self.assertEqual(len(trimmed_frames), frame_count - 4 + 2 - 2)
+        self.assertEqual(trimmed_data.obj, audio_data)
+        self.assertEqual(bytes(trimmed_data), audio_data[frames[2].offset : frames[-2].offset])
+
+        # trim data received by chunks, like the whole data
+        for chunk_size in (1, 50, 96, 1000, len(audio_data)):
+            chunks = [audio_data[i : i + chunk_size] for i in range(0, len(audio_data), chunk_size)]
+            self.assertEqual(
+                b"".join(google_speech.mp3.iterTrimmedChunks(chunks, 0.1, 0.07)), bytes(trimmed_data), chunk_size
+            )
+        # too short, only frames are kept
+        short_data = audio_data[: frames[6].offset]
+        self.assertEqual(
+            b"".join(google_speech.mp3.iterTrimmedChunks((short_data,), 0.1, 0.07)), short_data[frames[0].offset :]
+        )
+        # frames are output before the end of data
+        trimmer = google_speech.mp3.StreamTrimmer(0.1, 0.07)
+        self.assertEqual(trimmer.feed(audio_data[: frames[10].offset]), audio_data[frames[2].offset : frames[7].offset])
+
+        # not MP3 data
+        self.assertEqual(google_speech.mp3.trim(b"\x00\x01", 0.1, 0.07), b"\x00\x01")
+        self.assertEqual(b"".join(google_speech.mp3.iterTrimmedChunks((b"\x00", b"\x01"), 0.1, 0.07)), b"\x00\x01")
+
+        # concatenate with Info tag
+        output = io.BytesIO()
+        with google_speech.mp3.Mp3Writer(output) as writer:
+            writer.write(trimmed_data)
+            writer.write(trimmed_data)
+        output_data = output.getvalue()
+        tag_frame = google_speech.mp3.parseFrameHeader(output_data, 0)
+        self.assertEqual(output_data[13:17], b"Info")
+        self.assertEqual(int.from_bytes(output_data[21:25], "big"), 2 * len(trimmed_frames))
+        self.assertEqual(int.from_bytes(output_data[25:29], "big"), len(output_data))
+        toc = output_data[29:129]
+        self.assertEqual(list(toc), sorted(toc))
+        self.assertEqual(toc[50], (tag_frame.size + len(trimmed_data)) * 256 // len(output_data))
+        self.assertEqual(output_data[tag_frame.size :], bytes(trimmed_data) * 2)
+        self.assertEqual(len(list(google_speech.mp3.iterFrames(output_data))), 2 * len(trimmed_frames))
+
+    def test_server(self):
+        """Get speech audio data from a server, on TCP and Unix sockets."""
+        for address, is_unix_socket in (
+            ("127.0.0.1:8493", False),
+            ("localhost:8493", False),
+            ("[::1]:8493", False),
+            ("/tmp/speech.sock", True),
+            ("speech.sock", True),
+            ("run/speech:1", True),
+        ):
+            self.assertEqual(google_speech.server.isUnixSocketAddress(address), is_unix_socket)
+        self.assertEqual(google_speech.server.parseTcpAddress("[::1]:8493"), ("::1", 8493))
+        text = " ".join("Served sentence number %u." % (i) for i in range(30))
+        speech = google_speech.Speech(text, "en")
+        with tempfile.TemporaryDirectory() as tmp_dir, unittest.mock.patch.object(
+            google_speech.SpeechSegment, "download", side_effect=lambda url: url.encode()
+        ) as download_mock:
+            scheduler = google_speech.PreloadScheduler(2)
+            cwd = os.getcwd()
+            # for the relative socket path
+            os.chdir(tmp_dir)
+            try:
+                for address in ("127.0.0.1:0", os.path.join(tmp_dir, "server.sock"), "relative.sock"):
+                    server = google_speech.server.createServer(address, scheduler)
+                    if not google_speech.server.isUnixSocketAddress(address):
+                        address = "%s:%u" % server.server_address
+                    server_thread = threading.Thread(target=server.serve_forever)
+                    server_thread.start()
+                    try:
+                        audio_data = b"".join(google_speech.server.iterSpeechData(address, text, "en"))
+                        self.assertEqual(audio_data, b"".join(segment.buildUrl().encode() for segment in speech))
+                        with self.assertRaises(RuntimeError):
+                            next(google_speech.server.iterSpeechData(address, text, "invalid"))
+                    finally:
+                        server.shutdown()
+                        server.server_close()
+                        server_thread.join()
+            finally:
+                os.chdir(cwd)
+                scheduler.stop()
+        # next servers get audio data from cache
+        self.assertEqual(download_mock.call_count, len(list(speech)))
+
+    def test_packFileCacheBackend(self):
+        """Store, read, delete and compact pack file cache entries."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pack_filepath = os.path.join(tmp_dir, "cache.pack")
+            cache = google_speech.cache_backends.PackFileCacheBackend(pack_filepath)
+            cache["a"] = b"data a"
+            cache["b"] = b"data b"
+            cache["a"] = b"new data a"
+            self.assertEqual(cache["a"], b"new data a")
+            self.assertIn("b", cache)
+            self.assertNotIn("c", cache)
+            with self.assertRaises(KeyError):
+                cache["c"]
+
+            # writes are seen by other instances
+            other_cache = google_speech.cache_backends.PackFileCacheBackend(pack_filepath)
+            self.assertEqual(other_cache["b"], b"data b")
+            cache["c"] = b"data c"
+            self.assertEqual(other_cache["c"], b"data c")
+            del other_cache["b"]
+            self.assertNotIn("b", cache)
+            self.assertEqual(sorted(cache.keys()), ["a", "c"])
+
+            self.assertGreater(cache.compact(), 0)
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(other_cache["a"], b"new data a")
+            cache.close()
+            other_cache.close()
+
+            cache = google_speech.cache_backends.PackFileCacheBackend(pack_filepath)
+            self.assertEqual(sorted(cache.keys()), ["a", "c"])
+            self.assertEqual(cache["c"], b"data c")
+
+            # compaction keeps write order, for eviction
+            cache["a"] = b"newer data a"
+            cache.compact()
+            self.assertEqual(cache.keys(), ["c", "a"])
+            self.assertEqual(cache.evict(max_count=1), 1)
+            self.assertEqual(cache.keys(), ["a"])
+
+            # readers never read the new pack file with the old index
+            other_cache = google_speech.cache_backends.PackFileCacheBackend(pack_filepath)
+            cache["a"] = b"data a"
+            cache["d"] = b"data d"
+            replace = os.replace
+            read_data = []
+
+            def replace_and_read(src, dst):
+                replace(src, dst)
+                if dst == pack_filepath:
+                    read_data.append(bytes(other_cache["d"]))
+
+            with unittest.mock.patch.object(google_speech.cache_backends.os, "replace", side_effect=replace_and_read):
+                cache.compact()
+            self.assertEqual(read_data, [b"data d"])
+            self.assertEqual(other_cache["d"], b"data d")
+            other_cache.close()
+            cache.close()
+            self.assertTrue(cache.lock_file.closed)
+
+    def test_cacheMaintenance(self):
+        """Purge, evict least recently used entries and compact caches, at most once per interval."""
+        with tempfile.TemporaryDirectory() as tmp_dir, unittest.mock.patch.object(
+            google_speech.web_cache, "DISABLE_PERSISTENT_CACHING", False
+        ):
+            sqlite_cache = google_speech.cache_backends.WebCacheBackend(os.path.join(tmp_dir, "cache.sqlite"))
+            pack_cache = google_speech.cache_backends.PackFileCacheBackend(os.path.join(tmp_dir, "cache.pack"))
+            for cache in (sqlite_cache, pack_cache):
+                for i in range(10):
+                    cache["key%u" % (i)] = bytes(1000)
+            with sqlite_cache.connect() as connection, connection:
+                # timestamps have a 1s resolution, make access order explicit
+                for i in range(10):
+                    connection.execute(
+                        "UPDATE %s SET last_accessed_timestamp = ? WHERE url = ?;"
+                        % (sqlite_cache.cache.getDbTableName()),
+                        (int(time.time()) - 100 + i, "key%u" % (i)),
+                    )
+
+            for cache in (sqlite_cache, pack_cache):
+                self.assertEqual(cache.getUsage(), (10, 10000))
+                self.assertEqual(cache.filterKeys(["key0", "key9", "missing"]), {"key0", "key9"})
+                self.assertIsNone(cache.getMetadata("name"))
+                cache.setMetadata("name", [1, "a"])
+                self.assertEqual(cache.getMetadata("name"), [1, "a"])
+
+                self.assertEqual(google_speech.cache_tools.maintainCache(cache, max_count=8, interval=3600), 2)
+                self.assertEqual(sorted(cache.keys()), ["key%u" % (i) for i in range(2, 10)])
+                # too soon
+                self.assertIsNone(google_speech.cache_tools.maintainCache(cache, max_count=1, interval=3600))
+                self.assertEqual(len(cache), 8)
+
+                self.assertEqual(google_speech.cache_tools.maintainCache(cache, max_size=5500, compact=True), 3)
+                self.assertEqual(sorted(cache.keys()), ["key%u" % (i) for i in range(5, 10)])
+                self.assertEqual(cache.getUsage(), (5, 5000))
+                self.assertEqual(cache.getMetadata("name"), [1, "a"])
+                self.assertTrue(cache.replaceMetadata("name", [1, "a"], 2))
+                self.assertFalse(cache.replaceMetadata("name", [1, "a"], 3))
+                self.assertTrue(cache.replaceMetadata("other name", None, 4))
+                self.assertEqual((cache.getMetadata("name"), cache.getMetadata("other name")), (2, 4))
+
+                # timestamp is only recorded when maintenance completes
+                timestamp = cache.getMetadata(google_speech.cache_tools.MAINTENANCE_TIMESTAMP_KEY)
+                with unittest.mock.patch.object(cache, "purge", side_effect=OSError()):
+                    with self.assertRaises(OSError):
+                        google_speech.cache_tools.maintainCache(cache, max_count=1)
+                self.assertEqual(cache.getMetadata(google_speech.cache_tools.MAINTENANCE_TIMESTAMP_KEY), timestamp)
+                self.assertIsNone(cache.getMetadata(google_speech.cache_tools.MAINTENANCE_LEASE_KEY))
+
+                # cache is being maintained by another process
+                cache.setMetadata(google_speech.cache_tools.MAINTENANCE_LEASE_KEY, time.time())
+                self.assertIsNone(google_speech.cache_tools.maintainCache(cache, max_count=1))
+                self.assertEqual(len(cache), 5)
+                # the other process died
+                cache.setMetadata(
+                    google_speech.cache_tools.MAINTENANCE_LEASE_KEY,
+                    time.time() - google_speech.cache_tools.MAINTENANCE_LEASE_DURATION - 1,
+                )
+                self.assertEqual(google_speech.cache_tools.maintainCache(cache, max_count=4), 1)
+                self.assertIsNone(cache.getMetadata(google_speech.cache_tools.MAINTENANCE_LEASE_KEY))
+            pack_cache.close()
+
+        # background maintenance does not compact, nor delay exit
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "cache_maintained", False
+        ), unittest.mock.patch.object(
+            google_speech.cache_tools, "maintainCache", return_value=0
+        ) as maintain_cache_mock, unittest.mock.patch.object(
+            google_speech.atexit, "register"
+        ) as atexit_register_mock:
+            google_speech.SpeechSegment.maintainCache().join()
+            self.assertFalse(maintain_cache_mock.call_args.kwargs["compact"])
+            atexit_register_mock.assert_not_called()
+
+        # audio data is not stored if the cache is locked
+        locked_cache = unittest.mock.MagicMock()
+        locked_cache.__setitem__.side_effect = sqlite3.OperationalError("database is locked")
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "getCache", return_value=locked_cache
+        ), unittest.mock.patch.object(google_speech.SpeechSegment, "maintainCache"):
+            google_speech.SpeechSegment("Locked cache", "en", 0).storeAudioData(b"\x00")
+        locked_cache.__setitem__.assert_called_once()
+
+    def test_segmentIndex(self):
+        """Write a segment index when saving, and extract segments with it."""
+        text = "  " + "\n".join("Indexed  sentence number %u, of the \t segment index test." % (i) for i in range(30))
+
+        def download(url):
+            # 24 ms frames, a different frame count for each segment
+            return (b"\xff\xf3\x44\xc4" + bytes(92)) * (10 + len(url) % 13)
+
+        with tempfile.TemporaryDirectory() as tmp_dir, unittest.mock.patch.object(
+            google_speech.SpeechSegment, "download", side_effect=download
+        ):
+            mp3_filepath = os.path.join(tmp_dir, "speech.mp3")
+            google_speech.Speech(text, "en").save(mp3_filepath, index=True)
+            index = google_speech.segment_index.readIndex(google_speech.segment_index.getIndexPath(mp3_filepath))
+            segments = index["segments"]
+            self.assertEqual(index["lang"], "en")
+            segment_texts = [segment.text for segment in google_speech.Speech(text, "en")]
+            self.assertEqual(len(segments), len(segment_texts))
+            with open(mp3_filepath, "rb") as f:
+                mp3_data = f.read()
+            start_time = 0
+            for segment_num, segment in enumerate(segments):
+                # offsets are in source text
+                source_text = text[segment["text_start"] : segment["text_end"]]
+                self.assertEqual(source_text.strip(), source_text)
+                self.assertEqual(google_speech.Speech.cleanSpaces(source_text), segment_texts[segment_num])
+                self.assertNotIn("text", segment)
+                audio_data = google_speech.SpeechSegment(
+                    segment_texts[segment_num], "en", segment_num
+                ).getTrimmedAudioData()
+                self.assertEqual(mp3_data[segment["offset"] : segment["offset"] + segment["size"]], audio_data)
+                self.assertEqual(segment["frame_count"], len(list(google_speech.mp3.iterFrames(audio_data))))
+                self.assertAlmostEqual(segment["duration"], segment["frame_count"] * 0.024)
+                self.assertAlmostEqual(segment["start_time"], start_time)
+                start_time += segment["duration"]
+            self.assertEqual(segments[-1]["offset"] + segments[-1]["size"], len(mp3_data))
+            self.assertEqual(google_speech.segment_index.findSegment(segments, 0), 0)
+            self.assertEqual(google_speech.segment_index.findSegment(segments, segments[2]["start_time"] + 0.01), 2)
+            self.assertEqual(google_speech.segment_index.findSegment(segments, start_time + 1), len(segments) - 1)
+
+            # text offsets are the same when text is read by chunks
+            chunks = [text[i : i + 100] for i in range(0, len(text), 100)]
+            self.assertEqual(
+                [segment.source_span for segment in google_speech.Speech(iter(chunks), "en")],
+                [(segment["text_start"], segment["text_end"]) for segment in segments],
+            )
+            self.assertEqual(
+                [segment.text_offset for segment in google_speech.Speech(iter(chunks), "en")],
+                [segment.text_offset for segment in google_speech.Speech(text, "en")],
+            )
+
+            for extract in (google_speech.segment_index.extractSegments, google_speech.segment_index.renderSegments):
+                output_file = io.BytesIO()
+                if extract is google_speech.segment_index.extractSegments:
+                    extracted_segments = extract(mp3_filepath, output_file, 1, 2)
+                else:
+                    extracted_segments = extract(index, text, output_file, 1, 2)
+                self.assertEqual(extracted_segments, segments[1:3])
+                extracted_data = output_file.getvalue()
+                self.assertTrue(extracted_data.endswith(mp3_data[segments[1]["offset"] : segments[3]["offset"]]))
+                self.assertEqual(
+                    len(list(google_speech.mp3.iterFrames(extracted_data))),
+                    segments[1]["frame_count"] + segments[2]["frame_count"],
+                )
+            with self.assertRaises(IndexError):
+                google_speech.segment_index.extractSegments(mp3_filepath, io.BytesIO(), len(segments))
+
+    def test_prefetch(self):
+        """Plan and run a deduplicated prefetch of texts in several languages."""
+        items = [
+            ("Prefetch one. Prefetch two.", "en"),
+            ("Prefetch two. Prefetch cached.", "en"),
+            ("Prefetch one. Prefetch fail.", "fr"),
+            ("Prefetch one.", "de"),
+        ]
+        google_speech.SpeechSegment("Prefetch cached.", "en", 0).storeAudioData(b"\x07")
+
+        def download(url):
+            if "fail" in url:
+                raise ValueError()
+            return url.encode()
+
+        with unittest.mock.patch.object(
+            google_speech.SpeechSegment, "download", side_effect=download
+        ) as download_mock, unittest.mock.patch.object(google_speech.SpeechSegment, "DOWNLOAD_RETRY_COUNT", 0):
+            plan = google_speech.cache_tools.planPrefetch(items, segmentation="sentence")
+            self.assertEqual(len(plan), 5)
+            self.assertEqual(plan.duplicate_count, 1)
+            self.assertEqual(plan.cached_counts, {"en": 1})
+            self.assertEqual(list(plan.segments), ["en", "fr", "de"])
+            self.assertEqual(
+                [(segment.lang, segment.text) for segment in plan.iterScheduled()],
+                [
+                    ("en", "Prefetch one."),
+                    ("fr", "Prefetch one."),
+                    ("de", "Prefetch one."),
+                    ("en", "Prefetch two."),
+                    ("fr", "Prefetch fail."),
+                ],
+            )
+
+            progress_callback = unittest.mock.Mock()
+            progress = google_speech.cache_tools.runPrefetch(plan, 2, progress_callback)
+            self.assertEqual(download_mock.call_count, 5)
+            self.assertEqual(
+                {lang: (p["total"], p["done"], p["failed"]) for lang, p in progress.items()},
+                {"en": (2, 2, 0), "fr": (2, 2, 1), "de": (1, 1, 0)},
+            )
+            progress_callback.assert_called_with(progress)
+
+            # nothing left to download, except the failed segment
+            plan = google_speech.cache_tools.planPrefetch(items, segmentation="sentence")
+            self.assertEqual([segment.text for segment in plan.iterScheduled()], ["Prefetch fail."])
+
 
 if __name__ == "__main__":
     # disable logging